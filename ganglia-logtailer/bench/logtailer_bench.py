@@ -0,0 +1,367 @@
+#!/usr/bin/python
+"""Throughput benchmark for the ganglia-logtailer plugins.
+
+For each plugin this generates a synthetic log from the sample lines in the
+plugin's documentation, with a chosen number of distinct vhosts, listeners or
+clients (the cardinality) and a chosen fraction of lines the plugin is
+interested in (the match ratio; the rest are unrelated syslog lines).  Each
+plugin then runs in a process of its own, so the peak RSS is its own, and
+reports
+    parse_line_lps   lines per second fed to parse_line one at a time
+    parse_lines_lps  lines per second fed to parse_lines in batches (for the
+                     plugins that have it, as ganglia-logtailer does)
+    get_state_s      seconds get_state takes after a whole corpus
+    peak_rss_kb      peak RSS of the process
+    parser_rss_kb    how much of that came after the corpus was built
+
+The results are written as JSON, and two result files (eg. from before and
+after a change) can be compared with --compare:
+
+    bench/logtailer_bench.py --output before.json
+    ... change something ...
+    bench/logtailer_bench.py --output after.json
+    bench/logtailer_bench.py --compare before.json after.json
+
+To benchmark another checkout with the same corpora, point --src at its src
+directory.  A plugin that raises anything but LogtailerParsingException fails
+its run, and the benchmark then exits with status 1."""
+
+import os
+import sys
+import gc
+import inspect
+import json
+import time
+import random
+import resource
+import optparse
+import subprocess
+from timeit import default_timer
+
+here = os.path.dirname(os.path.abspath(__file__))
+default_src = os.path.join(os.path.dirname(here), 'src')
+
+# lines the plugins aren't interested in, for match ratios below 1
+noise_lines = [
+    'Sep 11 09:03:05 host kernel: [1234567.891011] eth0: link up, 1000Mbps, full-duplex\n',
+    'Sep 11 09:03:06 host CRON[23456]: (root) CMD (   cd / && run-parts --report /etc/cron.hourly)\n',
+    'Sep 11 09:03:07 host sshd[3456]: Accepted publickey for deploy from 10.2.3.4 port 50212 ssh2\n',
+]
+
+# the generators take a random.Random and the cardinality, and return one line
+def ip(rand, cardinality, skew=1):
+    """returns one of cardinality IPs; the higher skew, the more often the
+    first few come up"""
+    n = int(cardinality * rand.random() ** skew)
+    return '10.%d.%d.%d' % (n >> 16 & 255, n >> 8 & 255, n & 255)
+
+def ncsa_date(rand):
+    return '[08/Jul/2013:12:%02d:%02d -0400]' % (rand.randrange(60), rand.randrange(60))
+
+def iso_date(rand):
+    return '2008-05-08T07:%02d:%02d' % (rand.randrange(60), rand.randrange(60))
+
+def request(rand):
+    return '%s /path/%d/item?id=%d HTTP/1.1' % (rand.choice(('GET', 'GET', 'GET', 'POST', 'HEAD')),
+                                                 rand.randrange(1000), rand.randrange(100000))
+
+def status(rand):
+    return rand.choice((200, 200, 200, 200, 304, 301, 404, 500))
+
+def apache_line(rand, cardinality):
+    # %v %A %a %u %{%Y-%m-%dT%H:%M:%S}t %c %s %>s %B %D %{cookie}n "%{Referer}i" "%r" "%{User-Agent}i" %P
+    code = status(rand)
+    return 'www.example.com 10.0.0.1 %s - %s - %d %d %d %d - "-" "%s" "Mozilla/5.0 (X11; Linux x86_64)" %d\n' % (
+        ip(rand, cardinality), iso_date(rand), code, code, rand.randrange(100, 50000),
+        rand.randrange(100, 2000000), request(rand), rand.randrange(1000, 30000))
+
+def vhost_line(rand, cardinality):
+    # %v %P %u %{%Y-%m-%dT%H:%M:%S}t %D %s %>s %I %O %B %a "%{X-Forwarded-For}i" "%r"
+    # a few busy vhosts and a long tail, as on a real shared server
+    vhost = int(cardinality * rand.random() ** 3)
+    code = status(rand)
+    return 'vhost%d.example.com %d - %s %d %d %d 400 %d %d %s "-" "%s"\n' % (
+        vhost, rand.randrange(1000, 30000), iso_date(rand), rand.randrange(100, 2000000), code, code,
+        rand.randrange(100, 50000), rand.randrange(100, 50000), ip(rand, 1000), request(rand))
+
+def haproxy_line(rand, cardinality):
+    listener = int(cardinality * rand.random() ** 3)
+    total = rand.randrange(1, 2000)
+    return 'Jan 24 20:17:25 localhost haproxy[6844]: %s:%d [24/Jan/2014:20:17:25.210] apps%d apps/app711 0/0/0/%d/%d %d 602 - - ---- %d/166/%d/0/0 0/0 "%s"\n' % (
+        ip(rand, 1000), rand.randrange(1024, 65536), listener, total, total, status(rand),
+        rand.randrange(100, 200), rand.randrange(100, 200), request(rand))
+
+def bind_line(rand, cardinality):
+    # a few clients make most of the queries
+    return 'Sep 11 09:03:05 ns0-sfo.lindenlab.com named[577]: client %s#%d: query: host%d.secondlife.com IN A\n' % (
+        ip(rand, cardinality, skew=2), rand.randrange(1024, 65536), rand.randrange(100))
+
+def postfix_line(rand, cardinality):
+    queue_id = '%X' % rand.randrange(1 << 40)
+    return rand.choice((
+        'Sep 12 13:50:21 host postfix/smtpd[13334]: connect from unknown[%s]\n' % ip(rand, cardinality),
+        'Sep 12 13:39:11 host postfix/local[11393]: %s: to=<foo@host>, orig_to=<foo@bar.com>, relay=local, delay=5, delays=1.9/0/0/3.2, dsn=2.0.0, status=sent (delivered to command: /usr/local/bin/procmail)\n' % queue_id,
+        'Sep 12 11:58:52 host postfix/local[18444]: %s: to=<invalid@host>, orig_to=<invalid@bar.com>, relay=local, delay=0.43, delays=0.41/0/0/0.02, dsn=5.1.1, status=bounced (unknown user: "invalid")\n' % queue_id,
+        ))
+
+def slapd_line(rand, cardinality):
+    return 'Oct 27 13:34:30 ldap0.lindenlab.com slapd[16533]: conn=%d fd=18 ACCEPT from IP=%s:%d (IP=0.0.0.0:636)\n' % (
+        rand.randrange(100000), ip(rand, cardinality), rand.randrange(1024, 65536))
+
+def tomcat_line(rand, cardinality):
+    # %h %l %u %t "%r" %s %b %D
+    return '%s - - %s "%s" %d %d %d\n' % (ip(rand, cardinality), ncsa_date(rand), request(rand), status(rand),
+                                            rand.randrange(100, 50000), rand.randrange(1, 2000))
+
+def varnish_line(rand, cardinality):
+    # %h %l %u %t "%r" %s %b "%{Referer}i" "%{User-agent}i"
+    return '%s - - %s "%s" %d %d "-" "Mozilla/5.0 (X11; Linux x86_64)"\n' % (
+        ip(rand, cardinality), ncsa_date(rand), request(rand), status(rand), rand.randrange(100, 50000))
+
+def svn_line(rand, cardinality):
+    # %{X-Forwarded-For}i %l %u %t "%r" %s %b "%{Referer}i" "%{User-Agent}i" %D
+    return '%s - - %s "%s /svn/repo/!svn/vcc/default HTTP/1.1" %d %d "-" "SVN/1.6.11 neon/0.29.3" %d\n' % (
+        ip(rand, cardinality), ncsa_date(rand), rand.choice(('PROPFIND', 'REPORT', 'GET', 'OPTIONS', 'MERGE')),
+        status(rand), rand.randrange(100, 50000), rand.randrange(1, 2000000))
+
+def unbound_line(rand, cardinality):
+    queries = rand.randrange(100, 10000)
+    cached = rand.randrange(queries)
+    return 'Mar  1 10:00:00 host unbound: [1234:0] info: server stats for thread %d: %d queries, %d answers from cache, %d recursions\n' % (
+        rand.randrange(4), queries, cached, queries - cached)
+
+def javagc_line(rand, cardinality):
+    start = rand.randrange(100000, 500000)
+    return rand.choice((
+        '%d.%03d: [GC %dK->%dK(508288K), 0.%07d secs]\n' % (rand.randrange(10000), rand.randrange(1000), start, start / 10, rand.randrange(10 ** 7)),
+        '%d.%03d: [Full GC %dK->%dK(508288K), 0.%07d secs]\n' % (rand.randrange(10000), rand.randrange(1000), start, start / 2, rand.randrange(10 ** 7)),
+        ))
+
+# plugin -> line generator
+generators = {
+    'ApacheLogtailer': apache_line,
+    'ApacheVHostLogtailer': vhost_line,
+    'BindLogtailer': bind_line,
+    'DummyLogtailer': slapd_line,
+    'HAProxyLogtailer': haproxy_line,
+    'JavaGCLogtailer': javagc_line,
+    'PostfixLogtailer': postfix_line,
+    'SVNLogtailer': svn_line,
+    'SlapdLogtailer': slapd_line,
+    'TomcatLogtailer': tomcat_line,
+    'UnboundLogtailer': unbound_line,
+    'VarnishLogtailer': varnish_line,
+    'VarnishMemcacheLogtailer': varnish_line,
+}
+
+class NullMemcache(object):
+    '''Takes VarnishMemcacheLogtailer's writes without a memcache server, so
+    only the plugin itself is measured.'''
+    def incr(self, key, delta=1):
+        return None
+    def add(self, key, value, time=0):
+        return True
+    def append(self, key, value, time=0):
+        return True
+
+def make_corpus(plugin, lines, cardinality, match_ratio, seed=1):
+    """returns a list of lines for plugin; the same arguments always give
+    the same lines"""
+    rand = random.Random(seed)
+    generate = generators[plugin]
+    corpus = []
+    for i in xrange(lines):
+        if rand.random() < match_ratio:
+            corpus.append(generate(rand, cardinality))
+        else:
+            corpus.append(rand.choice(noise_lines))
+    return corpus
+
+def make_parser(plugin):
+    cls = getattr(__import__(plugin), plugin)
+    # plugins that write to memcache (VarnishMemcacheLogtailer, since it
+    # took a client) get one that goes nowhere
+    if 'mc' in inspect.getargspec(cls.__init__).args:
+        parser = cls(mc=NullMemcache())
+    else:
+        parser = cls()
+    # as in cron mode, so get_state doesn't care how long the run took
+    parser.set_check_duration(parser.period)
+    return parser
+
+def feed_line(parser, corpus):
+    # from --src, like the plugins
+    from ganglia_logtailer_helper import LogtailerParsingException
+    for line in corpus:
+        try:
+            parser.parse_line(line)
+        except LogtailerParsingException:
+            # parsing exceptions are part of the cost; ganglia-logtailer
+            # logs them.  Anything else would kill it, so it fails the run.
+            pass
+
+def feed_lines(parser, corpus, batch=10000):
+    for i in xrange(0, len(corpus), batch):
+        parser.parse_lines(corpus[i:i + batch])
+
+def best_time(plugin, feed, corpus, repeat):
+    """returns the fastest of repeat runs of feed over corpus, each on a
+    fresh parser, and the last parser"""
+    best = None
+    for i in range(repeat):
+        parser = make_parser(plugin)
+        gc.collect()
+        start = default_timer()
+        feed(parser, corpus)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, parser)
+
+def run_one(plugin, lines, cardinality, match_ratio, repeat):
+    """benchmarks one plugin on one corpus, in this process, and returns the
+    result as a dict"""
+    corpus = make_corpus(plugin, lines, cardinality, match_ratio)
+    gc.collect()
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = dict(plugin=plugin, lines=lines, cardinality=cardinality, match_ratio=match_ratio)
+    (elapsed, parser) = best_time(plugin, feed_line, corpus, repeat)
+    result['parse_line_lps'] = int(lines / elapsed)
+    if hasattr(parser, 'parse_lines'):
+        (elapsed, parser) = best_time(plugin, feed_lines, corpus, repeat)
+        result['parse_lines_lps'] = int(lines / elapsed)
+    else:
+        result['parse_lines_lps'] = None
+    start = default_timer()
+    metrics = parser.get_state()
+    result['get_state_s'] = round(default_timer() - start, 6)
+    result['metrics'] = len(metrics)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_rss_kb'] = peak_rss
+    result['parser_rss_kb'] = peak_rss - baseline_rss
+    return result
+
+def run_all(options):
+    """benchmarks each plugin and cardinality in a process of its own and
+    returns the results, and a list of (plugin, cardinality) for the runs
+    that failed"""
+    results = []
+    failed = []
+    for plugin in options.plugins:
+        for cardinality in options.cardinality:
+            command = [sys.executable, os.path.abspath(__file__), '--src', options.src,
+                       '--run_one', plugin, '--lines', str(options.lines),
+                       '--cardinality', str(cardinality), '--match_ratio', str(options.match_ratio),
+                       '--repeat', str(options.repeat)]
+            child = subprocess.Popen(command, stdout=subprocess.PIPE)
+            (output, error) = child.communicate()
+            if child.returncode != 0:
+                print >> sys.stderr, "%s (cardinality %s) failed" % (plugin, cardinality)
+                failed.append((plugin, cardinality))
+                continue
+            result = json.loads(output)
+            print >> sys.stderr, "%-26s %8s %10s lines/s %10s lines/s (batched) %9.4fs get_state %8d KB" % (
+                plugin, cardinality, result['parse_line_lps'], result['parse_lines_lps'],
+                result['get_state_s'], result['peak_rss_kb'])
+            results.append(result)
+    return (results, failed)
+
+def git_commit(src):
+    try:
+        child = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=src,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return child.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+# measurement -> whether more is better
+measurements = [('parse_line_lps', True), ('parse_lines_lps', True),
+                ('get_state_s', False), ('peak_rss_kb', False)]
+
+def compare(before_file, after_file, threshold):
+    """prints the change in each measurement between two result files and
+    returns the number that got worse by more than threshold (a fraction)"""
+    (before, after) = [json.load(open(name)) for name in (before_file, after_file)]
+    key = lambda result: (result['plugin'], result['cardinality'], result['match_ratio'], result['lines'])
+    old = dict([(key(result), result) for result in before['results']])
+    regressions = 0
+    for result in after['results']:
+        if key(result) not in old:
+            continue
+        changes = []
+        for (name, higher_is_better) in measurements:
+            (was, now) = (old[key(result)][name], result[name])
+            if not was or now is None:
+                continue
+            change = float(now - was) / was
+            worse = (change < -threshold) if higher_is_better else (change > threshold)
+            if worse:
+                regressions += 1
+            changes.append('%s %+.1f%%%s' % (name, change * 100, worse and ' (worse)' or ''))
+        print "%-26s %8s  %s" % (result['plugin'], result['cardinality'], ', '.join(changes))
+    return regressions
+
+def main():
+    cmdline = optparse.OptionParser(usage='%prog [options]\n       %prog --compare BEFORE.json AFTER.json')
+    cmdline.add_option('--plugins', '-p', action='store', default=','.join(sorted(generators)),
+                       help='Comma separated plugins to benchmark (default all)')
+    cmdline.add_option('--lines', '-n', action='store', type='int', default=100000,
+                       help='Lines in each corpus (default 100000)')
+    cmdline.add_option('--cardinality', '-c', action='store', default='100,10000',
+                       help='Comma separated numbers of distinct vhosts, listeners or clients to benchmark with (default 100,10000)')
+    cmdline.add_option('--match_ratio', '-m', action='store', type='float', default=1.0,
+                       help='Fraction of lines the plugin is interested in; the rest are unrelated syslog lines (default 1)')
+    cmdline.add_option('--repeat', '-r', action='store', type='int', default=3,
+                       help='Time each plugin this many times and keep the fastest (default 3)')
+    cmdline.add_option('--src', '-s', action='store', default=default_src,
+                       help='The directory the plugins are in (default %s)' % default_src)
+    cmdline.add_option('--output', '-o', action='store',
+                       help='Write the results to this file as well as standard output')
+    cmdline.add_option('--compare', action='store_true', default=False,
+                       help='Compare two result files instead of running the benchmark')
+    cmdline.add_option('--threshold', '-t', action='store', type='float', default=0.1,
+                       help='With --compare, the fraction by which a measurement has to get worse to count as a regression (default 0.1)')
+    cmdline.add_option('--run_one', action='store', help=optparse.SUPPRESS_HELP)
+    (options, arguments) = cmdline.parse_args()
+
+    if options.compare:
+        if len(arguments) != 2:
+            cmdline.error("--compare needs two result files")
+        # exit status 1 if anything regressed, for scripts
+        sys.exit(compare(arguments[0], arguments[1], options.threshold) and 1 or 0)
+
+    options.src = os.path.abspath(options.src)
+    sys.path.insert(0, options.src)
+    if options.run_one:
+        # we're the child process benchmarking one plugin
+        result = run_one(options.run_one, options.lines, int(options.cardinality),
+                         options.match_ratio, options.repeat)
+        json.dump(result, sys.stdout)
+        return
+
+    options.plugins = [plugin.strip() for plugin in options.plugins.split(',')]
+    unknown = [plugin for plugin in options.plugins if plugin not in generators]
+    if unknown:
+        cmdline.error("no corpus for %s" % ', '.join(unknown))
+    try:
+        options.cardinality = [int(value) for value in options.cardinality.split(',')]
+    except ValueError:
+        cmdline.error("--cardinality must be a comma separated list of numbers")
+
+    (results, failed) = run_all(options)
+    report = dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  python=sys.version.split()[0],
+                  src=options.src,
+                  commit=git_commit(options.src),
+                  results=results)
+    output = json.dumps(report, indent=1, sort_keys=True)
+    print output
+    if options.output:
+        with open(options.output, 'w') as fh:
+            fh.write(output + '\n')
+    # a plugin that crashed is a failure, not a missing row
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -4,161 +4,149 @@
 ###    * hits per second
 ###    * GETs per second
 ###    * average query processing time
-###    * ninetieth percentile query processing time
+###    * query processing time percentiles (90th by default, see percentiles)
 ###    * number of HTTP 200, 300, 400, and 500 responses per second
 ###
 ###  Note that this plugin depends on a certain apache log format, documented in
-##   __init__.
+###  log_format.  Set the log_format plugin option if your log is different.
 
-import time
-import threading
-import re
+from itertools import repeat
+from operator import truediv
 
 # local dependencies
 from ganglia_logtailer_helper import GangliaMetricObject
 from ganglia_logtailer_helper import LogtailerParsingException, LogtailerStateException
+from ganglia_logtailer_helper import QuantileSketch, BufferedLogtailer
+from ganglia_logtailer_helper import LogFormat, parse_percentiles
 
-class ApacheLogtailer(object):
+class ApacheLogtailer(BufferedLogtailer):
     # only used in daemon mode
     period = 30
+    # request time percentiles to report (100 reports the maximum)
+    percentiles = (90,)
+    # the apache LogFormat of the log, unless the log_format option says otherwise
+    # host.com 127.0.0.1 127.0.0.1 - 2008-05-08T07:34:44 - 200 200 371 103918 - "-" "GET /path HTTP/1.0" "-" 23794
+    # it needs %r, %s (or %>s) and %D
+    log_format = '%v %A %a %u %{%Y-%m-%dT%H:%M:%S}t %c %s %>s %B %D %{cookie}n "%{Referer}i" "%r" "%{User-Agent}i" %P'
     def __init__(self):
         '''This function should initialize any data structures or variables
         needed for the internal state of the line parser.'''
-        self.reset_state()
-        self.lock = threading.RLock()
-        # this is what will match the apache lines
-        # apache log format string:
-        # %v %A %a %u %{%Y-%m-%dT%H:%M:%S}t %c %s %>s %B %D %{cookie}n \"%{Referer}i\" \"%r\" \"%{User-Agent}i\" %P
-        # host.com 127.0.0.1 127.0.0.1 - 2008-05-08T07:34:44 - 200 200 371 103918 - "-" "GET /path HTTP/1.0" "-" 23794
-        # match keys: server_name, local_ip, remote_ip, date, conn_status, init_retcode, final_retcode, size,
-        #               req_time, cookie, referrer, request, user_agent, pid
-        self.reg = re.compile('^(?P<server_name>[^ ]+) (?P<local_ip>[^ ]+) (?P<remote_ip>[^ ]+) (?P<user>[^ ]+) (?P<date>[^ ]+) (?P<conn_status>[^ ]+) (?P<init_retcode>[^ ]+) (?P<final_retcode>[^ ]+) (?P<size>[^ ]+) (?P<req_time>[^ ]+) (?P<cookie>[^ ]+) "(?P<referrer>[^"]+)" "(?P<request>[^"]+)" "(?P<user_agent>[^"]+)" (?P<pid>[^ ]+)')
+        BufferedLogtailer.__init__(self)
+        self.configure({})
 
-        # assume we're in daemon mode unless set_check_duration gets called
-        self.dur_override = False
 
-
-    # example function for parse line
-    # takes one argument (text) line to be parsed
+    # takes a dict of plugin options
     # returns nothing
-    def parse_line(self, line):
+    def configure(self, options):
+        '''This function takes the options given to the plugin with
+        --plugin_option or in its section of the --config file: log_format,
+        the apache LogFormat the log is written in, and percentiles, a comma
+        separated list of the percentiles to report (eg. 50,90,99,100).'''
+        unknown = [key for key in options if key not in ('log_format', 'percentiles')]
+        if unknown:
+            raise ValueError("unknown plugin options: %s" % ', '.join(unknown))
+        if 'percentiles' in options:
+            self.percentiles = parse_percentiles(options['percentiles'])
+        # this is what will pull the interesting fields out of the apache lines
+        log_format = LogFormat(options.get('log_format', self.log_format))
+        self.fields = log_format.extractor(('request', log_format.status_field(), 'req_time'))
+        # so use_event_time can count lines by their %t
+        self.event_time_from(log_format)
+    # takes no arguments
+    # returns an empty state buffer
+    def new_state(self):
+        '''This function returns the data structure used to maintain state,
+        zeroed out.  A fresh one is swapped in each time get_state is
+        called.'''
+        return dict( num_hits=0,
+                    num_gets=0,
+                    req_time=0,
+                    num_two=0,
+                    num_three=0,
+                    num_four=0,
+                    num_five=0,
+                    req_time_sketch=QuantileSketch()
+                    )
+    def accumulate(self, state, line):
         '''This function should digest the contents of one line at a time,
-        updating the internal state variables.'''
-        self.lock.acquire()
-        self.num_hits+=1
+        updating the state buffer.'''
+        state['num_hits']+=1
         try:
-            regMatch = self.reg.match(line)
-            if regMatch:
-                linebits = regMatch.groupdict()
-                # capture GETs
-                if( 'GET' in linebits['request'] ):
-                    self.num_gets+=1
-                # capture HTTP response code
-                rescode = float(linebits['init_retcode'])
-                if( (rescode >= 200) and (rescode < 300) ):
-                    self.num_two+=1
-                elif( (rescode >= 300) and (rescode < 400) ):
-                    self.num_three+=1
-                elif( (rescode >= 400) and (rescode < 500) ):
-                    self.num_four+=1
-                elif( (rescode >= 500) and (rescode < 600) ):
-                    self.num_five+=1
-                # capture request duration
-                dur = float(linebits['req_time'])
-                # convert to seconds
-                dur = dur / 1000000
-                self.req_time += dur
-                # store for 90th % calculation
-                self.ninetieth.append(dur)
-            else:
-                raise LogtailerParsingException, "regmatch failed to match"
+            (request, init_retcode, req_time) = self.fields.extract(line)
+            # capture GETs
+            if( 'GET' in request ):
+                state['num_gets']+=1
+            # capture HTTP response code
+            self.count_responses(state, init_retcode, 1)
+            # capture request duration
+            dur = float(req_time)
+            # convert to seconds
+            dur = dur / 1000000
+            state['req_time'] += dur
+            # store for percentile calculation
+            state['req_time_sketch'].add(dur)
         except Exception, e:
-            self.lock.release()
-            raise LogtailerParsingException, "regmatch or contents failed with %s" % e
-        self.lock.release()
-    # example function for deep copy
-    # takes no arguments
-    # returns one object
-    def deep_copy(self):
-        '''This function should return a copy of the data structure used to
-        maintain state.  This copy should different from the object that is
-        currently being modified so that the other thread can deal with it
-        without fear of it changing out from under it.  The format of this
-        object is internal to the plugin.'''
-        myret = dict( num_hits=self.num_hits,
-                    num_gets=self.num_gets,
-                    req_time=self.req_time,
-                    num_two=self.num_two,
-                    num_three=self.num_three,
-                    num_four=self.num_four,
-                    num_five=self.num_five,
-                    ninetieth=self.ninetieth
-                    )
-        return myret
-    # example function for reset_state
-    # takes no arguments
-    # returns nothing
-    def reset_state(self):
-        '''This function resets the internal data structure to 0 (saving
-        whatever state it needs).  This function should be called
-        immediately after deep copy with a lock in place so the internal
-        data structures can't be modified in between the two calls.  If the
-        time between calls to get_state is necessary to calculate metrics,
-        reset_state should store now() each time it's called, and get_state
-        will use the time since that now() to do its calculations'''
-        self.num_hits = 0
-        self.num_gets = 0
-        self.req_time = 0
-        self.num_two = 0
-        self.num_three = 0
-        self.num_four = 0
-        self.num_five = 0
-        self.ninetieth = list()
-        self.last_reset_time = time.time()
-    # example for keeping track of runtimes
-    # takes no arguments
-    # returns float number of seconds for this run
-    def set_check_duration(self, dur):
-        '''This function only used if logtailer is in cron mode.  If it is
-        invoked, get_check_duration should use this value instead of calculating
-        it.'''
-        self.duration = dur 
-        self.dur_override = True
-    def get_check_duration(self):
-        '''This function should return the time since the last check.  If called
-        from cron mode, this must be set using set_check_duration().  If in
-        daemon mode, it should be calculated internally.'''
-        if( self.dur_override ):
-            duration = self.duration
-        else:
-            cur_time = time.time()
-            duration = cur_time - self.last_reset_time
-            # the duration should be within 10% of period
-            acceptable_duration_min = self.period - (self.period / 10.0)
-            acceptable_duration_max = self.period + (self.period / 10.0)
-            if (duration < acceptable_duration_min or duration > acceptable_duration_max):
-                raise LogtailerStateException, "time calculation problem - duration (%s) > 10%% away from period (%s)" % (duration, self.period)
-        return duration
-    # example function for get_state
-    # takes no arguments
-    # returns a dictionary of (metric => metric_object) pairs
-    def get_state(self):
-        '''This function should acquire a lock, call deep copy, get the
-        current time if necessary, call reset_state, then do its
-        calculations.  It should return a list of metric objects.'''
-        # get the data to work with
-        self.lock.acquire()
+            raise LogtailerParsingException, "log format or contents failed with %s" % e
+    # takes the state buffer to update and a list of lines to be parsed
+    # returns a list of parsing exceptions
+    def accumulate_lines(self, state, lines):
+        '''This function digests a whole batch of lines a column at a time,
+        which saves doing the same work over for every line.  Lines that
+        don't fit the log format are skipped; if anything else in the batch
+        doesn't parse, it falls back to accumulate() for each line so the
+        good lines still count.'''
+        rows = map(self.fields.match, lines)
+        errors = []
+        good = filter(None, rows)
+        if len(good) < len(rows):
+            errors = [LogtailerParsingException("log format failed to match %s" % line.rstrip())
+                      for (line, row) in zip(lines, rows) if row is None]
+            rows = good
+        if not rows:
+            state['num_hits'] += len(lines)
+            return errors
         try:
-            mydata = self.deep_copy()
-            check_time = self.get_check_duration()
-            self.reset_state()
-            self.lock.release()
-        except LogtailerStateException, e:
-            # if something went wrong with deep_copy or the duration, reset and continue
-            self.reset_state()
-            self.lock.release()
-            raise e
-
+            (requests, init_retcodes, req_times) = zip(*rows)
+            # there are only a handful of distinct response codes
+            codes = {}
+            get = codes.get
+            for init_retcode in init_retcodes:
+                codes[init_retcode] = get(init_retcode, 0) + 1
+            for init_retcode in codes:
+                float(init_retcode)
+            durs = map(float, req_times)
+        except Exception:
+            return BufferedLogtailer.accumulate_lines(self, state, lines)
+        state['num_hits'] += len(lines)
+        state['num_gets'] += len([request for request in requests if 'GET' in request])
+        for (init_retcode, count) in codes.iteritems():
+            self.count_responses(state, init_retcode, count)
+        # convert to seconds
+        durs = map(truediv, durs, repeat(1000000, len(durs)))
+        state['req_time'] += sum(durs)
+        state['req_time_sketch'].extend(durs)
+        return errors
+    # takes the state buffer to update, a response code and how many
+    # responses had it
+    # returns nothing
+    def count_responses(self, state, init_retcode, count):
+        '''This function adds count responses with code init_retcode to the
+        per-class counters.'''
+        rescode = float(init_retcode)
+        if( (rescode >= 200) and (rescode < 300) ):
+            state['num_two']+=count
+        elif( (rescode >= 300) and (rescode < 400) ):
+            state['num_three']+=count
+        elif( (rescode >= 400) and (rescode < 500) ):
+            state['num_four']+=count
+        elif( (rescode >= 500) and (rescode < 600) ):
+            state['num_five']+=count
+    # takes a retired state buffer and the duration it covers
+    # returns a list of metric objects
+    def crunch(self, mydata, check_time):
+        '''This function does the calculations on a state buffer that is no
+        longer being written to.  It should return a list of metric
+        objects.'''
         # crunch data to how you want to report it
         hits_per_second = mydata['num_hits'] / check_time
         gets_per_second = mydata['num_gets'] / check_time
@@ -171,27 +159,19 @@ class ApacheLogtailer(object):
         four_per_second = mydata['num_four'] / check_time
         five_per_second = mydata['num_five'] / check_time
 
-        # calculate 90th % request time
-        ninetieth_list = mydata['ninetieth']
-        ninetieth_list.sort()
-        num_entries = len(ninetieth_list)
-        if (num_entries != 0 ):
-             ninetieth_element = ninetieth_list[int(num_entries * 0.9)]
-        else:
-             ninetieth_element = 0
-
         # package up the data you want to submit
         hps_metric = GangliaMetricObject('apache_hits', hits_per_second, units='hps')
         gps_metric = GangliaMetricObject('apache_gets', gets_per_second, units='hps')
         avgdur_metric = GangliaMetricObject('apache_avg_dur', avg_req_time, units='sec')
-        ninetieth_metric = GangliaMetricObject('apache_90th_dur', ninetieth_element, units='sec')
         twops_metric = GangliaMetricObject('apache_200', two_per_second, units='hps')
         threeps_metric = GangliaMetricObject('apache_300', three_per_second, units='hps')
         fourps_metric = GangliaMetricObject('apache_400', four_per_second, units='hps')
         fiveps_metric = GangliaMetricObject('apache_500', five_per_second, units='hps')
 
-        # return a list of metric objects
-        return [ hps_metric, gps_metric, avgdur_metric, ninetieth_metric, twops_metric, threeps_metric, fourps_metric, fiveps_metric, ]
-
-
+        # request time percentiles, eg. apache_90th_dur
+        percentile_metrics = []
+        for (label, value) in mydata['req_time_sketch'].percentiles(self.percentiles):
+            percentile_metrics.append(GangliaMetricObject('apache_%s_dur' % label, value, units='sec'))
 
+        # return a list of metric objects
+        return [ hps_metric, gps_metric, avgdur_metric, ] + percentile_metrics + [ twops_metric, threeps_metric, fourps_metric, fiveps_metric, ]
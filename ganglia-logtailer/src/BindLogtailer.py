@@ -2,142 +2,110 @@
 ###  This plugin for logtailer crunches bind's log and produces these metrics:
 ###    * queries per second
 ###    * number of unique clients seen in the sampling period, normalized over
-###      the sampling time
+###      the sampling time (estimated with a HyperLogLog, to within 2% or so)
 ###    * number of requests by the client that made the most requests
+###      (tracked for the busiest max_clients clients only)
 ###
 
-import time
-import threading
 import re
 
 # local dependencies
 from ganglia_logtailer_helper import GangliaMetricObject
 from ganglia_logtailer_helper import LogtailerParsingException, LogtailerStateException
+from ganglia_logtailer_helper import BufferedLogtailer, HeavyHitterTable, HyperLogLog
 
-class BindLogtailer(object):
+class BindLogtailer(BufferedLogtailer):
     # only used in daemon mode
     period = 30.0
+    # lines without these can't be queries; skip them without running the regex
+    line_guards = ('query', 'client ', 'named')
+    # how many of the busiest clients to count queries for
+    max_clients = 1000
     def __init__(self):
         '''This function should initialize any data structures or variables
         needed for the internal state of the line parser.'''
-        self.reset_state()
-        self.lock = threading.RLock()
+        BufferedLogtailer.__init__(self)
         # this is what will match the backbone lines
         # backbone log example:
         # Sep 11 09:03:05 ns0-sfo.lindenlab.com named[577]: client 80.189.94.233#49199: query: secondlife.com IN A
         # match keys: client_ip
-        self.reg = re.compile('^.*named.*client (?P<client_ip>[0-9\.]+).*query')
+        # searched for from where 'named' appears, rather than matched behind
+        # a leading .* that backtracks over the whole line
+        self.reg = re.compile('client (?P<client_ip>[0-9\.]+).*query')
 
-        # assume we're in daemon mode unless set_check_duration gets called
-        self.dur_override = False
 
-
-    # example function for parse line
-    # takes one argument (text) line to be parsed
-    # returns nothing
-    def parse_line(self, line):
+    # takes no arguments
+    # returns an empty state buffer
+    def new_state(self):
+        '''This function returns the data structure used to maintain state,
+        zeroed out.  A fresh one is swapped in each time get_state is
+        called.'''
+        return dict( num_hits=0,
+                     # distinct client ips
+                     clients=HyperLogLog(),
+                     # number of queries from the busiest client ips
+                     client_counts=HeavyHitterTable(self.max_clients, {}),
+                     )
+    def accumulate(self, state, line):
         '''This function should digest the contents of one line at a time,
-        updating the internal state variables.'''
-        self.lock.acquire()
+        updating the state buffer.'''
         try:
-            regMatch = self.reg.match(line)
+            regMatch = self.reg.search(line, line.find('named'))
             if regMatch:
-                linebits = regMatch.groupdict()
-                self.num_hits+=1
-                self.client_ip_list.append(linebits['client_ip'])
+                client_ip = regMatch.group('client_ip')
+                state['num_hits']+=1
+                state['clients'].add(client_ip)
+                client_counts = state['client_counts']
+                if client_counts.hit(client_ip) is None:
+                    # the table only counts; there are no other stats
+                    client_counts.admit(client_ip, {})
             else:
                 # this occurs for every non-named query line.  Ignore them.
                 #raise LogtailerParsingException, "regmatch failed to match line (%s)" % line
                 pass
         except Exception, e:
-            self.lock.release()
             raise LogtailerParsingException, "regmatch or contents failed with %s" % e
-        self.lock.release()
-    # example function for deep copy
-    # takes no arguments
-    # returns one object
-    def deep_copy(self):
-        '''This function should return a copy of the data structure used to
-        maintain state.  This copy should different from the object that is
-        currently being modified so that the other thread can deal with it
-        without fear of it changing out from under it.  The format of this
-        object is internal to the plugin.'''
-        myret = dict( num_hits=self.num_hits,
-                      client_ip_list=self.client_ip_list,
-                    )
-        return myret
-    # example function for reset_state
-    # takes no arguments
-    # returns nothing
-    def reset_state(self):
-        '''This function resets the internal data structure to 0 (saving
-        whatever state it needs).  This function should be called
-        immediately after deep copy with a lock in place so the internal
-        data structures can't be modified in between the two calls.  If the
-        time between calls to get_state is necessary to calculate metrics,
-        reset_state should store now() each time it's called, and get_state
-        will use the time since that now() to do its calculations'''
-        self.num_hits = 0
-        self.last_reset_time = time.time()
-        self.client_ip_list = list()
-    # example for keeping track of runtimes
-    # takes no arguments
-    # returns float number of seconds for this run
-    def set_check_duration(self, dur):
-        '''This function only used if logtailer is in cron mode.  If it is
-        invoked, get_check_duration should use this value instead of calculating
-        it.'''
-        self.duration = dur 
-        self.dur_override = True
-    def get_check_duration(self):
-        '''This function should return the time since the last check.  If called
-        from cron mode, this must be set using set_check_duration().  If in
-        daemon mode, it should be calculated internally.'''
-        if( self.dur_override ):
-            duration = self.duration
-        else:
-            cur_time = time.time()
-            duration = cur_time - self.last_reset_time
-            # the duration should be within 10% of period
-            acceptable_duration_min = self.period - (self.period / 10.0)
-            acceptable_duration_max = self.period + (self.period / 10.0)
-            if (duration < acceptable_duration_min or duration > acceptable_duration_max):
-                raise LogtailerStateException, "time calculation problem - duration (%s) > 10%% away from period (%s)" % (duration, self.period)
-        return duration
-    # example function for get_state
-    # takes no arguments
-    # returns a dictionary of (metric => metric_object) pairs
-    def get_state(self):
-        '''This function should acquire a lock, call deep copy, get the
-        current time if necessary, call reset_state, then do its
-        calculations.  It should return a list of metric objects.'''
-        # get the data to work with
-        self.lock.acquire()
-        try:
-            mydata = self.deep_copy()
-            check_time = self.get_check_duration()
-            self.reset_state()
-            self.lock.release()
-        except LogtailerStateException, e:
-            # if something went wrong with deep_copy or the duration, reset and continue
-            self.reset_state()
-            self.lock.release()
-            raise e
-
+    # takes the state buffer to update and a list of (text) lines to be parsed
+    # returns a list of parsing exceptions
+    def accumulate_lines(self, state, lines):
+        '''This function digests a whole batch of lines, counting up the
+        queries from each client before they go into the sketches, so a
+        busy client costs one update per batch rather than one per line.'''
+        search = self.reg.search
+        client_ips = []
+        for line in lines:
+            regMatch = search(line, line.find('named'))
+            if regMatch:
+                client_ips.append(regMatch.group('client_ip'))
+        state['num_hits'] += len(client_ips)
+        state['clients'].update(client_ips)
+        queries = {}
+        get = queries.get
+        for client_ip in client_ips:
+            queries[client_ip] = get(client_ip, 0) + 1
+        client_counts = state['client_counts']
+        # busiest first, so the quiet clients only push each other out
+        for (client_ip, count) in sorted(queries.iteritems(), key=lambda item: item[1], reverse=True):
+            if client_counts.hit(client_ip, count) is None:
+                client_counts.admit(client_ip, {}, count)
+        return []
+    # takes a retired state buffer and the duration it covers
+    # returns a list of metric objects
+    def crunch(self, mydata, check_time):
+        '''This function does the calculations on a state buffer that is no
+        longer being written to.  It should return a list of metric
+        objects.'''
         # crunch data to how you want to report it
         queries_per_second = mydata['num_hits'] / check_time
 
-        # calculate number of querying IPs and maximum number of queries per IP
-        clist = mydata['client_ip_list']
-
-        cdict = dict()
-        for elem in clist:
-            cdict[elem] = cdict.get(elem,0) + 1
-
         # number of unique clients connecting, normalized to per minute
-        num_client_ips = len(cdict) / check_time
+        num_client_ips = mydata['clients'].count() / check_time
         # number of requests issued by the client making the most
-        max_client_ip_count = max(cdict.values()) / check_time
+        top = mydata['client_counts'].top(1)
+        if top:
+            max_client_ip_count = top[0][1] / check_time
+        else:
+            max_client_ip_count = 0
 
 
         # package up the data you want to submit
@@ -147,6 +115,3 @@ class BindLogtailer(object):
 
         # return a list of metric objects
         return [ qps_metric, clients_metric, max_reqs_metric, ]
-
-
-
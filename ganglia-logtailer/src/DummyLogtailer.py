@@ -13,9 +13,27 @@
 ###     an instance method set_check_duration that sets the time since last invocation (used in cron mode)
 ###     an instance method get_state() that returns a list of metric objects
 ###     an instance method parse_line(line) that takes one line of the log file and does whatever internal accounting is necessary to record its metrics
+###   and may define
+###     an instance method parse_lines(lines) that takes a list of lines, skips any that would make parse_line raise a LogtailerParsingException
+###       and returns the list of those exceptions.  ganglia-logtailer uses it instead of parse_line when catching up on a log.
 ###   The logtailer class must be thread safe - a separate thread will be calling get_state() and parse_line(line)
 ###   parse_line(line) may raise a LogtailerParsingException to log an error and discard the current line but keep going.  Any other exception will kill the process.
 ###
+###   Instead of doing the locking and copying shown below, a plugin may subclass BufferedLogtailer from
+###   ganglia_logtailer_helper and only define new_state(), accumulate(state, line) and crunch(state, check_time).
+###   The parser thread then never takes a lock; see ApacheLogtailer.py for an example.
+###   A BufferedLogtailer's state buffers can be added together with merge_state(into, other), so it can have
+###   a large cron-mode backlog split between several processes (--workers), each with its own instance of the class.
+###   The default merge_state adds up counters and summaries (see merge_states); override it if the state holds anything
+###   else, or set mergeable = False if it can't be merged.
+###   A plugin that takes options (--plugin_option KEY=VALUE, or extra settings in its --config section) defines
+###     an instance method configure(options) that takes a dict of them and raises ValueError for any it doesn't know.
+###   The HTTP plugins take a log_format option, an Apache LogFormat string that LogFormat in ganglia_logtailer_helper
+###   turns into a FieldExtractor for just the fields the plugin needs.
+###   A BufferedLogtailer with an event_time(line) method, returning the unix time the line was logged,
+###   can count lines by when they were logged rather than when they were read (--event_time, in daemon mode).
+###   LogFormat plugins get one by calling event_time_from(log_format) in configure.
+###
 
 import time
 import threading
@@ -26,7 +44,7 @@ from ganglia_logtailer_helper import LogtailerParsingException, LogtailerStateEx
 
 class DummyLogtailer(object):
     # period must be defined and indicates how often the gmetric thread should call get_state() (in seconds) (in daemon mode only)
-    # note that if period is shorter than it takes to run get_state() (if there's lots of complex calculation), the calling thread will automatically double period.
+    # note that if period is shorter than it takes to run get_state() (if there's lots of complex calculation), the calling thread will skip the periods it misses (and report them as overruns).
     # period ought to be >=5.  It should probably be >=60 (to avoid excessive load).  120 to 300 is a good range (2-5 minutes).  Take into account the need for time resolution, as well as the number of hosts reporting (6000 hosts * 15s == lots of data).
     period = 5
     def __init__(self):
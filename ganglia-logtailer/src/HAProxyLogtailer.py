@@ -1,19 +1,25 @@
-import time
-import threading
 import re
-import copy
 
 # local dependencies
 from ganglia_logtailer_helper import GangliaMetricObject
 from ganglia_logtailer_helper import LogtailerParsingException, LogtailerStateException
+from ganglia_logtailer_helper import QuantileSketch, BufferedLogtailer, HeavyHitterTable
+from ganglia_logtailer_helper import parse_percentiles
 
-class HAProxyLogtailer(object):
+class HAProxyLogtailer(BufferedLogtailer):
     # only used in daemon mode
     period = 30
+    # per-listener latency percentiles to report (100 reports the maximum)
+    percentiles = (50, 90, 100)
+    # how many listeners to keep separate stats for; past that the quietest
+    # ones are reported together as 'other'
+    max_listeners = 100
+    # response codes are counted in these groups
+    response_codes = ['2xx', '3xx', '4xx', '5xx', 'other']
     def __init__(self):
         '''This function should initialize any data structures or variables
         needed for the internal state of the line parser.'''
-        self.lock = threading.RLock()
+        BufferedLogtailer.__init__(self)
 
         # example:
         # Jan 24 20:17:25 localhost haproxy[6844]: 127.0.0.1:39747 [24/Jan/2014:20:17:25.210] apps apps/app711 0/0/0/156/156 200 602 - - ---- 169/166/166/0/0 0/0 "POST /1/comm HTTP/1.0"
@@ -34,43 +40,65 @@ class HAProxyLogtailer(object):
         self.reg = re.compile(logformat)
 
         self.metricshash = {}
-        self.global_actconn = [] #this is a list of active connections, from which we calculate min/max/avg at the end
-        self.global_hits = 0
-        self.listeners = {}
-        self.response_codes = ['2xx', '3xx', '4xx', '5xx', 'other']
-        # example substructure
-        # listeners["parse.com"] = {}
-        # # hit count is the length of any of these three arrays; they should all be the same
-        # listeners["parse.com"]["latency"] = []
-        # listeners["parse.com"]["feconn"] = []
-        # listeners["parse.com"]["beconn"] = []
-        # listeners["parse.com"]["responses"] = {'2xx':[], '3xx':[], '4xx':[], '5xx':[]}
+        # listeners is a HeavyHitterTable of these (see new_listener), eg.
+        # listeners.hit("parse.com")["latency"]
 
         #print logformat
-        # assume we're in daemon mode unless set_check_duration gets called
-        self.dur_override = False
-        self.reset_state()
 
-    # example function for parse line
-    # takes one argument (text) line to be parsed
+    # takes a dict of plugin options
     # returns nothing
-    def parse_line(self, line):
-        '''This function should digest the contents of one line at a time,
-        updating the internal state variables.'''
-        self.lock.acquire()
+    def configure(self, options):
+        '''This function takes the options given to the plugin with
+        --plugin_option or in its section of the --config file.  The only
+        one is percentiles, a comma separated list of the latency
+        percentiles to report (eg. 50,90,99,100).'''
+        unknown = [key for key in options if key != 'percentiles']
+        if unknown:
+            raise ValueError("unknown plugin options: %s" % ', '.join(unknown))
+        if 'percentiles' in options:
+            self.percentiles = parse_percentiles(options['percentiles'])
+
+    # takes no arguments
+    # returns an empty state buffer
+    def new_state(self):
+        '''This function returns the data structure used to maintain state,
+        zeroed out.  A fresh one is swapped in each time get_state is
+        called.'''
+        return dict( global_actconn=QuantileSketch(), # active connections, from which we calculate min/max/avg at the end
+                     global_hits=0,
+                     listeners=HeavyHitterTable(self.max_listeners, self.new_listener()),
+                     )
 
+    # takes no arguments
+    # returns empty stats for one listener
+    def new_listener(self):
+        '''This function returns the stats kept for each listener, zeroed
+        out.  The hit count is the count of any of the three sketches; they
+        should all be the same.'''
+        responses = {}
+        for code in self.response_codes:
+            responses[code] = 0
+        return dict( latency=QuantileSketch(),
+                     feconn=QuantileSketch(),
+                     beconn=QuantileSketch(),
+                     responses=responses,
+                     )
+
+    def accumulate(self, state, line):
+        '''This function should digest the contents of one line at a time,
+        updating the state buffer.'''
         reg = self.reg
         try:
             regMatch = reg.match(line)
         except Exception, e:
-            self.lock.release()
             # this happens a lot in this file, just return and go on to the next line.
             return
 
         if regMatch:
             lineBits = regMatch.groupdict()
-            self.global_hits += 1
-            self.global_actconn.append(int(lineBits['actconn']))
+            state['global_hits'] += 1
+            state['global_actconn'].add(int(lineBits['actconn']))
+            listeners = state['listeners']
 
             if lineBits['response_code'].startswith('2'):
                 response_code = "2xx"
@@ -83,102 +111,29 @@ class HAProxyLogtailer(object):
             else:
                 response_code = "other"
 
-            try:
-                self.listeners[lineBits['frontend']]['latency'].append(int(lineBits['tt']))
-            except KeyError:
-                # first time seeing this listener; create the data structure
-                self.listeners[lineBits['frontend']] = {}
-                self.listeners[lineBits['frontend']]["name"] = lineBits['frontend']
-                self.listeners[lineBits['frontend']]["latency"] = []
-                self.listeners[lineBits['frontend']]["feconn"] = []
-                self.listeners[lineBits['frontend']]["beconn"] = []
-                self.listeners[lineBits['frontend']]["responses"] = {}
-                for code in self.response_codes:
-                    self.listeners[lineBits['frontend']]["responses"][code] = 0
-                # ok, now re-add the entry
-                self.listeners[lineBits['frontend']]['latency'].append(int(lineBits['tt']))
-            self.listeners[lineBits['frontend']]["feconn"].append(int(lineBits['feconn']))
-            self.listeners[lineBits['frontend']]["beconn"].append(int(lineBits['beconn']))
-            self.listeners[lineBits['frontend']]["responses"][response_code] += 1
-
-        else:
-            self.lock.release()
-            return
-
-        self.lock.release()
-
-
-    # example function for reset_state
-    # takes no arguments
-    # returns nothing
-    def reset_state(self):
-        '''This function resets the internal data structure to 0 (saving
-        whatever state it needs).  This function should be called
-        immediately after deep copy with a lock in place so the internal
-        data structures can't be modified in between the two calls.  If the
-        time between calls to get_state is necessary to calculate metrics,
-        reset_state should store now() each time it's called, and get_state
-        will use the time since that now() to do its calculations'''
-
-        self.last_reset_time = time.time()
-        self.metricshash = {}
-        self.global_actconn = []
-        self.global_hits = 0
-        self.listeners = {}
-
-
-    # example for keeping track of runtimes
-    # takes no arguments
-    # returns float number of seconds for this run
-    def set_check_duration(self, dur):
-        '''This function only used if logtailer is in cron mode.  If it is
-        invoked, get_check_duration should use this value instead of calculating
-        it.'''
-        self.duration = dur
-        self.dur_override = True
-
-
-    def get_check_duration(self):
-        '''This function should return the time since the last check.  If called
-        from cron mode, this must be set using set_check_duration().  If in
-        daemon mode, it should be calculated internally.'''
-        if (self.dur_override):
-            duration = self.duration
-        else:
-            cur_time = time.time()
-            duration = cur_time - self.last_reset_time
-            # the duration should be within 10% of period
-            acceptable_duration_min = self.period - (self.period / 10.0)
-            acceptable_duration_max = self.period + (self.period / 10.0)
-            if (duration < acceptable_duration_min or duration > acceptable_duration_max):
-                raise LogtailerStateException, "time calculation problem - duration (%s) > 10%% away from period (%s)" % (duration, self.period)
-        return duration
+            listener = listeners.hit(lineBits['frontend'])
+            if listener is None:
+                # not tracking this listener (yet); create the data structure
+                listener = listeners.admit(lineBits['frontend'], self.new_listener())
+            listener["latency"].add(int(lineBits['tt']))
+            listener["feconn"].add(int(lineBits['feconn']))
+            listener["beconn"].add(int(lineBits['beconn']))
+            listener["responses"][response_code] += 1
 
 
     def add_metric(self, name, val):
         self.metricshash[name] = val
 
-    # example function for get_state
-    # takes no arguments
-    # returns a dictionary of (metric => metric_object) pairs
-    def get_state(self):
-        '''This function should acquire a lock, call deep copy, get the
-        current time if necessary, call reset_state, then do its
-        calculations.  It should return a list of metric objects.'''
-        # get the data to work with
-        self.lock.acquire()
-        try:
-            global_actconn = copy.deepcopy(self.global_actconn)
-            global_hits = self.global_hits
-            listeners = copy.deepcopy(self.listeners)
-            check_time = self.get_check_duration()
-            self.reset_state()
-            self.lock.release()
-        except LogtailerStateException, e:
-            # if something went wrong with deep_copy or the duration, reset and continue
-            self.reset_state()
-            self.lock.release()
-            raise e
+    # takes a retired state buffer and the duration it covers
+    # returns a list of metric objects
+    def crunch(self, mydata, check_time):
+        '''This function does the calculations on a state buffer that is no
+        longer being written to.  It should return a list of metric
+        objects.'''
+        global_actconn = mydata['global_actconn']
+        global_hits = mydata['global_hits']
+        listeners = mydata['listeners']
+        self.metricshash = {}
 
         results  = []       # A list for all the Ganglia Log objects
 
@@ -193,37 +148,36 @@ class HAProxyLogtailer(object):
         else:
             # calculate min/max/avg for global active connections
             self.add_metric('haproxy_total_hits', float(global_hits) / check_time)
-            global_actconn.sort()
-            global_actconn_min = global_actconn[0]
-            global_actconn_max = global_actconn[-1]
-            global_actconn_avg = float(sum(global_actconn)) / global_hits
+            global_actconn_min = global_actconn.min
+            global_actconn_max = global_actconn.max
+            global_actconn_avg = global_actconn.avg()
 
             self.add_metric('haproxy_active_connections_min', global_actconn_min)
             self.add_metric('haproxy_active_connections_max', global_actconn_max)
             self.add_metric('haproxy_active_connections_avg', global_actconn_avg)
 
-            for name, listener in listeners.iteritems():
-                self.add_metric('haproxy_%s_hits' % name, float(len(listener["latency"])) / check_time)
+            # every listener being tracked, and the rest as 'other'
+            (tracked, other) = listeners.hot_and_other(0)
+            if other["latency"].count:
+                tracked.append(('other', other))
+            for name, listener in tracked:
+                self.add_metric('haproxy_%s_hits' % name, float(listener["latency"].count) / check_time)
                 # percentage of total hits from this listener 
-                self.add_metric('haproxy_%s_hits_p' % name, float(len(listener["latency"])) / global_hits * 100)
+                self.add_metric('haproxy_%s_hits_p' % name, float(listener["latency"].count) / global_hits * 100)
                 latency = listener["latency"]
-                latency.sort()
                 # latency is recorded in millisec; convert it to seconds
-                self.add_metric('haproxy_%s_latency_%s' % (name, 'min'), float(latency[0])/1000)
-                self.add_metric('haproxy_%s_latency_%s' % (name, 'max'), float(latency[-1])/1000)
-                self.add_metric('haproxy_%s_latency_%s' % (name, 'avg'), float(sum(latency)) / len(latency)/1000)
-                self.add_metric('haproxy_%s_latency_%s' % (name, '50th'), float(latency[int(len(latency) * 0.5)])/1000)
-                self.add_metric('haproxy_%s_latency_%s' % (name, '90th'), float(latency[int(len(latency) * 0.9)])/1000)
+                self.add_metric('haproxy_%s_latency_%s' % (name, 'min'), float(latency.min)/1000)
+                self.add_metric('haproxy_%s_latency_%s' % (name, 'avg'), latency.avg()/1000)
+                for (label, value) in latency.percentiles(self.percentiles):
+                    self.add_metric('haproxy_%s_latency_%s' % (name, label), float(value)/1000)
                 feconn = listener["feconn"]
-                feconn.sort()
-                self.add_metric('haproxy_%s_feconn_%s' % (name, 'min'), feconn[0])
-                self.add_metric('haproxy_%s_feconn_%s' % (name, 'max'), feconn[-1])
-                self.add_metric('haproxy_%s_feconn_%s' % (name, 'avg'), float(sum(feconn)) / len(feconn))
+                self.add_metric('haproxy_%s_feconn_%s' % (name, 'min'), feconn.min)
+                self.add_metric('haproxy_%s_feconn_%s' % (name, 'max'), feconn.max)
+                self.add_metric('haproxy_%s_feconn_%s' % (name, 'avg'), feconn.avg())
                 beconn = listener["beconn"]
-                beconn.sort()
-                self.add_metric('haproxy_%s_beconn_%s' % (name, 'min'), beconn[0])
-                self.add_metric('haproxy_%s_beconn_%s' % (name, 'max'), beconn[-1])
-                self.add_metric('haproxy_%s_beconn_%s' % (name, 'avg'), float(sum(beconn)) / len(beconn))
+                self.add_metric('haproxy_%s_beconn_%s' % (name, 'min'), beconn.min)
+                self.add_metric('haproxy_%s_beconn_%s' % (name, 'max'), beconn.max)
+                self.add_metric('haproxy_%s_beconn_%s' % (name, 'avg'), beconn.avg())
                 for code in self.response_codes:
                     self.add_metric('haproxy_%s_%s_hits' % (name, code), float(listener["responses"][code]) / check_time)
 
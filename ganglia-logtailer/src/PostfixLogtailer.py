@@ -6,22 +6,22 @@
 ###    * number of bounces per second
 ###
 
-import time
-import threading
 import re
 
 # local dependencies
 from ganglia_logtailer_helper import GangliaMetricObject
 from ganglia_logtailer_helper import LogtailerParsingException, LogtailerStateException
+from ganglia_logtailer_helper import BufferedLogtailer
 
-class PostfixLogtailer(object):
+class PostfixLogtailer(BufferedLogtailer):
     # only used in daemon mode
     period = 30.0
+    # only postfix lines are of interest; the rest of the syslog is skipped unparsed
+    line_guards = ('postfix/',)
     def __init__(self):
         '''This function should initialize any data structures or variables
         needed for the internal state of the line parser.'''
-        self.reset_state()
-        self.lock = threading.RLock()
+        BufferedLogtailer.__init__(self)
         # this is what will match the postfix lines
         # postfix example log format string:
         # connections:
@@ -30,109 +30,42 @@ class PostfixLogtailer(object):
         # Sep 12 13:39:11 host postfix/local[11393]: E412470C2B8: to=<foo@host>, orig_to=<foo@bar.com>, relay=local, delay=5, delays=1.9/0/0/3.2, dsn=2.0.0, status=sent (delivered to command: /usr/local/bin/procmail)
         # bounces:
         # Sep 12 11:58:52 host postfix/local[18444]: 8D3C671C324: to=<invalid@host>, orig_to=<invalid@bar.com>, relay=local, delay=0.43, delays=0.41/0/0/0.02, dsn=5.1.1, status=bounced (unknown user: "invalid")
-        self.reg_connections = re.compile('^.*postfix/smtpd.*connect from unknown.*$')
-        self.reg_deliveries = re.compile('^.*postfix/local.* status=sent .*$')
-        self.reg_bounces = re.compile('^.*postfix/local.* status=bounced .*$')
+        # these start with a literal and are searched for, rather than matched
+        # behind a leading .* that backtracks over the whole line
+        self.reg_connections = re.compile('postfix/smtpd.*connect from unknown')
+        self.reg_deliveries = re.compile('postfix/local.* status=sent ')
+        self.reg_bounces = re.compile('postfix/local.* status=bounced ')
 
-        # assume we're in daemon mode unless set_check_duration gets called
-        self.dur_override = False
 
-
-    # example function for parse line
-    # takes one argument (text) line to be parsed
-    # returns nothing
-    def parse_line(self, line):
+    # takes no arguments
+    # returns an empty state buffer
+    def new_state(self):
+        '''This function returns the data structure used to maintain state,
+        zeroed out.  A fresh one is swapped in each time get_state is
+        called.'''
+        return dict( num_conns = 0,
+                     num_deliv = 0,
+                     num_bounc = 0
+                     )
+    def accumulate(self, state, line):
         '''This function should digest the contents of one line at a time,
-        updating the internal state variables.'''
-        self.lock.acquire()
+        updating the state buffer.'''
         try:
-            regMatch = self.reg_connections.match(line)
-            if regMatch:
-                self.num_connections+=1
-            regMatch = self.reg_deliveries.match(line)
-            if regMatch:
-                self.num_deliveries+=1
-            regMatch = self.reg_bounces.match(line)
-            if regMatch:
-                self.num_bounces+=1
-            
+            if 'postfix/smtpd' in line and self.reg_connections.search(line):
+                state['num_conns']+=1
+            if 'postfix/local' in line:
+                if self.reg_deliveries.search(line):
+                    state['num_deliv']+=1
+                if self.reg_bounces.search(line):
+                    state['num_bounc']+=1
         except Exception, e:
-            self.lock.release()
             raise LogtailerParsingException, "regmatch or contents failed with %s" % e
-        self.lock.release()
-    # example function for deep copy
-    # takes no arguments
-    # returns one object
-    def deep_copy(self):
-        '''This function should return a copy of the data structure used to
-        maintain state.  This copy should different from the object that is
-        currently being modified so that the other thread can deal with it
-        without fear of it changing out from under it.  The format of this
-        object is internal to the plugin.'''
-        myret = dict( num_conns = self.num_connections,
-                    num_deliv = self.num_deliveries,
-                    num_bounc = self.num_bounces
-                    )
-        return myret
-    # example function for reset_state
-    # takes no arguments
-    # returns nothing
-    def reset_state(self):
-        '''This function resets the internal data structure to 0 (saving
-        whatever state it needs).  This function should be called
-        immediately after deep copy with a lock in place so the internal
-        data structures can't be modified in between the two calls.  If the
-        time between calls to get_state is necessary to calculate metrics,
-        reset_state should store now() each time it's called, and get_state
-        will use the time since that now() to do its calculations'''
-        self.num_connections = 0
-        self.num_deliveries = 0
-        self.num_bounces = 0
-        self.last_reset_time = time.time()
-    # example for keeping track of runtimes
-    # takes no arguments
-    # returns float number of seconds for this run
-    def set_check_duration(self, dur):
-        '''This function only used if logtailer is in cron mode.  If it is
-        invoked, get_check_duration should use this value instead of calculating
-        it.'''
-        self.duration = dur 
-        self.dur_override = True
-    def get_check_duration(self):
-        '''This function should return the time since the last check.  If called
-        from cron mode, this must be set using set_check_duration().  If in
-        daemon mode, it should be calculated internally.'''
-        if( self.dur_override ):
-            duration = self.duration
-        else:
-            cur_time = time.time()
-            duration = cur_time - self.last_reset_time
-            # the duration should be within 10% of period
-            acceptable_duration_min = self.period - (self.period / 10.0)
-            acceptable_duration_max = self.period + (self.period / 10.0)
-            if (duration < acceptable_duration_min or duration > acceptable_duration_max):
-                raise LogtailerStateException, "time calculation problem - duration (%s) > 10%% away from period (%s)" % (duration, self.period)
-        return duration
-    # example function for get_state
-    # takes no arguments
-    # returns a dictionary of (metric => metric_object) pairs
-    def get_state(self):
-        '''This function should acquire a lock, call deep copy, get the
-        current time if necessary, call reset_state, then do its
-        calculations.  It should return a list of metric objects.'''
-        # get the data to work with
-        self.lock.acquire()
-        try:
-            mydata = self.deep_copy()
-            check_time = self.get_check_duration()
-            self.reset_state()
-            self.lock.release()
-        except LogtailerStateException, e:
-            # if something went wrong with deep_copy or the duration, reset and continue
-            self.reset_state()
-            self.lock.release()
-            raise e
-
+    # takes a retired state buffer and the duration it covers
+    # returns a list of metric objects
+    def crunch(self, mydata, check_time):
+        '''This function does the calculations on a state buffer that is no
+        longer being written to.  It should return a list of metric
+        objects.'''
         # crunch data to how you want to report it
         connections_per_second = mydata['num_conns'] / check_time
         deliveries_per_second = mydata['num_deliv'] / check_time
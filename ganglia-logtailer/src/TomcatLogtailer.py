@@ -4,129 +4,80 @@
 ###    * hits per second
 ###    * GETs per second
 ###    * average query processing time
-###    * ninetieth percentile query processing time
+###    * query processing time percentiles (90th by default, see percentiles)
 ###    * number of HTTP 200, 300, 400, and 500 responses per second
 ###
 ###  Note that this plugin depends on a certain apache log format, documented in
-##   __init__.
-
-import time
-import threading
-import re
+###  log_format.  Set the log_format plugin option if your log is different.
 
 # local dependencies
 from ganglia_logtailer_helper import GangliaMetricObject
 from ganglia_logtailer_helper import LogtailerParsingException, LogtailerStateException
+from ganglia_logtailer_helper import QuantileSketch, BufferedLogtailer
+from ganglia_logtailer_helper import LogFormat, parse_percentiles
 
-class TomcatLogtailer(object):
+class TomcatLogtailer(BufferedLogtailer):
     # only used in daemon mode
     period = 60
+    # query time percentiles to report (100 reports the maximum)
+    percentiles = (90,)
+    # the AccessLogValve pattern of the log, unless the log_format option says otherwise
+    #  10.0.1.31 - - [08/Jul/2013:12:44:19 -0400] "OPTIONS /status HTTP/1.0" 200 - 0
+    # It needs %D
+    log_format = '%h %l %u %t "%r" %s %b %D'
     def __init__(self):
         '''This function should initialize any data structures or variables
         needed for the internal state of the line parser.'''
-        self.reset_state()
-        self.lock = threading.RLock()
-        # This is what will match the tomcat lines
-        # Tomcat access log valve pattern string:
-        #  %h %l %u %t &quot;%r&quot; %s %b %D
-        # Sample Line:
-        #  10.0.1.31 - - [08/Jul/2013:12:44:19 -0400] "OPTIONS /status HTTP/1.0" 200 - 0
-        self.reg = re.compile("(?P<host>[0-9]+(?:\.[0-9]+){3}) (?P<ident>[^\s]+) (?P<user>[^\s]+) (?P<date>\[([^\]]+)\]) (?P<req>\"([A-Z]+)[^\"]*\") (?P<status>\d+) (?P<bytes>[^\s]+) (?P<qtime>\d+)")
-        # assume we're in daemon mode unless set_check_duration gets called
-        self.dur_override = False
+        BufferedLogtailer.__init__(self)
+        self.configure({})
 
 
-    # example function for parse line
-    # takes one argument (text) line to be parsed
+    # takes a dict of plugin options
     # returns nothing
-    def parse_line(self, line):
-        '''This function should digest the contents of one line at a time,
-        updating the internal state variables.'''
-        self.lock.acquire()
-        self.num_hits+=1
-        regMatch = self.reg.match(line)
-        if regMatch:
-            linebits = regMatch.groupdict()
-            self.num_hits += 1
-            # capture request duration
-            dur = int(linebits['qtime'])
-            self.req_time += dur
-            # store for 90th % calculation
-            self.ninetieth.append(dur)
-        self.lock.release()
-    # example function for deep copy
+    def configure(self, options):
+        '''This function takes the options given to the plugin with
+        --plugin_option or in its section of the --config file: log_format,
+        the LogFormat the log is written in, and percentiles, a comma
+        separated list of the percentiles to report (eg. 50,90,99,100).'''
+        unknown = [key for key in options if key not in ('log_format', 'percentiles')]
+        if unknown:
+            raise ValueError("unknown plugin options: %s" % ', '.join(unknown))
+        if 'percentiles' in options:
+            self.percentiles = parse_percentiles(options['percentiles'])
+        # this is what will pull the interesting fields out of the tomcat lines
+        log_format = LogFormat(options.get('log_format', self.log_format))
+        self.fields = log_format.extractor(('req_time',))
+        # so use_event_time can count lines by their %t
+        self.event_time_from(log_format)
     # takes no arguments
-    # returns one object
-    def deep_copy(self):
-        '''This function should return a copy of the data structure used to
-        maintain state.  This copy should different from the object that is
-        currently being modified so that the other thread can deal with it
-        without fear of it changing out from under it.  The format of this
-        object is internal to the plugin.'''
-        myret = dict( num_hits=self.num_hits,
-                    req_time=self.req_time,
-                    ninetieth=self.ninetieth
+    # returns an empty state buffer
+    def new_state(self):
+        '''This function returns the data structure used to maintain state,
+        zeroed out.  A fresh one is swapped in each time get_state is
+        called.'''
+        return dict( num_hits=0,
+                    req_time=0,
+                    qtime_sketch=QuantileSketch()
                     )
-        return myret
-    # example function for reset_state
-    # takes no arguments
-    # returns nothing
-    def reset_state(self):
-        '''This function resets the internal data structure to 0 (saving
-        whatever state it needs).  This function should be called
-        immediately after deep copy with a lock in place so the internal
-        data structures can't be modified in between the two calls.  If the
-        time between calls to get_state is necessary to calculate metrics,
-        reset_state should store now() each time it's called, and get_state
-        will use the time since that now() to do its calculations'''
-        self.num_hits = 0
-        self.req_time = 0
-        self.ninetieth = list()
-        self.last_reset_time = time.time()
-    # example for keeping track of runtimes
-    # takes no arguments
-    # returns float number of seconds for this run
-    def set_check_duration(self, dur):
-        '''This function only used if logtailer is in cron mode.  If it is
-        invoked, get_check_duration should use this value instead of calculating
-        it.'''
-        self.duration = dur 
-        self.dur_override = True
-    def get_check_duration(self):
-        '''This function should return the time since the last check.  If called
-        from cron mode, this must be set using set_check_duration().  If in
-        daemon mode, it should be calculated internally.'''
-        if( self.dur_override ):
-            duration = self.duration
-        else:
-            cur_time = time.time()
-            duration = cur_time - self.last_reset_time
-            # the duration should be within 10% of period
-            acceptable_duration_min = self.period - (self.period / 10.0)
-            acceptable_duration_max = self.period + (self.period / 10.0)
-            if (duration < acceptable_duration_min or duration > acceptable_duration_max):
-                raise LogtailerStateException, "time calculation problem - duration (%s) > 10%% away from period (%s)" % (duration, self.period)
-        return duration
-    # example function for get_state
-    # takes no arguments
-    # returns a dictionary of (metric => metric_object) pairs
-    def get_state(self):
-        '''This function should acquire a lock, call deep copy, get the
-        current time if necessary, call reset_state, then do its
-        calculations.  It should return a list of metric objects.'''
-        # get the data to work with
-        self.lock.acquire()
+    def accumulate(self, state, line):
+        '''This function should digest the contents of one line at a time,
+        updating the state buffer.  Lines that don't fit are counted but
+        otherwise ignored.'''
+        state['num_hits']+=1
         try:
-            mydata = self.deep_copy()
-            check_time = self.get_check_duration()
-            self.reset_state()
-            self.lock.release()
-        except LogtailerStateException, e:
-            # if something went wrong with deep_copy or the duration, reset and continue
-            self.reset_state()
-            self.lock.release()
-            raise e
-
+            # capture request duration
+            dur = int(self.fields.extract(line)[0])
+        except ValueError:
+            return
+        state['req_time'] += dur
+        # store for percentile calculation
+        state['qtime_sketch'].add(dur)
+    # takes a retired state buffer and the duration it covers
+    # returns a list of metric objects
+    def crunch(self, mydata, check_time):
+        '''This function does the calculations on a state buffer that is no
+        longer being written to.  It should return a list of metric
+        objects.'''
         # crunch data to how you want to report it
         hits_per_second = mydata['num_hits'] / check_time
         if (mydata['num_hits'] != 0):
@@ -134,24 +85,20 @@ class TomcatLogtailer(object):
         else:
              avg_req_time = 0
 
-        # calculate 90th % request time
-        ninetieth_list = mydata['ninetieth']
-        ninetieth_list.sort()
-        num_entries = len(ninetieth_list)
-        if (num_entries != 0 ):
-            slowest = ninetieth_list[-1]
-            ninetieth_element = ninetieth_list[int(num_entries * 0.9)]
+        # slowest request time (exact)
+        qtime_sketch = mydata['qtime_sketch']
+        if (qtime_sketch.count != 0 ):
+            slowest = qtime_sketch.max
         else:
             slowest = 0
-            ninetieth_element = 0
 
         # package up the data you want to submit
         hps_metric = GangliaMetricObject('solr_rps', hits_per_second, units='rps')
         avgdur_metric = GangliaMetricObject('solr_avg_dur', avg_req_time, units='ms')
-        ninetieth_metric = GangliaMetricObject('solr_90th_dur', ninetieth_element, units='ms')
         slowest_metric   = GangliaMetricObject('solr_slowest_dur', slowest, units='ms')
+        # query time percentiles, eg. solr_90th_dur
+        percentile_metrics = []
+        for (label, value) in qtime_sketch.percentiles(self.percentiles):
+            percentile_metrics.append(GangliaMetricObject('solr_%s_dur' % label, value, units='ms'))
         # return a list of metric objects
-        return [ hps_metric, avgdur_metric, ninetieth_metric, slowest_metric ]
-
-
-
+        return [ hps_metric, avgdur_metric, ] + percentile_metrics + [ slowest_metric ]
@@ -16,7 +16,7 @@ from ganglia_logtailer_helper import LogtailerParsingException, LogtailerStateEx
 
 class UnboundLogtailer(object):
     # period must be defined and indicates how often the gmetric thread should call get_state() (in seconds) (in daemon mode only)
-    # note that if period is shorter than it takes to run get_state() (if there's lots of complex calculation), the calling thread will automatically double period.
+    # note that if period is shorter than it takes to run get_state() (if there's lots of complex calculation), the calling thread will skip the periods it misses (and report them as overruns).
     # period must be >15.  It should probably be >=60 (to avoid excessive load).  120 to 300 is a good range (2-5 minutes).  Take into account the need for time resolution, as well as the number of hosts reporting (6000 hosts * 15s == lots of data).
     period = 5
     def __init__(self):
@@ -11,198 +11,256 @@
 ###  Author: Vladimir Vuksan http://twitter.com/vvuksan
 ###
 ###  Note that this plugin depends on varnishncsa producing the standard NCSA HTTP format
+###  (or the format given with the log_format plugin option).
 ###  It also depends on the Python Memcached client. You can download it from
 ###  http://www.tummy.com/Community/software/python-memcached/
-##   __init__.
+###
+###  The requests per IP are counted up in memory and written to memcache in
+###  batches by a background thread, every flush_interval seconds or as soon as
+###  flush_size different (hour, IP) pairs are waiting, and whenever the metrics
+###  are reported.  The memcache server can be set with the memcache_servers
+###  plugin option (comma separated host:port).
 
 import time
-import threading
-import re
-import memcache
+import atexit
 import socket
+import logging
+import threading
 
 # local dependencies
 from ganglia_logtailer_helper import GangliaMetricObject
 from ganglia_logtailer_helper import LogtailerParsingException, LogtailerStateException
+from ganglia_logtailer_helper import BufferedLogtailer, DoubleBufferedState, LogFormat, TimestampParser
 
-class VarnishMemcacheLogtailer(object):
+logger = logging.getLogger('ganglia_logtailer')
+
+class VarnishMemcacheLogtailer(BufferedLogtailer):
     # only used in daemon mode
     period = 30
-    def __init__(self):
+    # each instance writes its per IP counts to memcache itself, which a
+    # --workers process can't be relied on to do before it exits
+    mergeable = False
+    # the LogFormat of the log, unless the log_format option says otherwise;
+    # this is varnishncsa's default.  It needs %h, %t, %r and %s (or %>s)
+    log_format = '%h %l %u %t "%r" %s %b "%{Referer}i" "%{User-agent}i"'
+    # IMPORTANT IMPORTANT IMPORTANT IMPORTANT IMPORTANT IMPORTANT
+    # Set the memcache server to your memcache server (or use the
+    # memcache_servers plugin option)
+    memcache_servers = ['localhost:11211']
+    # how long the per IP keys live in memcache
+    mc_ttl = 43200
+    # write the per IP counts to memcache at least this often (in seconds),
+    # or sooner once this many (hour, IP) pairs are waiting
+    flush_interval = 10
+    flush_size = 5000
+    def __init__(self, mc=None):
         '''This function should initialize any data structures or variables
-        needed for the internal state of the line parser.'''
-        self.reset_state()
-        self.lock = threading.RLock()
-        self.reg = re.compile('^(?P<remote_ip>[^ ]+) (?P<http_user>[^ ]+) (?P<http_user2>[^ ]+) \[(?P<req_date>[^ ]+) (?P<timezone>[^ ]+) "(?P<request>[^ ]+) (?P<url>[^ ]+) (?P<http_protocol>[^ ]+) (?P<init_retcode>[^ ]+)')
-        # assume we're in daemon mode unless set_check_duration gets called
-        self.dur_override = False
-
-        # IMPORTANT IMPORTANT IMPORTANT IMPORTANT IMPORTANT IMPORTANT
-        # Set the memcache server to your memcache server
-        self.mc = memcache.Client(['localhost:11211'], debug=0)
+        needed for the internal state of the line parser.  mc is the
+        memcache client to use; anything with python-memcached's add, incr
+        and append will do (eg. a fake one for testing).  By default one is
+        made for memcache_servers.'''
+        BufferedLogtailer.__init__(self)
+        self.mc = mc
+        self.configure({})
 
         hostName = socket.gethostname()
         self.instance = hostName.split('.')[0]
 
-        # I have to do this because python 2.4 doesn't support strptime. It is used
-        # to convert the date ie. 02/Apr/2010 to 20100402. I didn't want to introduce
-        # any dependencies
-        self.months_dict = {
-          'Jan' : '01', 'Feb' : '02', 'Mar' : '03', 'Apr' : '04', 'May' : '05', 'Jun' : '06',
-          'Jul' : '07', 'Aug' : '08', 'Sep' : '09', 'Oct' : '10', 'Nov' : '11', 'Dec' : '12'
-        }
+        # turns the request dates into unix times, and those into hours
+        # (ie. 2010040210) for the memcache keys
+        self.timestamps = TimestampParser('ncsa')
+        self.label_minute = None
+        self.label = None
 
+        # (date_and_hour, ip) -> requests, waiting to be written to memcache.
+        # The parsing thread writes into it without a lock; flush swaps it.
+        self.ip_counts = DoubleBufferedState(dict)
+        # only one flush talks to memcache at a time
+        self.flush_lock = threading.Lock()
+        # set by the parsing thread when flush_size pairs are waiting
+        self.flush_wanted = threading.Event()
+        self.stopping = False
+        self.flusher = threading.Thread(target=self.flush_loop)
+        # the process should die when the main thread dies, but not before
+        # the flusher has written out what it has
+        self.flusher.setDaemon( True )
+        self.flusher.start()
+        atexit.register(self.stop)
 
-    # example function for parse line
-    # takes one argument (text) line to be parsed
+
+    # takes a dict of plugin options
     # returns nothing
-    def parse_line(self, line):
+    def configure(self, options):
+        '''This function takes the options given to the plugin with
+        --plugin_option or in its section of the --config file: log_format,
+        the LogFormat the log is written in, and memcache_servers.'''
+        unknown = [key for key in options if key not in ('log_format', 'memcache_servers')]
+        if unknown:
+            raise ValueError("unknown plugin options: %s" % ', '.join(unknown))
+        # this is what will pull the interesting fields out of the varnishncsa lines
+        log_format = LogFormat(options.get('log_format', self.log_format))
+        self.fields = log_format.extractor(('remote_host', 'date', 'method', log_format.status_field()))
+        if 'memcache_servers' in options:
+            self.memcache_servers = [server.strip() for server in options['memcache_servers'].split(',')]
+            self.mc = None
+        if self.mc is None:
+            import memcache
+            self.mc = memcache.Client(self.memcache_servers, debug=0)
+    # takes no arguments
+    # returns an empty state buffer
+    def new_state(self):
+        '''This function returns the data structure used to maintain state,
+        zeroed out.  A fresh one is swapped in each time get_state is
+        called.'''
+        return dict( num_hits=0,
+                    num_gets=0,
+                    num_two=0,
+                    num_three=0,
+                    num_four=0,
+                    num_five=0,
+                    )
+    def accumulate(self, state, line):
         '''This function should digest the contents of one line at a time,
-        updating the internal state variables.'''
-        self.lock.acquire()
-        self.num_hits+=1
+        updating the state buffer, and counts the request against its IP and
+        hour for the flusher.'''
+        state['num_hits']+=1
         try:
-            regMatch = self.reg.match(line)
-            if regMatch:
-                linebits = regMatch.groupdict()
-                # capture GETs
-                if( 'GET' in linebits['request'] ):
-                    self.num_gets+=1
-                # capture HTTP response code
-                rescode = float(linebits['init_retcode'])
-
-                if( (rescode >= 200) and (rescode < 300) ):
-                    self.num_two+=1
-                elif( (rescode >= 300) and (rescode < 400) ):
-                    self.num_three+=1
-                elif( (rescode >= 400) and (rescode < 500) ):
-                    self.num_four+=1
-                elif( (rescode >= 500) and (rescode < 600) ):
-                    self.num_five+=1
-
-                full_date = linebits['req_date']
-                # This is not my proudest code however due to lack of strptime in Python 2.4
-                # we have to resort to these kinds of craziness
-                date_time_pieces = full_date.split(':')
-                date = date_time_pieces[0]
-                split_date = date.split('/')
-                day = split_date[0]
-                month = split_date[1]
-                year = split_date[2]
-                month = self.months_dict[month]
-                hour = date_time_pieces[1]
-                minute = date_time_pieces[2]
-
-                date_and_hour = year + month + day + hour
-                MC_TTL = 43200
-                
-                ##########################################################################################
-                # Memcache has an ADD command which only succeeds if a key is not present. We'll construct
-                # a key that contains the webserver that client is on and date and hour ie.
-                # ip-web22-2010033022-1.2.3.4
-                mc_key = "ip-" + self.instance + "-" + date_and_hour + "-" + linebits['remote_ip'] 
-                return_code = self.mc.add(mc_key , "1", MC_TTL) 
-
-                # If add fails it means that the key exists and we should increment it
-                if ( return_code == 0 ):
-                   incr_code = self.mc.incr(mc_key)
-                # If the key doesn't exist ie. add succeeded we should append the IP to 
-                # the list of IPs that have seen. We'll then end up with a key called
-                # ipsarray-web22-2010033022 which is a comma delimited list of IPs
-                else:
-                   # Try to add the key. If it's already there use append to append to the end of the list
-                   mc_key = "ipsarray-" + self.instance + "-" + date_and_hour
-                   return_code = self.mc.add(mc_key , linebits['remote_ip'], MC_TTL)                 
-                   if ( return_code == 0 ):
-                      self.mc.append(mc_key, "," + linebits['remote_ip'] , MC_TTL)
-
-            else:
-                raise LogtailerParsingException, "regmatch failed to match"
+            (remote_ip, full_date, method, init_retcode) = self.fields.extract(line)
+            # capture GETs
+            if( 'GET' in method ):
+                state['num_gets']+=1
+            # capture HTTP response code
+            rescode = float(init_retcode)
+
+            if( (rescode >= 200) and (rescode < 300) ):
+                state['num_two']+=1
+            elif( (rescode >= 300) and (rescode < 400) ):
+                state['num_three']+=1
+            elif( (rescode >= 400) and (rescode < 500) ):
+                state['num_four']+=1
+            elif( (rescode >= 500) and (rescode < 600) ):
+                state['num_five']+=1
+
+            date_and_hour = self.hour_label(self.timestamps.parse(full_date))
         except Exception, e:
-            self.lock.release()
-            raise LogtailerParsingException, "regmatch or contents failed with %s" % e
-        self.lock.release()
-    # example function for deep copy
+            raise LogtailerParsingException, "log format or contents failed with %s" % e
+
+        ip_counts = self.ip_counts
+        counts = ip_counts.begin()
+        try:
+            key = (date_and_hour, remote_ip)
+            counts[key] = counts.get(key, 0) + 1
+            if len(counts) >= self.flush_size and not self.flush_wanted.isSet():
+                self.flush_wanted.set()
+        finally:
+            ip_counts.end()
+
+    # takes a unix time
+    # returns the hour it's in, ie. 2010040210
+    def hour_label(self, when):
+        '''This function returns the local hour of a request, as used in
+        the memcache keys.  Zones are all whole minutes, so the label only
+        needs working out when the minute changes.'''
+        minute = when // 60
+        if minute != self.label_minute:
+            self.label = time.strftime('%Y%m%d%H', time.localtime(when))
+            self.label_minute = minute
+        return self.label
+
     # takes no arguments
-    # returns one object
-    def deep_copy(self):
-        '''This function should return a copy of the data structure used to
-        maintain state.  This copy should different from the object that is
-        currently being modified so that the other thread can deal with it
-        without fear of it changing out from under it.  The format of this
-        object is internal to the plugin.'''
-        myret = dict( num_hits=self.num_hits,
-                    num_gets=self.num_gets,
-                    req_time=self.req_time,
-                    num_two=self.num_two,
-                    num_three=self.num_three,
-                    num_four=self.num_four,
-                    num_five=self.num_five,
-                    )
-        return myret
-    # example function for reset_state
+    # returns nothing
+    def flush_loop(self):
+        '''This function runs in the flusher thread, writing the per IP
+        counts to memcache every flush_interval seconds, or sooner when the
+        parsing thread asks for it.'''
+        while True:
+            self.flush_wanted.wait(self.flush_interval)
+            self.flush_wanted.clear()
+            try:
+                self.flush()
+            except Exception, e:
+                logger.warning('Failed to write per IP counts to memcache: %s' % e)
+            if self.stopping:
+                return
+
     # takes no arguments
     # returns nothing
-    def reset_state(self):
-        '''This function resets the internal data structure to 0 (saving
-        whatever state it needs).  This function should be called
-        immediately after deep copy with a lock in place so the internal
-        data structures can't be modified in between the two calls.  If the
-        time between calls to get_state is necessary to calculate metrics,
-        reset_state should store now() each time it's called, and get_state
-        will use the time since that now() to do its calculations'''
-        self.num_hits = 0
-        self.num_gets = 0
-        self.req_time = 0
-        self.num_two = 0
-        self.num_three = 0
-        self.num_four = 0
-        self.num_five = 0
-        self.last_reset_time = time.time()
-    # example for keeping track of runtimes
+    def stop(self):
+        '''This function has the flusher thread write out what it has and
+        waits for it to finish.  It is called when the process exits.'''
+        self.stopping = True
+        self.flush_wanted.set()
+        self.flusher.join()
+        # anything counted while the flusher's last write was under way
+        try:
+            self.flush()
+        except Exception, e:
+            logger.warning('Failed to write per IP counts to memcache: %s' % e)
+
     # takes no arguments
-    # returns float number of seconds for this run
-    def set_check_duration(self, dur):
-        '''This function only used if logtailer is in cron mode.  If it is
-        invoked, get_check_duration should use this value instead of calculating
-        it.'''
-        self.duration = dur 
-        self.dur_override = True
-    def get_check_duration(self):
-        '''This function should return the time since the last check.  If called
-        from cron mode, this must be set using set_check_duration().  If in
-        daemon mode, it should be calculated internally.'''
-        if( self.dur_override ):
-            duration = self.duration
-        else:
-            cur_time = time.time()
-            duration = cur_time - self.last_reset_time
-            # the duration should be within 10% of period
-            acceptable_duration_min = self.period - (self.period / 10.0)
-            acceptable_duration_max = self.period + (self.period / 10.0)
-            if (duration < acceptable_duration_min or duration > acceptable_duration_max):
-                raise LogtailerStateException, "time calculation problem - duration (%s) > 10%% away from period (%s)" % (duration, self.period)
-        return duration
-    # example function for get_state
+    # returns nothing
+    def flush(self):
+        '''This function writes the per IP counts collected since the last
+        flush to memcache.'''
+        self.flush_lock.acquire()
+        try:
+            counts = self.ip_counts.swap()
+            if counts:
+                self.write_counts(counts)
+        finally:
+            self.flush_lock.release()
+
+    # takes a dict of (date_and_hour, ip) -> number of requests
+    # returns nothing
+    def write_counts(self, counts):
+        '''This function adds a batch of per IP counts to memcache, with one
+        memcache call per (hour, IP) rather than per request.'''
+        mc = self.mc
+        MC_TTL = self.mc_ttl
+        # date_and_hour -> IPs that weren't in memcache yet
+        new_ips = {}
+        for ((date_and_hour, ip), count) in counts.iteritems():
+            ##########################################################################################
+            # We'll construct a key that contains the webserver that client is on and date and
+            # hour ie.
+            # ip-web22-2010033022-1.2.3.4
+            mc_key = "ip-" + self.instance + "-" + date_and_hour + "-" + ip
+            # incr fails if the key isn't there yet, in which case we add it.  Memcache's ADD
+            # only succeeds if the key is not present, so if someone else added it in the
+            # meantime we go back to incrementing it
+            if ( mc.incr(mc_key, count) is None ):
+                if ( mc.add(mc_key, str(count), MC_TTL) ):
+                    new_ips.setdefault(date_and_hour, []).append(ip)
+                else:
+                    mc.incr(mc_key, count)
+
+        # We then append the IPs we haven't seen before to the list of IPs. We'll end up
+        # with a key called ipsarray-web22-2010033022 which is a comma delimited list of IPs
+        for (date_and_hour, ips) in new_ips.iteritems():
+            # Try to add the key. If it's already there use append to append to the end of the list
+            mc_key = "ipsarray-" + self.instance + "-" + date_and_hour
+            ip_list = ",".join(ips)
+            return_code = mc.add(mc_key, ip_list, MC_TTL)
+            if ( return_code == 0 ):
+                mc.append(mc_key, "," + ip_list, MC_TTL)
+
     # takes no arguments
-    # returns a dictionary of (metric => metric_object) pairs
+    # returns a list of metric objects
     def get_state(self):
-        '''This function should acquire a lock, call deep copy, get the
-        current time if necessary, call reset_state, then do its
-        calculations.  It should return a list of metric objects.'''
-        # get the data to work with
-        self.lock.acquire()
+        '''This function writes out any per IP counts still waiting (so none
+        are lost when a cron run ends) and then returns the metrics like any
+        BufferedLogtailer.'''
         try:
-            mydata = self.deep_copy()
-            check_time = self.get_check_duration()
-            self.reset_state()
-            self.lock.release()
-        except LogtailerStateException, e:
-            # if something went wrong with deep_copy or the duration, reset and continue
-            self.reset_state()
-            self.lock.release()
-            raise e
-
+            self.flush()
+        except Exception, e:
+            logger.warning('Failed to write per IP counts to memcache: %s' % e)
+        return BufferedLogtailer.get_state(self)
+    # takes a retired state buffer and the duration it covers
+    # returns a list of metric objects
+    def crunch(self, mydata, check_time):
+        '''This function does the calculations on a state buffer that is no
+        longer being written to.  It should return a list of metric
+        objects.'''
         # crunch data to how you want to report it
         hits_per_second = mydata['num_hits'] / check_time
         gets_per_second = mydata['num_gets'] / check_time
@@ -221,6 +279,3 @@ class VarnishMemcacheLogtailer(object):
 
         # return a list of metric objects
         return [ hps_metric, gps_metric, twops_metric, threeps_metric, fourps_metric, fiveps_metric, ]
-
-
-
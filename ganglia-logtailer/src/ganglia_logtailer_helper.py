@@ -1,6 +1,18 @@
 #!/usr/bin/python
-"""class for ganglia metric objects to be passed around"""
+"""class for ganglia metric objects to be passed around, plus shared building
+blocks for logtailer plugins"""
+import os
 import re
+import imp
+import math
+import time
+import marshal
+import struct
+import hashlib
+import calendar
+from array import array
+from itertools import repeat
+from operator import truediv
 
 class GangliaMetricObject(object):
     def __init__(self, name, value, units='', type='float', tmax=60, dmax=0):
@@ -29,6 +41,1186 @@ class GangliaMetricObject(object):
     def __eq__(self, other):
         """A ganglia metric object is equivalent if the name is the same."""
         return self.name == other.name
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    def __hash__(self):
+        """hashed by name, to match __eq__, so metrics can be looked up in
+        sets and dicts"""
+        return hash(self.name)
+
+class QuantileSketch(object):
+    """Mergeable, fixed-size summary of a stream of non-negative values
+    (request durations, connection counts, ...), used instead of keeping every
+    value in a list and sorting it at the end of the period.
+
+    Values are counted in logarithmically sized buckets (in the style of an
+    HDR histogram) so any quantile is reported to within relative_accuracy of
+    the true value.  count, sum, min and max are exact.  Values are bucketed
+    in batches of pending_limit, so inserting is cheap, and memory is bounded
+    by max_buckets; if the range of values ever needs more buckets than that,
+    the lowest buckets are folded together, which only costs accuracy at the
+    very bottom of the distribution."""
+    # values are kept in a list and bucketed this many at a time, which costs
+    # much less than bucketing each one as it comes in
+    pending_limit = 4096
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        # buckets[i] counts values in (gamma**(offset+i-1), gamma**(offset+i)]
+        self.buckets = array('L')
+        self.offset = 0
+        # values <= 0 can't be log-bucketed
+        self.zero_count = 0
+        self._count = 0
+        self._sum = 0
+        self._min = None
+        self._max = None
+        self.pending = []
+    def add(self, value):
+        """record one value"""
+        pending = self.pending
+        pending.append(value)
+        if len(pending) >= self.pending_limit:
+            self.fold()
+    def extend(self, values):
+        """record a list of values"""
+        pending = self.pending
+        pending.extend(values)
+        if len(pending) >= self.pending_limit:
+            self.fold()
+    def fold(self):
+        """bucket the values recorded since the last fold"""
+        pending = self.pending
+        if not pending:
+            return
+        self.pending = []
+        self._count += len(pending)
+        self._sum += sum(pending)
+        low = min(pending)
+        high = max(pending)
+        if self._min is None or low < self._min:
+            self._min = low
+        if self._max is None or high > self._max:
+            self._max = high
+        positive = [value for value in pending if value > 0]
+        self.zero_count += len(pending) - len(positive)
+        # ceil(log(value) / log_gamma) for each value, looping in C
+        indexes = map(math.ceil, map(truediv, map(math.log, positive),
+                                     repeat(self.log_gamma, len(positive))))
+        # count them up first so each bucket is only touched once
+        counts = {}
+        get = counts.get
+        for index in indexes:
+            counts[index] = get(index, 0) + 1
+        for (index, count) in counts.iteritems():
+            self._add_to_bucket(int(index), count)
+    @property
+    def count(self):
+        self.fold()
+        return self._count
+    @property
+    def sum(self):
+        self.fold()
+        return self._sum
+    @property
+    def min(self):
+        self.fold()
+        return self._min
+    @property
+    def max(self):
+        self.fold()
+        return self._max
+    def _add_to_bucket(self, index, count):
+        buckets = self.buckets
+        if not buckets:
+            buckets.append(0)
+            self.offset = index
+        if index < self.offset:
+            # grow downwards, but never past max_buckets
+            index = max(index, self.offset + len(buckets) - self.max_buckets)
+            if index < self.offset:
+                self.buckets = buckets = array('L', [0] * (self.offset - index)) + buckets
+                self.offset = index
+        elif index >= self.offset + len(buckets):
+            buckets.extend([0] * (index - self.offset - len(buckets) + 1))
+            if len(buckets) > self.max_buckets:
+                # fold the lowest buckets together to stay within max_buckets
+                excess = len(buckets) - self.max_buckets
+                folded = sum(buckets[:excess + 1])
+                del buckets[:excess]
+                buckets[0] = folded
+                self.offset += excess
+        buckets[index - self.offset] += count
+    def merge(self, other):
+        """fold another sketch (eg. from another vhost or worker) into this one"""
+        if other.gamma != self.gamma:
+            raise ValueError("can't merge sketches with different accuracies")
+        # values other hasn't bucketed yet are just taken over as they are,
+        # which keeps merging small sketches cheap
+        if other.pending:
+            self.extend(other.pending)
+        if other._count == 0:
+            return
+        self._count += other._count
+        self._sum += other._sum
+        self.zero_count += other.zero_count
+        if self._min is None or other._min < self._min:
+            self._min = other._min
+        if self._max is None or other._max > self._max:
+            self._max = other._max
+        for i, bucket_count in enumerate(other.buckets):
+            if bucket_count:
+                self._add_to_bucket(other.offset + i, bucket_count)
+    def avg(self):
+        if self.count == 0:
+            return 0
+        return float(self.sum) / self.count
+    def quantile(self, q):
+        """returns the value at quantile q (0 <= q <= 1), or 0 if the sketch
+        is empty.  Like indexing a sorted list at int(count * q)."""
+        if self.count == 0:
+            return 0
+        if q >= 1:
+            return self.max
+        rank = int(self.count * q)
+        running = self.zero_count
+        if rank < running:
+            return max(self.min, 0)
+        for i, bucket_count in enumerate(self.buckets):
+            running += bucket_count
+            if running > rank:
+                # the middle of the bucket, relative to its bounds
+                value = 2 * self.gamma ** (self.offset + i) / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+    def percentiles(self, percentiles):
+        """takes a list of percentiles (eg. [50, 90, 99, 100]) and returns a
+        list of (label, value) pairs, labeled '50th', '90th', '99th' and 'max'"""
+        results = []
+        for p in percentiles:
+            if p >= 100:
+                label = 'max'
+            else:
+                label = '%gth' % p
+            results.append((label, self.quantile(p / 100.0)))
+        return results
+
+def parse_percentiles(value):
+    """parses the percentiles plugin option, a comma separated list like
+    '50, 90, 99, 100', into a tuple for QuantileSketch.percentiles.
+    raises ValueError unless each one is over 0 and at most 100."""
+    percentiles = []
+    for p in value.split(','):
+        try:
+            p = float(p)
+        except ValueError:
+            raise ValueError("percentiles must be numbers, not %r" % value)
+        if not 0 < p <= 100:
+            raise ValueError("percentiles must be over 0 and at most 100, not %g" % p)
+        percentiles.append(p)
+    if not percentiles:
+        raise ValueError("no percentiles given")
+    return tuple(percentiles)
+
+class DoubleBufferedState(object):
+    """Holds a plugin's accumulated state as two buffers so the parsing thread
+    never has to take a lock.  The parsing thread writes into the active
+    buffer between begin() and end(); swap() (called from the gmetric
+    thread) installs a fresh buffer built by factory() and hands back the
+    retired one, which nobody else touches any more.
+
+    swap() can't know whether the parser read the old active buffer just
+    before the swap, so begin() and end() count writes in and out.  Any
+    write that had begun by the time the new buffer is installed may still
+    be using the old one; swap() waits for those (at most one) to finish.
+    Writes that begin afterwards can only see the new buffer."""
+    def __init__(self, factory):
+        self.factory = factory
+        self.active = factory()
+        self.entered = 0
+        self.exited = 0
+        self.last_swap_time = time.time()
+    def begin(self):
+        """called by the parsing thread before writing; returns the buffer to write to"""
+        self.entered += 1
+        return self.active
+    def end(self):
+        """called by the parsing thread when it's done writing"""
+        self.exited += 1
+    def swap(self):
+        """install a fresh buffer and return the retired one"""
+        retired = self.active
+        self.active = self.factory()
+        in_flight = self.entered
+        while self.exited < in_flight:
+            time.sleep(0.0001)
+        self.last_swap_time = time.time()
+        return retired
+
+def merge_states(into, other):
+    """adds the state buffer other into the state buffer into, for plugins
+    whose state is made of counters: numbers are added, QuantileSketches
+    merged and dicts merged key by key (keys only in other are copied
+    over).  Plugins can use it to implement merge_state."""
+    for (key, value) in other.iteritems():
+        if key not in into:
+            into[key] = value
+        elif isinstance(value, (int, long, float)):
+            into[key] += value
+        elif isinstance(value, dict):
+            merge_states(into[key], value)
+        elif isinstance(value, (QuantileSketch, HeavyHitterTable, HyperLogLog)):
+            into[key].merge(value)
+        else:
+            into[key] += value
+
+class HeavyHitterTable(object):
+    """Keeps separate stats for at most capacity keys (vhosts, listeners,
+    ...) out of a stream with any number of them, using the space-saving
+    algorithm: when a key that isn't in the table comes in and the table is
+    full, the key with the lowest count is evicted and its stats are folded
+    into other.  The newcomer inherits the evicted count (as its possible
+    error), so a key that keeps coming back works its way in and any key
+    with more than 1/capacity of the hits is sure to be in the table.
+
+    The stats are whatever the plugin keeps per key, eg. a dict of counters
+    and QuantileSketches; they must merge with merge_states.  Stats only
+    cover the hits since the key last entered the table; earlier ones are
+    in other.  The plugin looks keys up with hit() on every line and adds
+    the ones that aren't there yet with admit():
+        stats = table.hit(key)
+        if stats is None:
+            stats = table.admit(key, blank_stats())"""
+    def __init__(self, capacity, other):
+        self.capacity = capacity
+        # key -> stats, key -> estimated count, key -> possible overestimate
+        self.entries = {}
+        self.counts = {}
+        self.errors = {}
+        # count -> set of the keys with that count, and the lowest count, so
+        # the key to evict is found without a scan
+        self.by_count = {}
+        self.floor = 0
+        self.other = other
+        self.total = 0
+        self.evictions = 0
+    def hit(self, key, hits=1):
+        """counts hits (one by default) for key and returns its stats, or
+        None if key isn't in the table (the hits are still counted in the
+        total; pass them to admit())"""
+        self.total += hits
+        counts = self.counts
+        if key not in counts:
+            return None
+        count = counts[key]
+        counts[key] = count + hits
+        by_count = self.by_count
+        keys = by_count[count]
+        keys.remove(key)
+        if count + hits in by_count:
+            by_count[count + hits].add(key)
+        else:
+            by_count[count + hits] = set([key])
+        if not keys:
+            del by_count[count]
+            if count == self.floor:
+                if hits == 1:
+                    self.floor = count + 1
+                else:
+                    self.floor = min(by_count)
+        return self.entries[key]
+    def admit(self, key, stats, hits=1):
+        """adds key with the (empty) stats given and the hits hit() just
+        counted for it, evicting the key with the lowest count if the table
+        is full.  returns stats"""
+        floor = 0
+        if len(self.counts) >= self.capacity:
+            floor = self.evict()
+        self.insert(key, stats, floor + hits, floor)
+        return stats
+    def insert(self, key, stats, count, error):
+        """puts key in the table with the stats, count and error given"""
+        self.entries[key] = stats
+        self.counts[key] = count
+        self.errors[key] = error
+        if count in self.by_count:
+            self.by_count[count].add(key)
+        else:
+            self.by_count[count] = set([key])
+        if len(self.counts) == 1 or count < self.floor:
+            self.floor = count
+    def remove(self, key):
+        """takes key out of the table and returns its stats and count"""
+        count = self.counts.pop(key)
+        del self.errors[key]
+        keys = self.by_count[count]
+        keys.remove(key)
+        if not keys:
+            del self.by_count[count]
+            if count == self.floor and self.by_count:
+                self.floor = min(self.by_count)
+        return (self.entries.pop(key), count)
+    def evict(self):
+        """folds the key with the lowest count into other and returns its count"""
+        victim = iter(self.by_count[self.floor]).next()
+        (stats, count) = self.remove(victim)
+        merge_states(self.other, stats)
+        self.evictions += 1
+        return count
+    def merge(self, other):
+        """adds another table (eg. from a worker process) into this one"""
+        for (key, stats) in other.entries.iteritems():
+            (count, error) = (other.counts[key], other.errors[key])
+            if key in self.entries:
+                error += self.errors[key]
+                (mine, my_count) = self.remove(key)
+                merge_states(mine, stats)
+                (stats, count) = (mine, count + my_count)
+            self.insert(key, stats, count, error)
+        merge_states(self.other, other.other)
+        self.total += other.total
+        self.evictions += other.evictions
+        while len(self.counts) > self.capacity:
+            self.evict()
+    def hot_and_other(self, fraction):
+        """returns (hot, other): a list of (key, stats) for the keys that are
+        sure to have had at least fraction of all the hits, and the stats of
+        everything else folded together.  Folds the other keys away, so only
+        call it on a state buffer that is done with."""
+        threshold = self.total * fraction
+        hot = []
+        for (key, stats) in self.entries.items():
+            if self.counts[key] - self.errors[key] >= threshold:
+                hot.append((key, stats))
+            else:
+                self.remove(key)
+                merge_states(self.other, stats)
+        return (hot, self.other)
+    def top(self, n):
+        """returns a list of (key, hits) for the n keys with the most hits,
+        most first.  hits only counts the hits the key is sure to have had
+        (its count less its possible error), so it is never too high."""
+        errors = self.errors
+        sure = [(key, count - errors[key]) for (key, count) in self.counts.iteritems()]
+        sure.sort(key=lambda item: item[1], reverse=True)
+        return sure[:n]
+
+class HyperLogLog(object):
+    """Estimates the number of distinct values (client IPs, ...) in a stream
+    in a fixed 2**precision bytes, to within about 1.04 / sqrt(2**precision)
+    (1.6% with the default 4096 registers).  Values must be strings.  Two
+    estimators with the same precision merge into one that counts the union
+    of their values, so workers and periods can be combined.
+
+    Like QuantileSketch, values are collected (and de-duplicated) in a set
+    and only hashed pending_limit at a time."""
+    pending_limit = 4096
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = array('B', [0]) * self.size
+        self.pending = set()
+    def add(self, value):
+        """record one value"""
+        pending = self.pending
+        pending.add(value)
+        if len(pending) >= self.pending_limit:
+            self.fold()
+    def update(self, values):
+        """record a list of values"""
+        pending = self.pending
+        pending.update(values)
+        if len(pending) >= self.pending_limit:
+            self.fold()
+    def fold(self):
+        """hash the values recorded since the last fold into the registers"""
+        pending = self.pending
+        if not pending:
+            return
+        self.pending = set()
+        registers = self.registers
+        precision = self.precision
+        # the top precision bits of the hash pick the register, which keeps
+        # the longest run of leading zeros (plus one) seen in the rest
+        width = 64 - precision
+        mask = (1 << width) - 1
+        md5 = hashlib.md5
+        unpack = struct.unpack
+        for value in pending:
+            (hashed,) = unpack('>Q', md5(value).digest()[:8])
+            index = hashed >> width
+            rank = width - (hashed & mask).bit_length() + 1
+            if rank > registers[index]:
+                registers[index] = rank
+    def merge(self, other):
+        """fold another estimator (eg. from another worker) into this one"""
+        if other.precision != self.precision:
+            raise ValueError("can't merge estimators with different precisions")
+        self.pending.update(other.pending)
+        self.registers = array('B', map(max, self.registers, other.registers))
+        if len(self.pending) >= self.pending_limit:
+            self.fold()
+    def count(self):
+        """returns the estimated number of distinct values"""
+        self.fold()
+        size = self.size
+        width = 64 - self.precision
+        # Ertl's estimator ("New cardinality estimation algorithms for
+        # HyperLogLog sketches", 2017) works from how many registers hold
+        # each value, and unlike the original one needs no switch to linear
+        # counting or bias correction for small and mid-sized counts
+        histogram = [0] * (width + 2)
+        for rank in self.registers:
+            histogram[rank] += 1
+        z = size * self.tau(1 - float(histogram[width + 1]) / size)
+        for k in xrange(width, 0, -1):
+            z = 0.5 * (z + histogram[k])
+        z += size * self.sigma(float(histogram[0]) / size)
+        if z == float('inf'):
+            return 0.0
+        return size * size / (2 * math.log(2) * z)
+    @staticmethod
+    def sigma(x):
+        if x == 1:
+            return float('inf')
+        (y, z) = (1.0, x)
+        while True:
+            x = x * x
+            previous = z
+            z += x * y
+            y += y
+            if z == previous:
+                return z
+    @staticmethod
+    def tau(x):
+        if x == 0 or x == 1:
+            return 0.0
+        (y, z) = (1.0, 1 - x)
+        while True:
+            x = math.sqrt(x)
+            previous = z
+            y *= 0.5
+            z -= (1 - x) ** 2 * y
+            if z == previous:
+                return z / 3
+
+class FieldExtractor(object):
+    """Pulls named fields out of lines of a fixed-format log (eg. an access
+    log) with str.split and slicing instead of a regex, building only the
+    fields that are asked for.
+
+    format lists the fields of a line in order, separated by single spaces:
+        name      - a field with no spaces in it
+        "name"    - a field in double quotes, which may contain spaces
+        "a b c"   - a field in double quotes, split on its first spaces into
+                    a, b and c (the last one gets the rest, eg. the request
+                    line of an access log)
+        [name]    - a field in square brackets, which may contain spaces
+    Anything in a line after the last field is ignored.  Quoted fields can't
+    contain double quotes.
+
+    The format is compiled into a function, extract(line), that takes a
+    line and returns a tuple of the values of fields, in that order.  It
+    raises ValueError if the line doesn't fit the format.  match(line) does
+    the same but returns None instead, like a regex, which is handy for
+    map()ing over a batch of lines.  A line is only read as far as the last
+    field wanted, so later fields aren't checked.
+
+    If cache_dir is set (ganglia-logtailer sets it to its state dir), the
+    compiled functions are kept there, like a .pyc, so a cron run can load
+    them instead of compiling them again."""
+    token_re = re.compile(r'"[^"]*"|\[[^\]]*\]|[^ ]+')
+    cache_dir = None
+    # bump this whenever generate() changes, so old cached code isn't used
+    generator_version = 2
+    def __init__(self, format, fields):
+        self.format = format
+        self.fields = tuple(fields)
+        code = self.load_cached()
+        if code is None:
+            source = self.generate(self.parse(format), self.fields)
+            source += source.replace('def extract', 'def match').replace(
+                'raise ValueError(MISMATCH)', 'return None')
+            code = compile(source, '<FieldExtractor %s>' % format, 'exec')
+            self.save_cached(code)
+        namespace = {'MISMATCH': 'line does not fit the log format'}
+        exec code in namespace
+        self.extract = namespace['extract']
+        self.match = namespace['match']
+
+    def cache_file(self):
+        key = repr((self.generator_version, self.format, self.fields))
+        return os.path.join(self.cache_dir, 'fieldextractor-%s.cache' % hashlib.sha1(key).hexdigest())
+
+    def load_cached(self):
+        """returns the cached code object for this format and fields, or
+        None if there isn't one for this version of python"""
+        if self.cache_dir is None:
+            return None
+        try:
+            data = open(self.cache_file(), 'rb').read()
+        except IOError:
+            return None
+        magic = imp.get_magic()
+        if not data.startswith(magic):
+            return None
+        try:
+            return marshal.loads(data[len(magic):])
+        except (EOFError, ValueError, TypeError):
+            return None
+
+    def save_cached(self, code):
+        """writes the code object to the cache, if there is one.  Failing to
+        is no great loss, so it's not an error."""
+        if self.cache_dir is None:
+            return
+        cache_file = self.cache_file()
+        temp_file = '%s.%d' % (cache_file, os.getpid())
+        try:
+            fh = open(temp_file, 'wb')
+            try:
+                fh.write(imp.get_magic() + marshal.dumps(code))
+            finally:
+                fh.close()
+            os.rename(temp_file, cache_file)
+        except (IOError, OSError):
+            pass
+
+    def parse(self, format):
+        """returns the format as a list of runs of fields of the same kind
+        ('plain', 'quoted' or 'bracketed'), each a (kind, [names, ...]) pair.
+        Each quoted field is a list of the names it's split into."""
+        runs = []
+        for token in self.token_re.findall(format):
+            if token[0] == '"':
+                kind = 'quoted'
+                names = token[1:-1].split()
+            elif token[0] == '[':
+                kind = 'bracketed'
+                names = token[1:-1]
+            else:
+                kind = 'plain'
+                names = token
+            # brackets have to be found one at a time
+            if runs and runs[-1][0] == kind and kind != 'bracketed':
+                runs[-1][1].append(names)
+            else:
+                runs.append((kind, [names]))
+        return runs
+
+    def generate(self, runs, fields):
+        """returns the source of extract() for the parsed format runs"""
+        where = {}
+        for (i, (kind, items)) in enumerate(runs):
+            for (j, names) in enumerate(items):
+                if kind != 'quoted':
+                    names = [names]
+                for name in names:
+                    if name in fields and name not in where:
+                        where[name] = (i, j)
+        missing = [name for name in fields if name not in where]
+        if missing:
+            raise ValueError("fields not in the log format: %s" % ', '.join(missing))
+        # nothing past the last field wanted is split off
+        last_run = max([i for (i, j) in where.values()])
+        last_item = max([j for (i, j) in where.values() if i == last_run])
+        code = []
+        values = {}
+        for (i, (kind, items)) in enumerate(runs[:last_run + 1]):
+            last = (i == last_run)
+            part = 'p%d' % i
+            if kind == 'plain':
+                # split off the fields and (unless this is the last run) the
+                # rest of the line; a short line raises IndexError below
+                n = len(items)
+                if last:
+                    n = last_item + 1
+                code.append('%s = rest.split(" ", %d)' % (part, n))
+                for (j, name) in enumerate(items[:n]):
+                    value = '%s[%d]' % (part, j)
+                    if i == len(runs) - 1 and j == len(items) - 1:
+                        # may be the end of the line
+                        value += ".rstrip('\\r\\n')"
+                    values[name] = value
+                if not last:
+                    code.append('rest = %s[%d]' % (part, n))
+            elif kind == 'quoted':
+                # '"a" "b" rest' splits into '', a, ' ', b, ' rest'
+                n = len(items)
+                if last:
+                    n = last_item + 1
+                code.append("%s = rest.split('\"', %d)" % (part, 2 * n))
+                code.append('if %s[0] or len(%s) <= %d: raise ValueError(MISMATCH)' % (part, part, 2 * n))
+                for (j, names) in enumerate(items[:n]):
+                    value = '%s[%d]' % (part, 2 * j + 1)
+                    if len(names) == 1:
+                        values[names[0]] = value
+                        continue
+                    if not [name for name in names if name in fields]:
+                        continue
+                    words = 'w%d_%d' % (i, j)
+                    code.append('%s = %s.split(" ", %d)' % (words, value, len(names) - 1))
+                    code.append('if len(%s) < %d: raise ValueError(MISMATCH)' % (words, len(names)))
+                    for (k, name) in enumerate(names):
+                        values[name] = '%s[%d]' % (words, k)
+                if not last:
+                    code.append('rest = %s[%d][1:]' % (part, 2 * n))
+            else:
+                code.append("if rest[:1] != '[': raise ValueError(MISMATCH)")
+                # not index(), which raises a ValueError that match() can't
+                # turn into None
+                code.append("end = rest.find(']')")
+                code.append("if end < 0: raise ValueError(MISMATCH)")
+                code.append('%s = rest[1:end]' % part)
+                values[items[0]] = part
+                if not last:
+                    code.append('rest = rest[end + 2:]')
+        code.append('return (%s,)' % ', '.join([values[name] for name in fields]))
+        return '\n'.join(['def extract(line):',
+                          '    rest = line',
+                          '    try:'] +
+                         ['        ' + line for line in code] +
+                         ['    except IndexError:',
+                          '        raise ValueError(MISMATCH)']) + '\n'
+
+class LogFormat(object):
+    """An apache LogFormat string (as also written by varnishncsa, Tomcat's
+    AccessLogValve and most other NCSA-style loggers), eg.
+        %h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-agent}i"
+    which can be turned into a FieldExtractor for just the fields a plugin
+    needs.
+
+    Fields are named after their directive (see directives); %>s is
+    final_retcode and %s (or %<s) init_retcode.  Headers, notes, cookies etc.
+    are named after what's in the braces, lower-cased and with - turned into
+    _ (so %{User-Agent}i is user_agent), except that %{Referer}i is referrer
+    and %{X-Forwarded-For}i xfwd_for.  For varnishncsa's %{Varnish:hitmiss}x
+    only the part after the colon is used.  %r is the whole request line
+    (request), or, if a plugin asks for any of them, its method, url and
+    protocol.
+
+    Directives have to be separated by single spaces, and can be in double
+    quotes or square brackets (%t comes with its own brackets).  Any other
+    literal text raises ValueError, as do directives this doesn't know."""
+    directives = {'a': 'remote_ip',
+                  'A': 'local_ip',
+                  'B': 'size',
+                  'b': 'size_clf',
+                  'c': 'conn_status',       # apache 1.3's %X
+                  'D': 'req_time',          # microseconds (milliseconds in Tomcat)
+                  'f': 'filename',
+                  'h': 'remote_host',
+                  'H': 'protocol',
+                  'I': 'req_size_wire',
+                  'k': 'keepalives',
+                  'l': 'ident',
+                  'L': 'log_id',
+                  'm': 'method',
+                  'O': 'resp_size_wire',
+                  'p': 'port',
+                  'P': 'pid',
+                  'q': 'query_string',
+                  'r': 'request',
+                  'S': 'size_wire',
+                  't': 'date',
+                  'T': 'req_time_sec',
+                  'u': 'auth_user',
+                  'U': 'url',
+                  'v': 'server_name',
+                  'V': 'server_name_used',
+                  'X': 'conn_status'}
+    # %{...}x directives named after what's in the braces
+    brace_prefixes = {'i': '',          # request header
+                      'n': '',          # note
+                      'o': 'resp_',     # response header
+                      'e': 'env_',      # environment variable
+                      'C': 'cookie_',   # cookie
+                      'x': ''}          # varnishncsa extended variable
+    # names apacheLogToRegex always used
+    brace_names = {'referer': 'referrer',
+                   'x_forwarded_for': 'xfwd_for'}
+    directive_re = re.compile(r'%!?[0-9,]*([<>]?)(?:\{([^}]*)\})?([<>]?)([a-zA-Z])')
+    closing = {'"': '"', '[': ']'}
+    # %t formats TimestampParser can read
+    timestamp_formats = {None: 'ncsa',
+                         '%Y-%m-%dT%H:%M:%S': 'iso'}
+
+    def __init__(self, log_format):
+        self.log_format = log_format
+        # the TimestampParser format of the first %t, if it has one
+        self.timestamp_format = None
+        self.fields = self.parse(log_format)
+
+    def parse(self, log_format):
+        """returns the fields of log_format as a list of (quote, names)
+        pairs, where quote is '"', '[' or '' and names lists the field names
+        the directive takes up (a bare %r or a date format with spaces in it
+        takes up several)"""
+        fields = []
+        dated = False
+        pos = 0
+        while pos < len(log_format):
+            quote = ''
+            if log_format[pos] in self.closing:
+                quote = log_format[pos]
+                pos += 1
+            match = self.directive_re.match(log_format, pos)
+            if not match:
+                raise ValueError("can't make sense of %r in log format %s" % (log_format[pos:], log_format))
+            pos = match.end()
+            if quote:
+                if log_format[pos:pos + 1] != self.closing[quote]:
+                    raise ValueError("unclosed %s in log format %s" % (quote, log_format))
+                pos += 1
+            if pos < len(log_format):
+                if log_format[pos] != ' ':
+                    raise ValueError("can't make sense of %r in log format %s" % (log_format[pos:], log_format))
+                pos += 1
+            (modifier, argument, modifier2, letter) = match.groups()
+            name = self.field_name(modifier or modifier2, argument, letter)
+            names = [name]
+            if name == 'date' and not dated:
+                self.timestamp_format = self.timestamp_formats.get(argument)
+                dated = True
+            if letter == 't' and argument is None and not quote:
+                # %t is written with brackets round it
+                quote = '['
+            elif letter == 't' and not quote:
+                names += ['%s_%d' % (name, i) for i in range(1, argument.count(' ') + 1)]
+            elif letter == 'r' and not quote:
+                names = ['method', 'url', 'protocol']
+            fields.append((quote, names))
+        return fields
+
+    def field_name(self, modifier, argument, letter):
+        """returns the name of the field a directive writes"""
+        if letter == 's':
+            if modifier == '>':
+                return 'final_retcode'
+            return 'init_retcode'
+        if argument is not None and letter in self.brace_prefixes:
+            name = argument.split(':')[-1].lower().replace('-', '_')
+            return self.brace_prefixes[letter] + self.brace_names.get(name, name)
+        if letter in self.directives:
+            return self.directives[letter]
+        raise ValueError("unknown log format directive %%%s" % letter)
+
+    def extractor_format(self, fields):
+        """returns the FieldExtractor format for this log format.  %r is
+        split up if any of fields is its method, url or protocol."""
+        provided = []
+        for (quote, names) in self.fields:
+            provided.extend(names)
+        split = [name for name in ('method', 'url', 'protocol')
+                 if name in fields and name not in provided]
+        tokens = []
+        for (quote, names) in self.fields:
+            if names == ['request'] and quote == '"' and split:
+                if 'request' in fields:
+                    raise ValueError("can't have the request both whole and split into method, url and protocol")
+                names = ['method', 'url', 'protocol']
+            if quote == '"':
+                tokens.append('"%s"' % ' '.join(names))
+            elif quote == '[':
+                tokens.append('[%s]' % names[0])
+            else:
+                tokens.extend(names)
+        return ' '.join(tokens)
+
+    def status_field(self, prefer='init_retcode'):
+        """returns the name of the response status field for a plugin to
+        extract: prefer if the log has it, otherwise the other of
+        init_retcode (%s) and final_retcode (%>s), so the plugin works with
+        either.  If the log has neither, extractor() will say so."""
+        provided = []
+        for (quote, names) in self.fields:
+            provided.extend(names)
+        if prefer in provided:
+            return prefer
+        for name in ('init_retcode', 'final_retcode'):
+            if name in provided:
+                return name
+        return prefer
+
+    def extractor(self, fields):
+        """returns a FieldExtractor for fields of lines in this log format.
+        raises ValueError if any of them aren't in it."""
+        return FieldExtractor(self.extractor_format(fields), fields)
+
+class TimestampParser(object):
+    """Turns log timestamps into unix times, for one of these formats:
+        ncsa    02/Apr/2010:10:20:30 -0400 (apache's %t, with or without the
+                brackets)
+        iso     2008-05-08T07:34:44, optionally with fractions of a second
+                and a zone (Z, +01:00 or +0100)
+        syslog  Sep 11 09:03:05 (the year is taken to be the one that puts
+                it no more than a day in the future)
+    Times without a zone are local time.  Fractions of a second are dropped.
+
+    Consecutive lines mostly share their timestamp, and always their hour,
+    so parse() remembers the last timestamp it saw and the start of each
+    hour; only the minutes and seconds are worked out on each call.
+    raises ValueError for a timestamp that isn't in the format."""
+    months = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+              'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+    # hours remembered before starting again
+    max_hours = 1024
+    def __init__(self, format):
+        if format not in ('ncsa', 'iso', 'syslog'):
+            raise ValueError("unknown timestamp format %s" % format)
+        self.format = format
+        self.split = getattr(self, 'split_' + format)
+        self.hour_start = getattr(self, 'hour_start_' + format)
+        # hour key (see the split functions) -> unix time the hour starts
+        self.hours = {}
+        self.last_text = None
+        self.last_time = None
+    def parse(self, text):
+        """returns the unix time of the timestamp text"""
+        if text == self.last_text:
+            return self.last_time
+        (hour, minutes, seconds) = self.split(text)
+        hours = self.hours
+        if hour in hours:
+            start = hours[hour]
+        else:
+            try:
+                start = self.hour_start(hour)
+            except (KeyError, IndexError, OverflowError, ValueError):
+                raise ValueError("can't parse %s timestamp %r" % (self.format, text))
+            if len(hours) >= self.max_hours:
+                hours.clear()
+            hours[hour] = start
+        when = start + int(minutes) * 60 + int(seconds)
+        self.last_text = text
+        self.last_time = when
+        return when
+
+    # each split function returns (hour key, minutes, seconds); the hour key
+    # is whatever its hour_start function needs to work out the hour
+    def split_ncsa(self, text):
+        if text[:1] == '[':
+            text = text[1:].rstrip(']')
+        if len(text) < 20 or text[2] != '/' or text[11] != ':' or text[17] != ':':
+            raise ValueError("can't parse ncsa timestamp %r" % text)
+        return ((text[:14], text[21:]), text[15:17], text[18:20])
+    def hour_start_ncsa(self, hour):
+        # 02/Apr/2010:10 and the zone
+        (date, zone) = hour
+        start = (int(date[7:11]), self.months[date[3:6]], int(date[0:2]), int(date[12:14]))
+        return self.start_of(start, zone)
+    def split_iso(self, text):
+        if len(text) < 19 or text[4] != '-' or text[10] not in 'T ' or text[16] != ':':
+            raise ValueError("can't parse iso timestamp %r" % text)
+        zone = text[19:]
+        if zone[:1] == '.':
+            zone = zone[1:].lstrip('0123456789')
+        return ((text[:13], zone), text[14:16], text[17:19])
+    def hour_start_iso(self, hour):
+        # 2008-05-08T07 and the zone
+        (date, zone) = hour
+        start = (int(date[0:4]), int(date[5:7]), int(date[8:10]), int(date[11:13]))
+        return self.start_of(start, zone)
+    def split_syslog(self, text):
+        if len(text) < 15 or text[3] != ' ' or text[9] != ':' or text[12] != ':':
+            raise ValueError("can't parse syslog timestamp %r" % text)
+        return (text[:9], text[10:12], text[13:15])
+    def hour_start_syslog(self, date):
+        # Sep 11 09 (or Sep  1 09)
+        (month, day, hour) = (self.months[date[0:3]], int(date[4:6]), int(date[7:9]))
+        now = time.time()
+        year = time.localtime(now).tm_year
+        start = self.start_of((year, month, day, hour), '')
+        if start > now + 86400:
+            # eg. a December log read in January
+            start = self.start_of((year - 1, month, day, hour), '')
+        return start
+    def start_of(self, start, zone):
+        """returns the unix time of the start of an hour, given as (year,
+        month, day, hour), in local time if zone is '', otherwise in Z or
+        +-hh[:]mm"""
+        (year, month, day, hour) = start
+        if not 1 <= month <= 12 or not 1 <= day <= 31 or not 0 <= hour <= 23:
+            raise ValueError("no such time")
+        if not zone:
+            return int(time.mktime((year, month, day, hour, 0, 0, 0, 0, -1)))
+        start = calendar.timegm((year, month, day, hour, 0, 0))
+        if zone == 'Z':
+            return start
+        offset = zone.replace(':', '')
+        if len(offset) != 5 or offset[0] not in '+-':
+            raise ValueError("no such zone")
+        offset = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+        if zone[0] == '-':
+            return start + offset
+        return start - offset
+
+class BufferedLogtailer(object):
+    """Base class for logtailer plugins that accumulate into a
+    DoubleBufferedState instead of guarding their counters with a lock.
+    Subclasses define:
+        new_state() - returns an empty state buffer (eg. a dict of counters)
+        accumulate(state, line) - digests one line into the state buffer.
+            May raise LogtailerParsingException, like parse_line().
+        crunch(state, check_time) - turns a retired state buffer into a list
+            of metric objects
+    and get parse_line(), get_state(), reset_state(), merge_state() and the
+    check duration functions from this class.
+
+    merge_state(into, other) adds the state buffer other, filled by another
+    instance of the plugin, into the state buffer into.  That lets cron mode
+    split a large backlog between several processes (see --workers) and
+    use_event_time keep a state buffer per window.  The default suits state
+    buffers made of counters and summaries (see merge_states) or with a
+    merge method of their own, like a HeavyHitterTable; plugins whose state
+    doesn't add up override it, or set mergeable to False.
+
+    Subclasses may also define
+        line_guards - a tuple of strings that must all appear in a line for
+            it to be worth parsing.  Other lines are dropped before
+            accumulate() is called, with a cheap substring test instead of
+            a regex.
+        accumulate_lines(state, lines) - digests a whole batch of lines at
+            once, eg. a column at a time, and returns the list of
+            LogtailerParsingExceptions for lines it skipped.  The default
+            calls accumulate() on each line.
+        event_time(line) - returns the unix time a line was logged at (or
+            raises ValueError), which lets use_event_time count lines in the
+            period they were logged in rather than the one they were read
+            in.  Plugins reading a LogFormat log can get one from
+            event_time_from()."""
+    # only used in daemon mode
+    period = 30
+    line_guards = ()
+    # whether merge_state can be used (see above)
+    mergeable = True
+    event_time = None
+    # with use_event_time, how long (in seconds of log time) to wait for
+    # stragglers before a window is reported
+    event_lateness = 60
+    # set by expect_duration for the next get_check_duration
+    expected_duration = None
+    def __init__(self):
+        # assume we're in daemon mode unless set_check_duration gets called
+        self.dur_override = False
+        self.windowed = False
+        self.state = DoubleBufferedState(self.new_state)
+    def new_state(self):
+        raise NotImplementedError
+    def accumulate(self, state, line):
+        raise NotImplementedError
+    def crunch(self, state, check_time):
+        raise NotImplementedError
+    def merge_state(self, into, other):
+        if isinstance(into, dict):
+            merge_states(into, other)
+        else:
+            into.merge(other)
+    def event_time_from(self, log_format):
+        """sets event_time up to read the (first) %t of a LogFormat, if it's
+        in a format TimestampParser knows"""
+        if log_format.timestamp_format is None:
+            self.event_time = None
+            return
+        self.date_field = log_format.extractor(('date',))
+        self.timestamps = TimestampParser(log_format.timestamp_format)
+        self.event_time = self.log_event_time
+    def log_event_time(self, line):
+        """event_time for plugins set up with event_time_from"""
+        return self.timestamps.parse(self.date_field.extract(line)[0])
+    def use_event_time(self, lateness=None):
+        """switches (daemon mode) to counting each line in the period-long
+        window its event_time falls in, rather than the period it happens
+        to be read in.  get_state then reports the windows that have closed
+        since it was last called, which is any more than lateness seconds
+        (event_lateness by default) older than the newest line, or than now
+        if no lines came in.  So catching up on a backlog reports the rates
+        as they were rather than a spike, and a late get_state doesn't lose
+        a period.  Lines that turn up after their window was reported are
+        counted in the next report instead (see late_lines).
+        raises ValueError if the plugin has no event_time or isn't
+        mergeable."""
+        if self.event_time is None or not self.mergeable:
+            raise ValueError("%s can't count lines by the time they were logged" % self.__class__.__name__)
+        if lateness is not None:
+            self.event_lateness = lateness
+        # period can change later (see GMetricManager); the windows can't
+        self.window = self.period
+        # the parsing thread writes into a dict of window start -> state
+        # buffer, which get_state swaps out and merges into its own windows
+        self.state = DoubleBufferedState(dict)
+        self.windows = {}
+        # everything before this has been reported
+        self.reported_until = None
+        self.latest_event = None
+        self.late_lines = 0
+        self.windowed = True
+    def window_state(self, windows, when):
+        """returns the state buffer in windows (a dict of window start ->
+        state buffer) for a line logged at when"""
+        start = int(when // self.window * self.window)
+        reported_until = self.reported_until
+        if reported_until is not None and start < reported_until:
+            # too late for its own window; it goes in the next report
+            self.late_lines += 1
+            start = reported_until
+        elif self.latest_event is None or when > self.latest_event:
+            self.latest_event = when
+        if start in windows:
+            return windows[start]
+        state = windows[start] = self.new_state()
+        return state
+    def parse_line(self, line):
+        for guard in self.line_guards:
+            if guard not in line:
+                return
+        state = self.state
+        active = state.begin()
+        try:
+            if self.windowed:
+                try:
+                    when = self.event_time(line)
+                except ValueError, e:
+                    raise LogtailerParsingException, "can't tell when line was logged: %s" % e
+                active = self.window_state(active, when)
+            self.accumulate(active, line)
+        finally:
+            state.end()
+    def parse_lines(self, lines):
+        """digests a list of lines in one go.  Lines that raise
+        LogtailerParsingException are skipped; the exceptions are returned
+        as a list so the caller can log them."""
+        for guard in self.line_guards:
+            lines = [line for line in lines if guard in line]
+        state = self.state
+        active = state.begin()
+        try:
+            if self.windowed:
+                return self.accumulate_windows(active, lines)
+            return self.accumulate_lines(active, lines)
+        finally:
+            state.end()
+    def accumulate_windows(self, windows, lines):
+        """digests a list of lines into the state buffers of their windows
+        (see use_event_time), a window's worth of lines at a time"""
+        errors = []
+        event_time = self.event_time
+        window_state = self.window_state
+        # id of state buffer -> (state buffer, lines)
+        batches = {}
+        for line in lines:
+            try:
+                when = event_time(line)
+            except ValueError, e:
+                errors.append(LogtailerParsingException("can't tell when line was logged: %s" % e))
+                continue
+            state = window_state(windows, when)
+            if id(state) in batches:
+                batches[id(state)][1].append(line)
+            else:
+                batches[id(state)] = (state, [line])
+        for (state, batch) in batches.itervalues():
+            errors.extend(self.accumulate_lines(state, batch))
+        return errors
+    def accumulate_lines(self, state, lines):
+        """digests a list of lines into the state buffer by calling
+        accumulate() on each of them, and returns the list of
+        LogtailerParsingExceptions raised by the lines that were skipped"""
+        errors = []
+        accumulate = self.accumulate
+        for line in lines:
+            try:
+                accumulate(state, line)
+            except LogtailerParsingException, e:
+                errors.append(e)
+        return errors
+    def reset_state(self):
+        self.state.swap()
+    def take_state(self):
+        """swaps in a fresh state buffer and returns the retired one, eg. to
+        hand it from a worker process to absorb_state"""
+        return self.state.swap()
+    def absorb_state(self, other):
+        """merges a state buffer taken from another instance of this plugin
+        into the live one."""
+        state = self.state
+        active = state.begin()
+        try:
+            self.merge_state(active, other)
+        finally:
+            state.end()
+    def set_check_duration(self, dur):
+        """only used in cron mode; get_check_duration will use this value
+        instead of calculating it."""
+        self.duration = dur
+        self.dur_override = True
+    def expect_duration(self, duration):
+        """only used in daemon mode; tells the next get_check_duration how
+        long it's really been since the last get_state (eg. two periods,
+        when the submitter missed a tick), to check against instead of
+        period."""
+        self.expected_duration = duration
+    def get_check_duration(self):
+        """returns the time since the last swap (or the value given to
+        set_check_duration).  raises LogtailerStateException in daemon mode
+        if that is more than 10% away from period (or from the duration
+        given to expect_duration)."""
+        if( self.dur_override ):
+            duration = self.duration
+        else:
+            duration = time.time() - self.state.last_swap_time
+            expected = self.expected_duration or self.period
+            self.expected_duration = None
+            # the duration should be within 10% of what was expected
+            acceptable_duration_min = expected - (expected / 10.0)
+            acceptable_duration_max = expected + (expected / 10.0)
+            if (duration < acceptable_duration_min or duration > acceptable_duration_max):
+                raise LogtailerStateException, "time calculation problem - duration (%s) > 10%% away from %s" % (duration, expected)
+        return duration
+    def get_state(self):
+        """swaps in a fresh state buffer and returns the list of metric
+        objects crunched from the retired one.  The swap happens even if the
+        duration is bad so the next period starts clean."""
+        if self.windowed:
+            return self.get_window_state()
+        try:
+            check_time = self.get_check_duration()
+        finally:
+            mydata = self.state.swap()
+        return self.crunch(mydata, check_time)
+    def get_window_state(self):
+        """get_state for use_event_time: returns the list of metric objects
+        crunched from the windows that have closed since the last call,
+        merged together.  raises LogtailerStateException if none have."""
+        arrived = self.state.swap()
+        windows = self.windows
+        for (start, state) in arrived.iteritems():
+            if start in windows:
+                self.merge_state(windows[start], state)
+            else:
+                windows[start] = state
+        if not windows:
+            raise LogtailerStateException, "no lines with a time to report on yet"
+        if self.reported_until is None:
+            self.reported_until = min(windows)
+        # a window closes once the lines are more than event_lateness past
+        # its end, or, if they've stopped coming, the clock is
+        latest = self.latest_event
+        if not arrived:
+            latest = max(latest, time.time())
+        closed = int((latest - self.event_lateness) // self.window * self.window)
+        if closed <= self.reported_until:
+            raise LogtailerStateException, "no window has closed since %s" % self.reported_until
+        mydata = self.new_state()
+        for start in sorted(windows):
+            if start < closed:
+                self.merge_state(mydata, windows.pop(start))
+        # the window starts are whole seconds; crunch divides by this
+        check_time = float(closed - self.reported_until)
+        self.reported_until = closed
+        return self.crunch(mydata, check_time)
 
 class LogtailerParsingException(Exception):
     """Raise this exception if the parse_line function wants to
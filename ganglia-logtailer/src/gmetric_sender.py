@@ -0,0 +1,142 @@
+#!/usr/bin/python
+"""send ganglia metrics in-process, without forking the gmetric binary
+
+The XDR packing is adapted from gmetric-python/gmetric.py (Nick Galbreath,
+Vladimir Vuksan, Adam Tygart; MIT license) and speaks the Ganglia 3.1 wire
+format: one metadata packet and one value packet per metric."""
+
+import re
+import socket
+from xdrlib import Packer
+
+slope_str2int = {'zero':0,
+                 'positive':1,
+                 'negative':2,
+                 'both':3,
+                 'unspecified':4}
+
+valid_types = ('string', 'int8', 'uint8', 'int16', 'uint16', 'int32',
+               'uint32', 'float', 'double', 'timestamp')
+
+def gmetric_write(NAME, VAL, TYPE, UNITS, SLOPE, TMAX, DMAX, GROUP, SPOOF, HOSTNAME):
+    """returns the (metadata, value) packet pair for one metric.
+    Arguments are in all upper-case to match XML"""
+    if SPOOF == "":
+        SPOOFENABLED = 0
+        host = HOSTNAME
+    else:
+        SPOOFENABLED = 1
+        host = SPOOF
+    # Meta data about a metric
+    packer = Packer()
+    packer.pack_int(128)
+    packer.pack_string(host)
+    packer.pack_string(NAME)
+    packer.pack_int(SPOOFENABLED)
+    packer.pack_string(TYPE)
+    packer.pack_string(NAME)
+    packer.pack_string(UNITS)
+    packer.pack_int(slope_str2int[SLOPE]) # map slope string to int
+    packer.pack_uint(int(TMAX))
+    packer.pack_uint(int(DMAX))
+    # Magic number. Indicates number of entries to follow. Put in 1 for GROUP
+    if GROUP == "":
+        packer.pack_int(0)
+    else:
+        packer.pack_int(1)
+        packer.pack_string("GROUP")
+        packer.pack_string(GROUP)
+
+    # Actual data sent in a separate packet
+    data = Packer()
+    data.pack_int(128+5)
+    data.pack_string(host)
+    data.pack_string(NAME)
+    data.pack_int(SPOOFENABLED)
+    data.pack_string("%s")
+    data.pack_string(str(VAL))
+
+    return ( packer.get_buffer(), data.get_buffer() )
+
+def get_send_channels(path):
+    """reads a gmond.conf and returns a list of (host, port, ttl) tuples, one
+    per udp_send_channel.  Multicast channels use their mcast_join address
+    as host.  raises IOError if the file can't be read and ValueError if a
+    channel is missing its address or port"""
+    data = open(path).read()
+    # strip comments so commented-out channels don't get picked up
+    data = re.sub(r'/\*.*?\*/', '', data, flags=re.S)
+    data = re.sub(r'(?m)(#|//).*$', '', data)
+    channels = []
+    for block in re.findall(r'udp_send_channel\s*\{([^}]*)\}', data):
+        settings = dict(re.findall(r'(\w+)\s*=\s*"?([^"\s]+)"?', block))
+        host = settings.get('mcast_join', settings.get('host'))
+        if host is None or 'port' not in settings:
+            raise ValueError("udp_send_channel in %s has no host or port" % path)
+        channels.append((host, int(settings['port']), int(settings.get('ttl', 1))))
+    return channels
+
+class GmetricSender(object):
+    """Sends GangliaMetricObjects to every udp_send_channel over one UDP
+    socket that is reused for the life of the process."""
+    def __init__(self, channels, group='', spoof='', slope='both'):
+        if not channels:
+            raise ValueError("no udp_send_channel to send metrics to")
+        if slope not in slope_str2int:
+            raise ValueError("slope must be one of: %s" % ', '.join(slope_str2int.keys()))
+        self.group = group
+        self.spoof = spoof
+        self.slope = slope
+        self.hostname = socket.gethostname()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # resolve once; a DNS lookup per packet would undo the point of this class
+        self.addresses = []
+        for (host, port, ttl) in channels:
+            address = socket.gethostbyname(host)
+            if 224 <= int(address.split('.')[0]) < 240:
+                self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+            self.addresses.append((address, port))
+
+    @classmethod
+    def from_gmetric_options(cls, gmetric_options):
+        """build a sender from the same option list that would be passed to
+        the gmetric binary (eg. ['-c', '/etc/ganglia/gmond.conf']).  raises
+        ValueError for options that gmetric takes but this sender doesn't
+        understand."""
+        conf = '/etc/ganglia/gmond.conf'
+        kwargs = {}
+        names = {'-c': 'conf', '--conf': 'conf',
+                 '-g': 'group', '--group': 'group',
+                 '-S': 'spoof', '--spoof': 'spoof',
+                 '-s': 'slope', '--slope': 'slope'}
+        options = list(gmetric_options)
+        while options:
+            option = options.pop(0)
+            if '=' in option and option.startswith('--'):
+                option, value = option.split('=', 1)
+            elif option in names and options:
+                value = options.pop(0)
+            else:
+                raise ValueError("gmetric option %s is not supported by the native sender" % option)
+            if option not in names:
+                raise ValueError("gmetric option %s is not supported by the native sender" % option)
+            if names[option] == 'conf':
+                conf = value
+            else:
+                kwargs[names[option]] = value
+        return cls(get_send_channels(conf), **kwargs)
+
+    def send(self, metric):
+        """send one GangliaMetricObject.  raises socket.error if the packets
+        can't be sent."""
+        if metric.type not in valid_types:
+            raise ValueError("metric %s has invalid type %s" % (metric.name, metric.type))
+        (meta_msg, data_msg) = gmetric_write(str(metric.name), metric.value,
+                str(metric.type), str(metric.units), self.slope, metric.tmax,
+                metric.dmax, self.group, self.spoof, self.hostname)
+        for address in self.addresses:
+            self.socket.sendto(meta_msg, address)
+            self.socket.sendto(data_msg, address)
+
+    def close(self):
+        self.socket.close()
@@ -0,0 +1,420 @@
+#!/usr/bin/python
+"""where ganglia-logtailer sends its metrics
+
+Each sink has a thread of its own and a bounded queue in front of it, so a
+slow or unreachable sink holds up neither the parsing nor the other sinks.
+Metrics are written in batches, over a connection that is kept open between
+batches; when a batch fails, the part of it that didn't get through is
+retried (after reconnecting) a few times and then dropped.  A full queue
+drops new metrics rather than waiting.  Every metric dropped, or refused by
+the destination, is counted.
+
+The sinks are
+    GmetricExecSink     runs the gmetric binary once per metric
+    GmetricSink         sends ganglia's XDR packets itself (see gmetric_sender)
+    CarbonSink          graphite's plaintext or pickle protocol, over TCP
+    StatsdSink          statsd gauges, over UDP
+    JsonSink            one JSON object per metric per line, to a file
+and sink_from_spec() makes one from a --sink argument."""
+
+import os
+import json
+import time
+import socket
+import struct
+import pickle
+import logging
+import threading
+import subprocess
+from Queue import Queue, Empty
+
+logger = logging.getLogger('ganglia_logtailer')
+
+class SinkError(Exception):
+    """Raised by a sink's write for a batch that didn't get through (and is
+    worth retrying).  sent is how many of the records (from the start) did
+    get through, so only the rest are retried."""
+    def __init__(self, message, sent=0):
+        Exception.__init__(self, message)
+        self.sent = sent
+
+class Sink(object):
+    """The queue and thread every sink has.  Subclasses define write(records),
+    which writes a list of records and returns the indexes of any the
+    destination refused (which aren't retried), or raises SinkError (or
+    EnvironmentError, taken to mean nothing got through).  They may define
+    close_connection(), called before a retry and on close.  A record is
+    (name, value, type, units, tmax, dmax, time), with the name already
+    prefixed."""
+    # metrics waiting to be written before new ones are dropped
+    queue_size = 10000
+    # most metrics to write at once
+    batch_size = 500
+    # times to retry a batch, and seconds to wait before each retry
+    retries = 3
+    retry_interval = 2
+    def __init__(self):
+        # (records, failed) pairs, where failed(count) is called for records
+        # that are dropped; None tells the thread to finish
+        self.queue = Queue()
+        # records queued and not yet written or dropped
+        self.queued = 0
+        self.queued_lock = threading.Lock()
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name=self.__class__.__name__)
+        # close() writes out what's queued; daemon mode doesn't wait for it
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    def submit(self, metrics, failed=None):
+        """queues a list of GangliaMetricObjects to be written, without
+        waiting.  failed, if given, is called with the number of them that
+        get dropped (possibly from the sink's thread)."""
+        now = int(time.time())
+        records = [ (m.name, m.value, m.type, m.units, m.tmax, m.dmax, now) for m in metrics ]
+        self.queued_lock.acquire()
+        try:
+            full = self.queued + len(records) > self.queue_size
+            if full:
+                self.dropped += len(records)
+            else:
+                self.queued += len(records)
+        finally:
+            self.queued_lock.release()
+        if full:
+            logger.warning( "%s is falling behind; dropped %d metrics" % (self, len(records)) )
+            if failed is not None:
+                failed(len(records))
+            return
+        self.queue.put((records, failed))
+
+    def take_batch(self):
+        """returns the next batch of (records, failed) pairs to write, and
+        whether close() has been called"""
+        batch = [self.queue.get()]
+        size = 0
+        while batch[-1] is not None:
+            size += len(batch[-1][0])
+            if size >= self.batch_size:
+                break
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        if batch[-1] is None:
+            return (batch[:-1], True)
+        return (batch, False)
+
+    def run(self):
+        while True:
+            (batch, closing) = self.take_batch()
+            if batch:
+                self.write_with_retries(batch)
+            if closing:
+                self.close_connection()
+                return
+
+    def write_with_retries(self, batch):
+        records = []
+        callbacks = []
+        for (submitted, failed) in batch:
+            records.extend(submitted)
+            callbacks.extend([failed] * len(submitted))
+        # records before this have been written (or refused)
+        unsent = 0
+        refused = []
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_interval)
+            try:
+                refused.extend([unsent + i for i in self.write(records[unsent:]) or ()])
+                unsent = len(records)
+                break
+            except (SinkError, EnvironmentError), e:
+                unsent += getattr(e, 'sent', 0)
+                logger.warning( "%s failed to write %d metrics (attempt %d): %s" % (self, len(records) - unsent, attempt + 1, e) )
+                try:
+                    self.close_connection()
+                except EnvironmentError:
+                    pass
+        self.lost(refused + range(unsent, len(records)), callbacks)
+        self.queued_lock.acquire()
+        self.queued -= len(records)
+        self.queued_lock.release()
+
+    def lost(self, indexes, callbacks):
+        """counts the records at indexes as dropped, telling the failed
+        callback each one was submitted with"""
+        # id of callback -> [callback, count]
+        counts = {}
+        for i in indexes:
+            counts.setdefault(id(callbacks[i]), [callbacks[i], 0])[1] += 1
+        self.queued_lock.acquire()
+        self.dropped += len(indexes)
+        self.queued_lock.release()
+        for (failed, count) in counts.values():
+            if failed is not None:
+                failed(count)
+
+    def close_connection(self):
+        pass
+
+    def close(self, timeout=None):
+        """writes out the metrics already queued (waiting at most timeout
+        seconds) and stops the thread.  Whatever is still queued after that
+        is counted as dropped."""
+        self.queue.put(None)
+        self.thread.join(timeout)
+        if not self.thread.isAlive():
+            return
+        # take back what the thread hasn't started on; the batch it's
+        # writing may yet get through, but the process won't wait for it
+        left = 0
+        while True:
+            try:
+                entry = self.queue.get_nowait()
+            except Empty:
+                break
+            if entry is None:
+                continue
+            (records, failed) = entry
+            left += len(records)
+            self.lost(range(len(records)), [failed] * len(records))
+        self.queued_lock.acquire()
+        self.queued -= left
+        self.queued_lock.release()
+        logger.warning( "%s didn't finish writing in %ss; dropped %d queued metrics (and %d being written)" %
+                        (self, timeout, left, self.queued) )
+
+class GmetricExecSink(Sink):
+    """Runs the gmetric binary for each metric, with gmetric_options (eg.
+    ['-c', '/etc/ganglia/gmond.conf']) added.  A metric gmetric fails on is
+    logged and counted, not retried."""
+    def __init__(self, gmetric, gmetric_options):
+        self.gmetric = gmetric
+        self.gmetric_options = gmetric_options
+        Sink.__init__(self)
+
+    def write(self, records):
+        refused = []
+        for (i, (name, value, type, units, tmax, dmax, when)) in enumerate(records):
+            call = [ self.gmetric,
+                     "--name", str(name),
+                     "--value", str(value),
+                     "--type", str(type),
+                     "--units", str(units),
+                     "--tmax", str(tmax),
+                     "--dmax", str(dmax)
+                     ] + self.gmetric_options
+            try:
+                status = subprocess.call(call)
+            except OSError, e:
+                raise SinkError(e, sent=i)
+            if ( status != 0 ):
+                logger.warning( "%s failed to send metric %s" % (self.gmetric, name) )
+                refused.append(i)
+        return refused
+
+class SinkMetric(object):
+    """The attributes of a GangliaMetricObject that GmetricSender reads
+    (name, value, type, units, tmax and dmax), for GmetricSink to refill
+    from each record rather than building a metric object per record."""
+    pass
+
+class GmetricSink(Sink):
+    """Sends the metrics with a GmetricSender, over its one UDP socket."""
+    def __init__(self, sender):
+        self.sender = sender
+        Sink.__init__(self)
+
+    def write(self, records):
+        # the sender takes GangliaMetricObjects, but only reads these
+        metric = SinkMetric()
+        refused = []
+        for (i, record) in enumerate(records):
+            (metric.name, metric.value, metric.type, metric.units, metric.tmax, metric.dmax, when) = record
+            try:
+                self.sender.send(metric)
+            except ValueError, e:
+                # nothing retrying would fix
+                logger.warning( "Failed to send metric %s: %s" % (metric.name, e) )
+                refused.append(i)
+            except socket.error, e:
+                raise SinkError(e, sent=i)
+        return refused
+
+class TCPSink(Sink):
+    """A sink that writes to a TCP connection, opened when it's first needed
+    and kept open until a write fails."""
+    def __init__(self, host, port, timeout=10):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.socket = None
+        Sink.__init__(self)
+
+    def __str__(self):
+        return '%s to %s:%s' % (self.__class__.__name__, self.address[0], self.address[1])
+
+    def connection(self):
+        if self.socket is None:
+            self.socket = socket.create_connection(self.address, self.timeout)
+        return self.socket
+
+    def close_connection(self):
+        if self.socket is not None:
+            sock = self.socket
+            self.socket = None
+            sock.close()
+
+class CarbonSink(TCPSink):
+    """Sends the metrics to a carbon daemon, with the plaintext protocol
+    (usually port 2003) or the pickle one (usually port 2004), as
+    <path_prefix>.<metric name>.  String metrics are left out; graphite only
+    keeps numbers.  Like graphite_integration/carbon_plugin.py, the points
+    are sent points_per_send at a time (each in a pickle of its own), so a
+    dropped connection only costs a retry of the points after the last
+    send that went through."""
+    points_per_send = 20
+    def __init__(self, host, port, protocol='plaintext', path_prefix=None, timeout=10):
+        if protocol not in ('plaintext', 'pickle'):
+            raise ValueError("unknown carbon protocol %s" % protocol)
+        if path_prefix is None:
+            path_prefix = 'logtailer.%s' % socket.gethostname().split('.')[0]
+        self.protocol = protocol
+        self.path_prefix = path_prefix
+        TCPSink.__init__(self, host, port, timeout)
+
+    def datapoints(self, records):
+        """returns (index, (path, (time, value))) for each record carbon can
+        store"""
+        points = []
+        for (i, (name, value, type, units, tmax, dmax, when)) in enumerate(records):
+            if type == 'string':
+                continue
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            points.append((i, ('%s.%s' % (self.path_prefix, name.replace(' ', '_')), (when, value))))
+        return points
+
+    def write(self, records):
+        points = self.datapoints(records)
+        sent = 0
+        for start in range(0, len(points), self.points_per_send):
+            chunk = [point for (i, point) in points[start:start + self.points_per_send]]
+            if self.protocol == 'pickle':
+                data = pickle.dumps(chunk, protocol=2)
+                data = struct.pack('!I', len(data)) + data
+            else:
+                data = ''.join(['%s %r %d\n' % (path, value, when) for (path, (when, value)) in chunk])
+            try:
+                self.connection().sendall(data)
+            except socket.error, e:
+                raise SinkError(e, sent=sent)
+            # records up to the next point carbon will get have been dealt with
+            if start + self.points_per_send < len(points):
+                sent = points[start + self.points_per_send][0]
+
+class StatsdSink(Sink):
+    """Sends the metrics to statsd as gauges (name:value|g), packed into
+    datagrams of up to max_packet bytes.  String metrics are left out."""
+    max_packet = 1400
+    def __init__(self, host, port):
+        self.address = (socket.gethostbyname(host), port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        Sink.__init__(self)
+
+    def __str__(self):
+        return '%s to %s:%s' % (self.__class__.__name__, self.address[0], self.address[1])
+
+    def write(self, records):
+        lines = []
+        # the first record in lines
+        first = 0
+        for (i, (name, value, type, units, tmax, dmax, when)) in enumerate(records):
+            if type == 'string':
+                continue
+            line = '%s:%s|g' % (name, value)
+            if lines and sum(map(len, lines)) + len(lines) + len(line) > self.max_packet:
+                self.send(lines, first)
+                (lines, first) = ([], i)
+            lines.append(line)
+        if lines:
+            self.send(lines, first)
+
+    def send(self, lines, first):
+        try:
+            self.socket.sendto('\n'.join(lines), self.address)
+        except socket.error, e:
+            raise SinkError(e, sent=first)
+
+class JsonSink(Sink):
+    """Appends each metric to a file as a line of JSON, eg.
+    {"name": "apache_hits", "value": 12.5, "type": "float", "units": "hps",
+     "tmax": 60, "dmax": 0, "time": 1270216800, "host": "web22"}
+    The file is reopened if it's rotated away."""
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.host = socket.gethostname()
+        Sink.__init__(self)
+
+    def __str__(self):
+        return '%s to %s' % (self.__class__.__name__, self.path)
+
+    def write(self, records):
+        if self.file is not None:
+            try:
+                if os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino:
+                    self.close_connection()
+            except OSError:
+                self.close_connection()
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        lines = []
+        for (name, value, type, units, tmax, dmax, when) in records:
+            lines.append(json.dumps(dict(name=name, value=value, type=type, units=units,
+                                         tmax=tmax, dmax=dmax, time=when, host=self.host),
+                                    sort_keys=True))
+        self.file.write('\n'.join(lines) + '\n')
+        self.file.flush()
+
+    def close_connection(self):
+        if self.file is not None:
+            f = self.file
+            self.file = None
+            f.close()
+
+def host_and_port(address, spec):
+    """splits HOST:PORT; raises ValueError if it isn't one"""
+    (host, sep, port) = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError("expected HOST:PORT in sink %s" % spec)
+    return (host, int(port))
+
+def sink_from_spec(spec):
+    """returns a sink for a --sink argument other than gmetric:
+        carbon:HOST:PORT          graphite's plaintext protocol
+        carbon-pickle:HOST:PORT   graphite's pickle protocol
+        statsd:HOST:PORT
+        json:PATH
+    raises ValueError if spec isn't one of those"""
+    (kind, sep, where) = spec.partition(':')
+    if not where:
+        raise ValueError("sink %s needs a destination, eg. %s:HOST:PORT" % (spec, kind))
+    if kind == 'carbon':
+        (host, port) = host_and_port(where, spec)
+        return CarbonSink(host, port)
+    if kind == 'carbon-pickle':
+        (host, port) = host_and_port(where, spec)
+        return CarbonSink(host, port, protocol='pickle')
+    if kind == 'statsd':
+        (host, port) = host_and_port(where, spec)
+        return StatsdSink(host, port)
+    if kind == 'json':
+        return JsonSink(where)
+    raise ValueError("unknown sink %s" % spec)
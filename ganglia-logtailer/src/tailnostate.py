@@ -1,10 +1,23 @@
 #!/usr/bin/python
 """Tail a file, reopening it if it gets rotated"""
 
-import time, os, sys, glob
+import time, os, sys, glob, re, stat
+import ctypes, errno, select, struct
+
+line_re = re.compile('[^\n]*\n')
+
+def split_lines(data):
+    """splits data into complete lines, each keeping its newline.  Only '\\n'
+    ends a line, as with file.readline().  returns (lines, leftover) where
+    leftover is the unterminated text after the last newline."""
+    end = data.rfind('\n') + 1
+    return (line_re.findall(data, 0, end), data[end:])
 
 
 class Tail(object):
+    # how much of the file to read at a time
+    read_block_size = 1024 * 1024
+
     def __init__(self, filename, start_pos=0):
         self.fp = file(filename)
         self.filename = filename
@@ -15,21 +28,47 @@ class Tail(object):
         else:
             self.fp.seek(start_pos)
             self.pos = start_pos
+        self.clear_buffer()
 
-    def __iter__(self):
-        """Return next line.  This function will sleep until there *is* a
-        next line.  Works over log rotation."""
-        counter = 0
+    def seek(self, pos):
+        self.fp.seek(pos)
+        self.pos = pos
+        self.clear_buffer()
+
+    def clear_buffer(self):
+        """forget anything read ahead from the file.  pos only counts lines
+        that have been handed out; the file offset is ahead of it by the
+        buffered lines and the partial line after them."""
+        self.lines = []
+        self.line_index = 0
+        self.partial = ''
+
+    def fill(self):
+        """reads blocks from the file until there's at least one new complete
+        line to hand out.  returns False if there isn't one yet."""
         while True:
-            line = self.next()
-            if line is None:
-                counter += 1
-                if counter >= 5:
-                    counter = 0
-                    self.check_inode()
-                time.sleep(1.0)
-            else:
-                yield line
+            data = os.read(self.fp.fileno(), self.read_block_size)
+            if not data:
+                return False
+            self.lines, self.partial = split_lines(self.partial + data)
+            self.line_index = 0
+            if self.lines:
+                return True
+
+    def __iter__(self):
+        """Return next line.  This function will block until there *is* a
+        next line, using inotify where it can.  Works over log rotation."""
+        watcher = TailWatcher([self])
+        try:
+            while True:
+                line = self.next()
+                if line is None:
+                    if not watcher.idle(self):
+                        watcher.wait()
+                else:
+                    yield line
+        finally:
+            watcher.close()
 
     def check_inode(self):
         """check to see if the filename we expect to tail has the same
@@ -39,62 +78,618 @@ class Tail(object):
         if inode != old_inode:
             self.fp = file(self.filename)
             self.pos = 0
+            self.clear_buffer()
 
     def next(self):
         """Return the next line from the file.  Returns None if there are not
         currently any lines available, at which point you should sleep before
         calling again.  Does *not* handle log rotation.  If you use next(), you
         must also use check_inode to handle log rotation"""
-        where = self.fp.tell()
-        line = self.fp.readline()
-        if line and line[-1] == '\n':
-            self.pos += len(line)
-            return line
-        else:
-            self.fp.seek(where)
+        if self.line_index >= len(self.lines) and not self.fill():
             return None
+        line = self.lines[self.line_index]
+        self.line_index += 1
+        self.pos += len(line)
+        return line
+
+    def read_lines(self, max_lines=10000):
+        """Return a list of the complete lines currently available, at most
+        max_lines of them.  Never blocks; an empty list means there is
+        nothing new yet.  Like next(), does *not* handle log rotation."""
+        if self.line_index >= len(self.lines) and not self.fill():
+            return []
+        lines = self.lines[self.line_index:self.line_index + max_lines]
+        self.line_index += len(lines)
+        self.pos += sum(map(len, lines))
+        return lines
+
+    def open_files(self):
+        """the files this tail has open"""
+        return [self.fp]
 
     def close(self):
         self.fp.close()
 
 
 
-class LogTail(Tail):
-    def __init__(self, filename):
-        self.base_filename = filename
-        super(LogTail, self).__init__(filename, -1)
+def read_offset_state(state_file):
+    """returns the (inode, offset) saved in a logtail(8) style state file, or
+    None if there isn't a readable one"""
+    try:
+        fh = open(state_file)
+        try:
+            inode, offset = fh.read().split()[:2]
+        finally:
+            fh.close()
+        return (int(inode), int(offset))
+    except (IOError, OSError, ValueError):
+        return None
 
-    def get_file(self, inode, next=False):
-        files = glob.glob('%s*' % self.base_filename)
-        files = [(os.stat(f).st_mtime, f) for f in files]
-        # Sort by modification time
-        files.sort()
+def write_offset_state(state_file, inode, offset):
+    """saves inode and offset in logtail(8)'s state file format.  The file is
+    written under a temporary name and renamed into place so a crash can't
+    leave a truncated state file behind."""
+    tmp_file = '%s.tmp' % state_file
+    fh = open(tmp_file, 'w')
+    try:
+        fh.write('%d\n%d\n' % (inode, offset))
+    finally:
+        fh.close()
+    os.rename(tmp_file, state_file)
 
-        flag = False
-        for mtime, f in files:
-            if flag:
-                return f
-            if os.stat(f).st_ino == inode:
-                if next:
-                    flag = True
+
+class OffsetTail(Tail):
+    """Reads everything appended to a log since the offset saved in a state
+    file, for cron mode.  If the log was rotated since the last run, the rest
+    of the rotated file (found by its inode, eg. log.1) is read first.  The
+    last, possibly half-written, line of the live file is left for next time.
+
+    read() works like file.read() so the caller can read in large blocks;
+    call save_state() once the data has been dealt with."""
+    rotated_suffixes = ('.1', '.0', '-*')
+
+    def __init__(self, filename, state_file):
+        self.state_file = state_file
+        self.sources = []
+        super(OffsetTail, self).__init__(filename, 0)
+        st = os.fstat(self.fp.fileno())
+        self.inode = st.st_ino
+        self.end = self.last_line_end(st.st_size)
+        state = read_offset_state(state_file)
+        if state is None:
+            # first run: start from the end rather than reading the whole log
+            self.pos = self.end
+        else:
+            inode, offset = state
+            if inode == self.inode:
+                if offset > st.st_size:
+                    # truncated in place (copytruncate); start over
+                    offset = 0
+                self.pos = offset
+                self.end = max(self.end, offset)
+            else:
+                rotated = self.find_rotated(inode)
+                if rotated is not None:
+                    self.sources.append((open(rotated), offset))
+        self.sources.append((self.fp, self.pos))
+        self.current = None
+
+    def find_rotated(self, inode):
+        """returns the name of the rotated (uncompressed) file with the given
+        inode, or None if it's gone"""
+        for suffix in self.rotated_suffixes:
+            for f in glob.glob(self.filename + suffix):
+                try:
+                    if os.stat(f).st_ino == inode and not f.endswith('.gz'):
+                        return f
+                except OSError:
+                    pass
+        return None
+
+    def last_line_end(self, size):
+        """returns the offset just past the last newline at or before size, so
+        a line that is still being written isn't read half-way"""
+        fd = self.fp.fileno()
+        start = max(0, size - 65536)
+        os.lseek(fd, start, 0)
+        tail = os.read(fd, size - start)
+        cut = tail.rfind('\n')
+        if cut == -1:
+            # no newline in the last 64k; don't hold back a line that long
+            return size
+        return start + cut + 1
+
+    def read(self, size):
+        """returns up to size bytes of unread data, or '' when there is none left"""
+        while self.sources:
+            if self.current is None:
+                fp, start = self.sources[0]
+                os.lseek(fp.fileno(), start, 0)
+                self.current = fp
+            fp = self.current
+            if fp is self.fp:
+                # don't read past the last complete line of the live file
+                size = min(size, self.end - self.pos)
+                if size > 0:
+                    data = os.read(fp.fileno(), size)
                 else:
-                    return f
+                    data = ''
+                self.pos += len(data)
+            else:
+                data = os.read(fp.fileno(), size)
+            if data:
+                return data
+            if fp is not self.fp:
+                fp.close()
+            self.sources.pop(0)
+            self.current = None
+        return ''
+
+    def ranges(self):
+        """returns the unread data as a list of (fileno, start, end) byte
+        ranges, oldest first, for reading some other way than read() (eg. in
+        several processes at once).  Call consume() afterwards."""
+        ranges = []
+        for (fp, start) in self.sources:
+            if fp is self.fp:
+                end = self.end
+            else:
+                end = os.fstat(fp.fileno()).st_size
+            if end > start:
+                ranges.append((fp.fileno(), start, end))
+        return ranges
+
+    def consume(self):
+        """mark everything ranges() returned as read"""
+        for (fp, start) in self.sources:
+            if fp is not self.fp:
+                fp.close()
+        self.sources = []
+        self.current = None
+        self.pos = max(self.pos, self.end)
+
+    def save_state(self):
+        """record how far we've read in the state file"""
+        write_offset_state(self.state_file, self.inode, self.pos)
+
+
+class RotatedFiles(object):
+    """A log and the files it has been rotated to (log.1, log-20160101, ...),
+    oldest first and indexed by inode.  The directory is only rescanned when
+    its mtime changes, which every rename or create does, so following a
+    rotation doesn't glob and stat every old log each time."""
+    # compressed logs can't be tailed
+    compressed_suffixes = ('.gz', '.bz2', '.xz', '.Z', '.zst')
+
+    def __init__(self, base_filename):
+        self.base_filename = base_filename
+        self.directory = os.path.dirname(os.path.abspath(base_filename))
+        self.prefix = os.path.basename(base_filename)
+        self.dir_mtime = None
+        # [(name, inode)], oldest first; the live log is always last
+        self.files = []
+        self.by_inode = {}
+
+    def refresh(self, force=False):
+        """rescan the directory if it has changed since the last scan"""
+        try:
+            mtime = os.stat(self.directory).st_mtime
+        except OSError:
+            return
+        if mtime == self.dir_mtime and not force:
+            return
+        self.dir_mtime = mtime
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.startswith(self.prefix) or name.endswith(self.compressed_suffixes):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            if name == self.prefix:
+                files.append((True, st.st_mtime, self.base_filename, st.st_ino))
+            else:
+                files.append((False, st.st_mtime, path, st.st_ino))
+        files.sort()
+        self.files = [(path, inode) for (live, mtime, path, inode) in files]
+        self.by_inode = dict((inode, i) for (i, (path, inode)) in enumerate(self.files))
+
+    def successor(self, inode):
+        """returns the (name, inode) of the file written after the one with
+        the given inode: the next rotated file if there is one, otherwise the
+        live log (whose inode is None if it's not been seen yet)."""
+        self.refresh()
+        if inode not in self.by_inode:
+            # mtimes can be coarser than the renames; make sure
+            self.refresh(force=True)
+        i = self.by_inode.get(inode)
+        if i is None or i + 1 >= len(self.files):
+            return (self.base_filename, None)
+        return self.files[i + 1]
+
+
+class LogTail(Tail):
+    """Tails a log across rotations.  Once the file being read has been
+    rotated away and read dry, LogTail moves on to the file written after it:
+    the next rotated file if it has fallen behind, otherwise the live log.
+    The file it leaves stays open for retire_grace seconds, and any lines
+    still written to it in that time are handed out too.
+
+    Given a state file, LogTail saves the inode and offset it has reached
+    there (at most every checkpoint_interval seconds, and on save_state())
+    and picks up from that point when it's next started, reading the rest
+    of the file it was on first if the log was rotated in the meantime.
+    Without one, or the first time, it starts at the end of the log."""
+    retire_grace = 60
+    checkpoint_interval = 10
+
+    def __init__(self, filename, state_file=None):
+        self.base_filename = filename
+        self.rotated = RotatedFiles(filename)
+        # [fp, lines, partial, deadline] for each file moved on from
+        self.retired = []
+        self.state_file = state_file
+        self.saved_state = None
+        self.next_checkpoint = time.time() + self.checkpoint_interval
+        state = None
+        if state_file is not None:
+            state = read_offset_state(state_file)
+        if state is None:
+            super(LogTail, self).__init__(filename, -1)
         else:
-            return self.base_filename
+            super(LogTail, self).__init__(filename, 0)
+            self.resume(*state)
+            self.saved_state = state
+
+    def resume(self, inode, offset):
+        """carry on from offset in the file with the given inode"""
+        st = os.fstat(self.fp.fileno())
+        if st.st_ino == inode:
+            if offset <= st.st_size:
+                self.seek(offset)
+            # otherwise it was truncated in place; start over
+            return
+        self.rotated.refresh()
+        i = self.rotated.by_inode.get(inode)
+        if i is None:
+            # rotated away and compressed or deleted since; all we can do
+            # is read everything written to the live log
+            return
+        filename = self.rotated.files[i][0]
+        fp = file(filename)
+        if os.fstat(fp.fileno()).st_ino != inode:
+            fp.close()
+            return
+        self.fp.close()
+        self.fp = fp
+        self.filename = filename
+        self.seek(offset)
 
     def reset(self):
         self.fp = file(self.filename)
         self.pos = 0
+        self.clear_buffer()
 
     def advance(self):
-        self.filename = self.get_file(os.fstat(self.fp.fileno()).st_ino, True)
-        self.reset()
+        """move on to the file written after the current one.  raises
+        EnvironmentError, leaving the current file as it is, if that can't
+        be opened or keeps being renamed under us."""
+        inode = os.fstat(self.fp.fileno()).st_ino
+        # open the next file before retiring this one: if that fails, this
+        # one has to stay current rather than be read both as the current
+        # file and as a retired one
+        for attempt in (1, 2):
+            (filename, next_inode) = self.rotated.successor(inode)
+            fp = file(filename)
+            if next_inode is None or os.fstat(fp.fileno()).st_ino == next_inode:
+                break
+            # renamed again since the last scan
+            fp.close()
+            self.rotated.refresh(force=True)
+        else:
+            raise IOError("%s is being renamed too fast to follow" % filename)
+        self.retire()
+        self.filename = filename
+        self.fp = fp
+        self.pos = 0
+        self.clear_buffer()
+
+    def retire(self):
+        """keep the current file open for a while; the writer may not have
+        reopened its log yet"""
+        self.retired.append([self.fp, self.lines[self.line_index:], self.partial,
+                             time.time() + self.retire_grace])
+
+    def read_retired(self, max_lines):
+        """returns up to max_lines lines written to files we've moved on
+        from.  Files whose grace period is over are closed once read dry."""
+        for entry in list(self.retired):
+            (fp, lines, partial, deadline) = entry
+            if not lines:
+                data = os.read(fp.fileno(), self.read_block_size)
+                if data:
+                    (lines, entry[2]) = split_lines(partial + data)
+            if lines:
+                entry[1] = lines[max_lines:]
+                return lines[:max_lines]
+            entry[1] = lines
+            if time.time() >= deadline:
+                fp.close()
+                self.retired.remove(entry)
+        return []
+
+    def next(self):
+        if self.retired:
+            lines = self.read_retired(1)
+            if lines:
+                return lines[0]
+        return super(LogTail, self).next()
+
+    def read_lines(self, max_lines=10000):
+        lines = []
+        if self.retired:
+            lines = self.read_retired(max_lines)
+        if not lines:
+            lines = super(LogTail, self).read_lines(max_lines)
+        self.checkpoint()
+        return lines
+
+    def checkpoint(self):
+        """save_state(), if checkpoint_interval has passed since the last
+        time.  Failures are left for the next checkpoint to retry."""
+        if self.state_file is None or time.time() < self.next_checkpoint:
+            return
+        self.next_checkpoint = time.time() + self.checkpoint_interval
+        try:
+            self.save_state()
+        except EnvironmentError:
+            pass
+
+    def save_state(self):
+        """record how far we've read in the state file, if it has changed.
+        Lines still to come from retired files aren't covered."""
+        state = (os.fstat(self.fp.fileno()).st_ino, self.pos)
+        if self.state_file is None or state == self.saved_state:
+            return
+        write_offset_state(self.state_file, *state)
+        self.saved_state = state
+
+    def lag(self):
+        """returns how many bytes of the log are still to be read: the rest
+        of the file being read, plus the files written after it if that's a
+        rotated one.  Lines still to come from retired files aren't
+        counted."""
+        st = os.fstat(self.fp.fileno())
+        lag = st.st_size - self.pos
+        if self.filename != self.base_filename:
+            self.rotated.refresh()
+            i = self.rotated.by_inode.get(st.st_ino)
+            if i is None:
+                later = [self.base_filename]
+            else:
+                later = [path for (path, inode) in self.rotated.files[i + 1:]]
+            for path in later:
+                try:
+                    lag += os.stat(path).st_size
+                except OSError:
+                    pass
+        return max(lag, 0)
+
+    def open_files(self):
+        return [self.fp] + [entry[0] for entry in self.retired]
 
     def check_inode(self):
         if self.filename != self.base_filename or os.stat(self.filename).st_ino != os.fstat(self.fp.fileno()).st_ino:
             self.advance()
 
 
+# inotify(7) event bits
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+
+class Inotify(object):
+    """A minimal ctypes binding to linux's inotify.  Raises OSError if
+    inotify isn't available."""
+    event_header = struct.Struct('iIII')
+
+    def __init__(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        try:
+            init1 = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """watch path for the events in mask.  returns the watch descriptor,
+        which is the same for every path naming the same inode"""
+        wd = self._add_watch(self.fd, path, mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def rm_watch(self, wd):
+        # fails harmlessly if the kernel already dropped the watch
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """returns the list of pending (wd, mask, name) events without
+        blocking"""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            i = 0
+            while i < len(data):
+                wd, mask, cookie, length = self.event_header.unpack_from(data, i)
+                i += self.event_header.size
+                events.append((wd, mask, data[i:i+length].rstrip('\0')))
+                i += length
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class TailWatcher(object):
+    """Waits until any of a set of tails may have something new to read.
+
+    With inotify, each tail's open file is watched for writes and for being
+    moved or unlinked, and its directory for a new file taking its name, so
+    an idle tail costs nothing and rotation is noticed straight away.
+    Without inotify (or with use_inotify=False, eg. for logs on NFS) wait()
+    sleeps for poll_interval and idle tails are checked for rotation every
+    check_interval seconds, as Tail.__iter__ always did.
+
+    After reading a tail dry, call idle() on it so a rotated tail moves on to
+    its new file."""
+    file_mask = IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF
+    dir_mask = IN_CREATE | IN_MOVED_TO
+
+    def __init__(self, tails=(), poll_interval=1.0, check_interval=5, use_inotify=True):
+        self.poll_interval = poll_interval
+        self.check_interval = check_interval
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except OSError:
+                pass
+        # watch descriptor -> the tails it wakes (two plugins may share a log)
+        self.file_watches = {}
+        self.dir_watches = {}
+        self.watched_files = {}
+        self.tails = []
+        # tails inotify saw rotated, waiting to be read dry
+        self.rotated = set()
+        # polling mode: when each tail is next checked for rotation
+        self.next_check = {}
+        for tail in tails:
+            self.add(tail)
+
+    def add(self, tail):
+        self.tails.append(tail)
+        self.next_check[tail] = time.time() + self.check_interval
+        if tail.filename != getattr(tail, 'base_filename', tail.filename):
+            # resumed in a rotated file; no event will say it has moved on
+            self.rotated.add(tail)
+        if self.inotify is None:
+            return
+        name = getattr(tail, 'base_filename', tail.filename)
+        try:
+            wd = self.inotify.add_watch(os.path.dirname(os.path.abspath(name)) or '/', self.dir_mask)
+            self.dir_watches.setdefault(wd, set()).add(tail)
+            self.watch_files(tail)
+        except OSError:
+            # out of watches, most likely; polling still works
+            self.fall_back()
+
+    def fall_back(self):
+        self.inotify.close()
+        self.inotify = None
+        self.file_watches = {}
+        self.dir_watches = {}
+        self.watched_files = {}
+
+    def watch_files(self, tail):
+        """watch the files tail has open, which after a rename are no longer
+        the files their names point to"""
+        for (wd, tails) in self.file_watches.items():
+            if tail in tails:
+                tails.discard(tail)
+                if not tails:
+                    del self.file_watches[wd]
+                    self.inotify.rm_watch(wd)
+        self.watched_files[tail] = tail.open_files()
+        for fp in self.watched_files[tail]:
+            wd = self.inotify.add_watch('/proc/self/fd/%d' % fp.fileno(), self.file_mask)
+            self.file_watches.setdefault(wd, set()).add(tail)
+
+    def rewatch(self, tail):
+        if self.inotify is None:
+            return
+        try:
+            self.watch_files(tail)
+        except OSError:
+            self.fall_back()
+
+    def wait(self, timeout=None):
+        """blocks until one of the tails may have new lines, or for at most
+        timeout seconds (None waits for ever).  When polling this just
+        sleeps for poll_interval."""
+        if self.inotify is None:
+            time.sleep(self.poll_interval)
+            return
+        readable = select.select([self.inotify], [], [], timeout)[0]
+        if not readable:
+            return
+        for (wd, mask, name) in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # lost events; check everything
+                self.rotated.update(self.tails)
+            elif wd in self.file_watches:
+                if mask & (IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF):
+                    self.rotated.update(self.file_watches[wd])
+            elif wd in self.dir_watches:
+                for tail in self.dir_watches[wd]:
+                    if name == os.path.basename(getattr(tail, 'base_filename', tail.filename)):
+                        self.rotated.add(tail)
+
+    def idle(self, tail):
+        """call when tail has no more lines.  Moves it on to a new file if its
+        log was rotated.  returns True if it did."""
+        if self.inotify is not None and tail.open_files() != self.watched_files.get(tail):
+            # a file it was keeping open after a rotation has been closed
+            self.rewatch(tail)
+        if self.inotify is None:
+            if time.time() < self.next_check[tail]:
+                return False
+            self.next_check[tail] = time.time() + self.check_interval
+        elif tail not in self.rotated:
+            return False
+        inode = os.fstat(tail.fp.fileno()).st_ino
+        try:
+            tail.check_inode()
+        except EnvironmentError:
+            # renamed away but not replaced yet; its replacement will wake us
+            return False
+        self.rotated.discard(tail)
+        if os.fstat(tail.fp.fileno()).st_ino == inode:
+            return False
+        self.rewatch(tail)
+        return True
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
 def main():
     import sys
 
@@ -0,0 +1,43 @@
+#!/usr/bin/python
+"""tests for BufferedLogtailer's daemon mode bookkeeping
+
+run from the ganglia-logtailer directory with
+    python -m unittest discover -s tests"""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ganglia_logtailer_helper import LogtailerStateException
+from SlapdLogtailer import SlapdLogtailer
+
+LINE = 'Oct 27 13:34:30 ldap0.lindenlab.com slapd[16533]: conn=0 fd=18 ACCEPT from IP=216.82.33.42:60976 (IP=0.0.0.0:636)\n'
+
+class MissedTickTest(unittest.TestCase):
+    def setUp(self):
+        self.parser = SlapdLogtailer()
+        self.parser.period = 10
+        self.parser.parse_lines([LINE] * 202)
+        # the submitter missed a tick, so it's been two periods since the
+        # last get_state
+        self.parser.state.last_swap_time = time.time() - 20.2
+
+    def test_unexpected_duration_is_rejected(self):
+        self.assertRaises(LogtailerStateException, self.parser.get_state)
+
+    def test_expected_duration_is_reported(self):
+        self.parser.expect_duration(20.2)
+        [metric] = self.parser.get_state()
+        self.assertAlmostEqual(metric.value, 10, places=1)
+
+    def test_expectation_only_lasts_one_period(self):
+        self.parser.expect_duration(20.2)
+        self.parser.get_state()
+        self.parser.state.last_swap_time = time.time() - 20.2
+        self.assertRaises(LogtailerStateException, self.parser.get_state)
+
+if __name__ == '__main__':
+    unittest.main()
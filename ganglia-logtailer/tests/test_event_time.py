@@ -0,0 +1,87 @@
+#!/usr/bin/python
+"""tests for counting lines by when they were logged (use_event_time)
+
+run from the ganglia-logtailer directory with
+    python -m unittest discover -s tests"""
+
+import os
+import sys
+import time
+import calendar
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ganglia_logtailer_helper import LogtailerParsingException, LogtailerStateException
+from ApacheLogtailer import ApacheLogtailer
+from SlapdLogtailer import SlapdLogtailer
+from VarnishMemcacheLogtailer import VarnishMemcacheLogtailer
+
+TOMCAT_FORMAT = '%h %l %u %t "%r" %s %b %D'
+# the start of a minute
+START = calendar.timegm((2010, 4, 2, 14, 20, 0, 0, 0, 0))
+
+def line(when):
+    stamp = time.strftime('%d/%b/%Y:%H:%M:%S +0000', time.gmtime(when))
+    return '10.0.1.31 - - [%s] "GET /status HTTP/1.0" 200 512 1234\n' % stamp
+
+def hits(metrics):
+    return dict((metric.name, metric.value) for metric in metrics)['apache_hits']
+
+class EventTimeTest(unittest.TestCase):
+    def setUp(self):
+        self.parser = ApacheLogtailer()
+        self.parser.configure({'log_format': TOMCAT_FORMAT})
+        self.parser.period = 60
+        self.parser.use_event_time(lateness=30)
+
+    def test_closed_windows_are_reported_together(self):
+        # 60 lines in the first minute, 120 in the second, then one 20s
+        # into the fourth, which closes the first two
+        lines = [line(START + i) for i in range(60)]
+        lines += [line(START + 60 + i // 2) for i in range(120)]
+        lines.append(line(START + 200))
+        self.assertEqual(self.parser.parse_lines(lines), [])
+        self.assertAlmostEqual(hits(self.parser.get_state()), 180 / 120.0)
+        self.assertEqual(self.parser.reported_until, START + 120)
+        # the third minute is still open
+        self.assertEqual(sorted(self.parser.windows), [START + 180])
+
+    def test_no_window_closed_yet(self):
+        self.parser.parse_lines([line(START), line(START + 70)])
+        self.assertRaises(LogtailerStateException, self.parser.get_state)
+        # the lines are kept for the next report
+        self.parser.parse_lines([line(START + 150)])
+        self.assertAlmostEqual(hits(self.parser.get_state()), 2 / 120.0)
+
+    def test_late_lines_go_in_the_next_report(self):
+        self.parser.parse_lines([line(START + i) for i in range(60)] + [line(START + 100)])
+        self.assertAlmostEqual(hits(self.parser.get_state()), 1.0)
+        self.parser.parse_lines([line(START + 10)] * 3 + [line(START + 160)])
+        self.assertEqual(self.parser.late_lines, 3)
+        self.assertAlmostEqual(hits(self.parser.get_state()), 4 / 60.0)
+
+    def test_parse_line_matches_parse_lines(self):
+        for when in (START, START + 1, START + 61, START + 100):
+            self.parser.parse_line(line(when))
+        # the first minute closed; the second is still open
+        self.assertAlmostEqual(hits(self.parser.get_state()), 2 / 60.0)
+
+    def test_unparseable_time_is_skipped(self):
+        errors = self.parser.parse_lines([line(START), line(START).replace('Apr', 'Foo'), line(START + 100)])
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(isinstance(errors[0], LogtailerParsingException))
+        self.assertRaises(LogtailerParsingException, self.parser.parse_line, line(START).replace('Apr', 'Foo'))
+
+    def test_plugins_that_cant(self):
+        # no event_time
+        self.assertRaises(ValueError, SlapdLogtailer().use_event_time)
+        # not mergeable, like VarnishMemcacheLogtailer
+        parser = ApacheLogtailer()
+        parser.configure({'log_format': TOMCAT_FORMAT})
+        parser.mergeable = False
+        self.assertRaises(ValueError, parser.use_event_time)
+        self.assertFalse(VarnishMemcacheLogtailer.mergeable)
+
+if __name__ == '__main__':
+    unittest.main()
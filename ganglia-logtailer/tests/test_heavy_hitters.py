@@ -0,0 +1,69 @@
+#!/usr/bin/python
+"""tests for HeavyHitterTable
+
+run from the ganglia-logtailer directory with
+    python -m unittest discover -s tests"""
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ganglia_logtailer_helper import HeavyHitterTable
+
+def blank_stats():
+    return {'hits': 0}
+
+def count(table, keys):
+    for key in keys:
+        stats = table.hit(key)
+        if stats is None:
+            stats = table.admit(key, blank_stats())
+        stats['hits'] += 1
+
+class HeavyHitterTableTest(unittest.TestCase):
+    def test_lowest_count_is_evicted(self):
+        table = HeavyHitterTable(2, blank_stats())
+        count(table, ['a', 'a', 'a', 'b', 'c'])
+        self.assertEqual(sorted(table.entries), ['a', 'c'])
+        self.assertEqual(table.other, {'hits': 1})
+        # c inherits b's count as its possible error
+        self.assertEqual((table.counts['c'], table.errors['c']), (2, 1))
+        self.assertEqual(table.evictions, 1)
+
+    def test_no_hits_are_lost(self):
+        table = HeavyHitterTable(5, blank_stats())
+        rand = random.Random(1)
+        count(table, ['k%d' % rand.randint(0, 50) for i in range(2000)])
+        self.assertEqual(table.total, 2000)
+        self.assertEqual(sum([stats['hits'] for stats in table.entries.values()]) + table.other['hits'], 2000)
+        self.assertEqual(table.floor, min(table.counts.values()))
+
+    def test_heavy_hitters_are_kept(self):
+        # a and b have over 1/capacity of the hits each, among many one-offs
+        table = HeavyHitterTable(10, blank_stats())
+        keys = []
+        for i in range(1000):
+            keys.extend(['a', 'a', 'b', 'x%d' % i])
+        count(table, keys)
+        self.assertEqual([key for (key, hits) in table.top(2)], ['a', 'b'])
+        (hot, other) = table.hot_and_other(0.2)
+        self.assertEqual(sorted([key for (key, stats) in hot]), ['a', 'b'])
+        self.assertEqual(other['hits'] + sum([stats['hits'] for (key, stats) in hot]), 4000)
+
+    def test_merge(self):
+        tables = (HeavyHitterTable(3, blank_stats()), HeavyHitterTable(3, blank_stats()))
+        count(tables[0], ['a'] * 5 + ['b'] * 2 + ['c'])
+        count(tables[1], ['a'] * 3 + ['d'] * 4 + ['e'])
+        tables[0].merge(tables[1])
+        table = tables[0]
+        self.assertEqual(len(table.entries), 3)
+        self.assertEqual(table.total, 16)
+        self.assertEqual(table.entries['a'], {'hits': 8})
+        self.assertEqual(table.entries['d'], {'hits': 4})
+        self.assertEqual(sum([stats['hits'] for stats in table.entries.values()]) + table.other['hits'], 16)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+"""tests for the HTTP plugins and the FieldExtractors they parse with
+
+run from the ganglia-logtailer directory with
+    python -m unittest discover -s tests"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ganglia_logtailer_helper import LogtailerParsingException
+from ApacheLogtailer import ApacheLogtailer
+from ApacheVHostLogtailer import ApacheVHostLogtailer
+
+TOMCAT_FORMAT = '%h %l %u %t "%r" %s %b %D'
+TOMCAT_LINE = '10.0.1.31 - - [08/Jul/2013:12:44:19 -0400] "GET /status HTTP/1.0" 200 512 1234\n'
+
+class MalformedBracketTest(unittest.TestCase):
+    def setUp(self):
+        self.parser = ApacheLogtailer()
+        self.parser.configure({'log_format': TOMCAT_FORMAT})
+
+    def test_match_returns_none(self):
+        self.assertEqual(self.parser.fields.match('10.0.1.31 - - [08/Jul/2013:12:44:19 -0400 "GET /'), None)
+        self.assertRaises(ValueError, self.parser.fields.extract, '10.0.1.31 - - [08/Jul/2013:12:44:19')
+
+    def test_parse_lines_skips_unclosed_bracket(self):
+        lines = [TOMCAT_LINE, '10.0.1.31 - - [08/Jul/2013:12:44:19 -0400 "GET /\n', TOMCAT_LINE]
+        errors = self.parser.parse_lines(lines)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(isinstance(errors[0], LogtailerParsingException))
+        self.assertEqual(self.parser.state.swap()['num_two'], 2)
+
+class StatusFieldTest(unittest.TestCase):
+    def test_apache_with_documented_format(self):
+        # the ApacheLogtailer example in the README, which logs %>s
+        parser = ApacheLogtailer()
+        parser.configure({'log_format': '%h %l %u %t "%r" %>s %b %D'})
+        errors = parser.parse_lines([TOMCAT_LINE,
+                                     TOMCAT_LINE.replace(' 200 ', ' 503 ')])
+        self.assertEqual(errors, [])
+        state = parser.state.swap()
+        self.assertEqual((state['num_two'], state['num_five']), (1, 1))
+
+    def test_vhost_with_init_status(self):
+        parser = ApacheVHostLogtailer()
+        parser.configure({'log_format': '%v %h %l %u %t "%r" %s %b %D'})
+        self.assertEqual(parser.parse_lines(['www.example.com ' + TOMCAT_LINE]), [])
+
+class VHostOtherTest(unittest.TestCase):
+    def test_vhost_called_other_is_kept(self):
+        parser = ApacheVHostLogtailer()
+        parser.configure({'log_format': '%v %h %l %u %t "%r" %s %b %D'})
+        parser.parse_lines(['other ' + TOMCAT_LINE] * 3 + ['www.example.com ' + TOMCAT_LINE] * 3)
+        metrics = dict((metric.name, metric.value) for metric in parser.crunch(parser.state.swap(), 1))
+        self.assertEqual(metrics['apache_other_hits'], 3)
+        self.assertEqual(metrics['apache_www.example.com_hits'], 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+"""tests for HyperLogLog
+
+run from the ganglia-logtailer directory with
+    python -m unittest discover -s tests"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ganglia_logtailer_helper import HyperLogLog
+
+def addresses(start, stop):
+    return ['10.%d.%d.%d' % (i >> 16, (i >> 8) & 255, i & 255) for i in xrange(start, stop)]
+
+class HyperLogLogTest(unittest.TestCase):
+    def assertEstimate(self, hll, expected):
+        # three standard errors of the default precision
+        self.assertTrue(abs(hll.count() - expected) <= expected * 0.05,
+                        "estimated %s for %s" % (hll.count(), expected))
+
+    def test_empty(self):
+        self.assertEqual(HyperLogLog().count(), 0)
+
+    def test_accuracy(self):
+        for count in (10, 1000, 20000, 100000):
+            hll = HyperLogLog()
+            hll.update(addresses(0, count))
+            self.assertEstimate(hll, count)
+
+    def test_small_counts_are_near_exact(self):
+        hll = HyperLogLog()
+        for value in addresses(0, 50):
+            hll.add(value)
+        self.assertEqual(round(hll.count()), 50)
+
+    def test_duplicates_count_once(self):
+        hll = HyperLogLog()
+        for i in range(5):
+            hll.update(addresses(0, 10000))
+            # and past the fold, not just in the pending set
+            hll.fold()
+        self.assertEstimate(hll, 10000)
+
+    def test_merge_counts_the_union(self):
+        (a, b) = (HyperLogLog(), HyperLogLog())
+        a.update(addresses(0, 30000))
+        b.update(addresses(20000, 50000))
+        # some still pending in b
+        b.update(addresses(0, 100))
+        a.merge(b)
+        self.assertEstimate(a, 50000)
+
+    def test_merge_needs_same_precision(self):
+        self.assertRaises(ValueError, HyperLogLog(12).merge, HyperLogLog(10))
+
+    def test_fixed_size(self):
+        hll = HyperLogLog(precision=10)
+        hll.update(addresses(0, 50000))
+        hll.fold()
+        self.assertEqual(len(hll.registers), 1024)
+        self.assertEqual(len(hll.pending), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+"""tests for the sinks' retries and failure counting
+
+run from the ganglia-logtailer directory with
+    python -m unittest discover -s tests"""
+
+import os
+import sys
+import time
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ganglia_logtailer_helper import GangliaMetricObject
+import metric_sinks
+
+logging.getLogger('ganglia_logtailer').addHandler(logging.NullHandler())
+
+def metrics(count):
+    return [GangliaMetricObject('m%d' % i, i) for i in range(count)]
+
+class FlakySink(metric_sinks.Sink):
+    '''gets the first three records through, then fails once'''
+    retry_interval = 0
+    def __init__(self):
+        self.written = []
+        self.failures = 1
+        metric_sinks.Sink.__init__(self)
+    def write(self, records):
+        if self.failures:
+            self.failures -= 1
+            self.written.extend(records[:3])
+            raise metric_sinks.SinkError('connection reset', sent=3)
+        self.written.extend(records)
+
+class SlowSink(metric_sinks.Sink):
+    batch_size = 1
+    def write(self, records):
+        time.sleep(0.5)
+
+class SinkTest(unittest.TestCase):
+    def setUp(self):
+        self.failures = []
+
+    def test_retry_sends_only_the_rest(self):
+        sink = FlakySink()
+        sink.submit(metrics(10), self.failures.append)
+        sink.close(5)
+        self.assertEqual([record[0] for record in sink.written], ['m%d' % i for i in range(10)])
+        self.assertEqual(self.failures, [])
+
+    def test_gmetric_failures_are_counted(self):
+        sink = metric_sinks.GmetricExecSink('/bin/false', [])
+        sink.submit(metrics(2), self.failures.append)
+        sink.close(5)
+        self.assertEqual(self.failures, [2])
+
+    def test_metrics_left_at_close_are_counted(self):
+        sink = SlowSink()
+        for i in range(4):
+            sink.submit(metrics(1), self.failures.append)
+        sink.close(0.2)
+        # the first is still being written
+        self.assertEqual(sum(self.failures), 3)
+        self.assertEqual(sink.dropped, 3)
+
+    def test_close_without_timeout_waits(self):
+        sink = SlowSink()
+        for i in range(3):
+            sink.submit(metrics(1), self.failures.append)
+        sink.close()
+        self.assertEqual(self.failures, [])
+        self.assertEqual((sink.queued, sink.dropped), (0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
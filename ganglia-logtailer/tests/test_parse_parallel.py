@@ -0,0 +1,92 @@
+#!/usr/bin/python
+"""tests for splitting a cron mode backlog between worker processes
+
+run from the ganglia-logtailer directory with
+    python -m unittest discover -s tests"""
+
+import os
+import sys
+import imp
+import shutil
+import tempfile
+import unittest
+
+src = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, src)
+
+from tailnostate import OffsetTail, write_offset_state
+
+LINE = 'Oct 27 13:34:30 ldap0.lindenlab.com slapd[16533]: conn=%d fd=18 ACCEPT from IP=216.82.33.42:60976 (IP=0.0.0.0:636)\n'
+
+def load_driver():
+    dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = True
+    try:
+        return imp.load_source('ganglia_logtailer', os.path.join(src, 'ganglia-logtailer'))
+    finally:
+        sys.dont_write_bytecode = dont_write_bytecode
+
+class StubTailer(object):
+    def __init__(self, driver, log_file):
+        self.class_name = 'SlapdLogtailer'
+        self.plugin_options = {}
+        self.log_file = log_file
+        self.parser = driver.load_parser(self.class_name)
+        self.stats = driver.TailerStats(self.class_name)
+
+class ParseParallelTest(unittest.TestCase):
+    def setUp(self):
+        try:
+            self.driver = load_driver()
+        except EnvironmentError, e:
+            # it sets up its log in /var/log/ganglia when imported
+            self.skipTest("can't load ganglia-logtailer: %s" % e)
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'slapd.log')
+        self.state_file = os.path.join(self.dir, 'slapd.state')
+        self.read_block_size = self.driver.read_block_size
+
+    def tearDown(self):
+        if hasattr(self, 'dir'):
+            self.driver.read_block_size = self.read_block_size
+            shutil.rmtree(self.dir)
+
+    def write(self, filename, lines):
+        fh = open(filename, 'a')
+        fh.write(''.join(lines))
+        fh.close()
+
+    def parse(self, block_size, workers=3):
+        # chunks are at least read_block_size long
+        self.driver.read_block_size = block_size
+        tailer = StubTailer(self.driver, self.log)
+        input = OffsetTail(self.log, self.state_file)
+        try:
+            self.driver.parse_parallel(tailer, input, workers)
+        finally:
+            input.close()
+        [metric] = tailer.parser.crunch(tailer.parser.take_state(), 1)
+        return (metric.value, tailer.stats.counters.swap()['lines'])
+
+    def test_every_line_parsed_once(self):
+        # lines of varying length, so chunks start at every offset in a line
+        lines = [LINE % (i * 37) for i in range(500)]
+        self.write(self.log, lines)
+        write_offset_state(self.state_file, os.stat(self.log).st_ino, 0)
+        for block_size in (1, 7, 100, 113, len(lines[0]), 4096):
+            self.assertEqual(self.parse(block_size), (500, 500), 'block size %d' % block_size)
+
+    def test_chunk_starting_on_a_line(self):
+        self.write(self.log, [LINE % 0] * 10)
+        write_offset_state(self.state_file, os.stat(self.log).st_ino, 0)
+        self.assertEqual(self.parse(len(LINE % 0)), (10, 10))
+
+    def test_rotated_file_and_live_log(self):
+        self.write(self.log, [LINE % 1] * 20)
+        write_offset_state(self.state_file, os.stat(self.log).st_ino, len(LINE % 1) * 5)
+        os.rename(self.log, self.log + '.1')
+        self.write(self.log, [LINE % 22] * 30 + ['unfinished'])
+        self.assertEqual(self.parse(50), (45, 45))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+"""tests for QuantileSketch
+
+run from the ganglia-logtailer directory with
+    python -m unittest discover -s tests"""
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ganglia_logtailer_helper import QuantileSketch
+
+def exact_quantile(values, q):
+    # as the plugins used to: index the sorted list
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+class QuantileSketchTest(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(1)
+        self.values = [rand.lognormvariate(0, 2) for i in range(20000)]
+
+    def assertClose(self, value, expected, accuracy=0.01):
+        self.assertTrue(abs(value - expected) <= expected * accuracy * 1.01,
+                        "%s not within %s of %s" % (value, accuracy, expected))
+
+    def test_quantiles_within_relative_accuracy(self):
+        sketch = QuantileSketch()
+        sketch.extend(self.values)
+        for q in (0.5, 0.9, 0.99):
+            self.assertClose(sketch.quantile(q), exact_quantile(self.values, q))
+
+    def test_exact_summaries(self):
+        sketch = QuantileSketch()
+        for value in self.values:
+            sketch.add(value)
+        self.assertEqual(sketch.count, len(self.values))
+        self.assertAlmostEqual(sketch.sum, sum(self.values), places=6)
+        self.assertEqual(sketch.min, min(self.values))
+        self.assertEqual(sketch.max, max(self.values))
+        self.assertEqual(sketch.quantile(1), max(self.values))
+
+    def test_merge_matches_one_sketch(self):
+        halves = (QuantileSketch(), QuantileSketch())
+        halves[0].extend(self.values[:5000])
+        halves[1].extend(self.values[5000:])
+        halves[0].merge(halves[1])
+        whole = QuantileSketch()
+        whole.extend(self.values)
+        self.assertEqual(halves[0].count, whole.count)
+        for q in (0.5, 0.9, 0.99):
+            self.assertEqual(halves[0].quantile(q), whole.quantile(q))
+
+    def test_zeros_and_empty(self):
+        sketch = QuantileSketch()
+        self.assertEqual(sketch.quantile(0.9), 0)
+        self.assertEqual(sketch.avg(), 0)
+        sketch.extend([0] * 10 + [5])
+        self.assertEqual(sketch.quantile(0.5), 0)
+        self.assertClose(sketch.quantile(0.95), 5)
+
+    def test_percentile_labels(self):
+        sketch = QuantileSketch()
+        sketch.extend(range(1, 101))
+        self.assertEqual([label for (label, value) in sketch.percentiles((50, 99.9, 100))],
+                         ['50th', '99.9th', 'max'])
+
+    def test_buckets_stay_bounded(self):
+        # twenty decades of values need far more than 64 buckets; only the
+        # bottom of the distribution loses accuracy
+        values = [10 ** (i / 100.0) for i in range(-1000, 1000)]
+        sketch = QuantileSketch(max_buckets=64)
+        sketch.extend(values)
+        self.assertEqual(sketch.count, len(values))
+        self.assertTrue(len(sketch.buckets) <= 64)
+        self.assertClose(sketch.quantile(0.99), exact_quantile(values, 0.99))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,256 @@
+#!/usr/bin/python
+"""tests for following logs across rotation
+
+run from the ganglia-logtailer directory with
+    python -m unittest discover -s tests"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from tailnostate import OffsetTail, RotatedFiles, LogTail, TailWatcher, Inotify
+
+class LogDirTest(unittest.TestCase):
+    '''a temporary directory holding log, and the state file for it'''
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'app.log')
+        self.state_file = os.path.join(self.dir, 'app.state')
+        self.write('')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, data, filename=None, mode='a'):
+        fh = open(filename or self.log, mode)
+        fh.write(data)
+        fh.close()
+
+    def rotate(self):
+        os.rename(self.log, self.log + '.1')
+        self.write('')
+
+class OffsetTailTest(LogDirTest):
+    def read_all(self):
+        tail = OffsetTail(self.log, self.state_file)
+        data = []
+        while True:
+            block = tail.read(4)
+            if not block:
+                break
+            data.append(block)
+        tail.save_state()
+        tail.close()
+        return ''.join(data)
+
+    def test_first_run_starts_at_the_end(self):
+        self.write('old\n')
+        self.assertEqual(self.read_all(), '')
+        self.write('new\n')
+        self.assertEqual(self.read_all(), 'new\n')
+
+    def test_partial_line_is_left_for_next_time(self):
+        self.read_all()
+        self.write('one\ntw')
+        self.assertEqual(self.read_all(), 'one\n')
+        self.write('o\n')
+        self.assertEqual(self.read_all(), 'two\n')
+
+    def test_rest_of_rotated_file_is_read_first(self):
+        self.read_all()
+        self.write('one\n')
+        self.assertEqual(self.read_all(), 'one\n')
+        self.write('two\n')
+        self.rotate()
+        self.write('three\n')
+        self.assertEqual(self.read_all(), 'two\nthree\n')
+        self.assertEqual(self.read_all(), '')
+
+    def test_rotated_file_gone(self):
+        self.read_all()
+        self.write('one\n')
+        self.rotate()
+        os.unlink(self.log + '.1')
+        self.write('two\n')
+        self.assertEqual(self.read_all(), 'two\n')
+
+    def test_truncation_starts_over(self):
+        self.read_all()
+        self.write('a long line\n')
+        self.assertEqual(self.read_all(), 'a long line\n')
+        # copytruncate
+        self.write('new\n', mode='w')
+        self.assertEqual(self.read_all(), 'new\n')
+
+    def test_ranges(self):
+        self.read_all()
+        self.write('one\n')
+        self.rotate()
+        self.write('two\nthr')
+        tail = OffsetTail(self.log, self.state_file)
+        data = ''.join([self.pread(fd, start, end) for (fd, start, end) in tail.ranges()])
+        tail.consume()
+        tail.save_state()
+        tail.close()
+        self.assertEqual(data, 'one\ntwo\n')
+        self.write('ee\n')
+        self.assertEqual(self.read_all(), 'three\n')
+
+    def pread(self, fd, start, end):
+        os.lseek(fd, start, 0)
+        return os.read(fd, end - start)
+
+class RotatedFilesTest(LogDirTest):
+    def setUp(self):
+        LogDirTest.setUp(self)
+        self.rotated = RotatedFiles(self.log)
+
+    def inode(self, filename):
+        return os.stat(filename).st_ino
+
+    def test_files_oldest_first(self):
+        for suffix in ('.2', '.1'):
+            self.write('', self.log + suffix)
+            os.utime(self.log + suffix, (1000, {'.2': 1000, '.1': 2000}[suffix]))
+        self.write('', self.log + '.3.gz')
+        self.write('', os.path.join(self.dir, 'other.log'))
+        self.rotated.refresh()
+        self.assertEqual([name for (name, inode) in self.rotated.files],
+                         [self.log + '.2', self.log + '.1', self.log])
+
+    def test_successor(self):
+        live = self.inode(self.log)
+        self.rotate()
+        self.assertEqual(self.rotated.successor(live), (self.log, self.inode(self.log)))
+        self.assertEqual(self.rotated.successor(self.inode(self.log)), (self.log, None))
+        # an inode it has never seen
+        self.assertEqual(self.rotated.successor(-1), (self.log, None))
+
+    def test_rescans_after_rename(self):
+        live = self.inode(self.log)
+        self.rotated.refresh()
+        self.rotate()
+        # the rename may land within the directory's last mtime
+        self.assertEqual(self.rotated.successor(live)[0], self.log)
+        self.assertTrue(live in self.rotated.by_inode)
+
+class LogTailTest(LogDirTest):
+    def test_follows_rotation(self):
+        tail = LogTail(self.log)
+        self.write('one\n')
+        self.rotate()
+        self.write('two\n')
+        self.assertEqual(tail.read_lines(), ['one\n'])
+        tail.check_inode()
+        self.assertEqual(tail.read_lines(), ['two\n'])
+        tail.close()
+
+    def test_renamed_during_advance(self):
+        tail = LogTail(self.log)
+        self.write('one\n')
+        self.rotate()
+        fp = tail.fp
+        # the successor it finds has always been renamed again by the time
+        # it's opened
+        tail.rotated.successor = lambda inode: (self.log, -1)
+        self.assertRaises(EnvironmentError, tail.advance)
+        self.assertTrue(tail.fp is fp)
+        self.assertFalse(tail.fp.closed)
+        self.assertEqual(tail.retired, [])
+        self.assertEqual(tail.read_lines(), ['one\n'])
+        tail.close()
+
+    def test_resume_after_rotation(self):
+        tail = LogTail(self.log, self.state_file)
+        self.write('one\n')
+        self.assertEqual(tail.read_lines(), ['one\n'])
+        tail.save_state()
+        tail.close()
+        # rotated while it was stopped
+        self.write('two\n')
+        self.rotate()
+        self.write('three\n')
+        tail = LogTail(self.log, self.state_file)
+        self.assertEqual(tail.read_lines(), ['two\n'])
+        tail.check_inode()
+        self.assertEqual(tail.read_lines(), ['three\n'])
+        tail.close()
+
+class TailWatcherTest(LogDirTest):
+    use_inotify = True
+
+    def setUp(self):
+        LogDirTest.setUp(self)
+        if self.use_inotify:
+            try:
+                Inotify().close()
+            except OSError:
+                self.skipTest('inotify is not available')
+        self.tail = LogTail(self.log, self.state_file)
+        self.watcher = TailWatcher([self.tail], poll_interval=0, check_interval=0,
+                                   use_inotify=self.use_inotify)
+
+    def tearDown(self):
+        self.watcher.close()
+        self.tail.close()
+        LogDirTest.tearDown(self)
+
+    def wait(self):
+        self.watcher.wait(1)
+
+    def test_idle_without_rotation(self):
+        self.write('one\n')
+        self.wait()
+        self.assertEqual(self.tail.read_lines(), ['one\n'])
+        self.assertFalse(self.watcher.idle(self.tail))
+
+    def test_follows_rotation(self):
+        self.write('one\n')
+        self.rotate()
+        self.write('two\n')
+        self.wait()
+        self.assertEqual(self.tail.read_lines(), ['one\n'])
+        self.assertEqual(self.tail.read_lines(), [])
+        self.assertTrue(self.watcher.idle(self.tail))
+        self.assertEqual(self.tail.read_lines(), ['two\n'])
+        self.assertFalse(self.watcher.idle(self.tail))
+
+    def test_lines_written_after_rotation_are_read(self):
+        self.rotate()
+        self.wait()
+        self.assertTrue(self.watcher.idle(self.tail))
+        # the writer hasn't reopened its log yet
+        self.write('late\n', self.log + '.1')
+        self.wait()
+        self.assertEqual(self.tail.read_lines(), ['late\n'])
+
+    def test_renamed_but_not_replaced(self):
+        os.rename(self.log, self.log + '.1')
+        self.wait()
+        self.assertFalse(self.watcher.idle(self.tail))
+        self.write('')
+        self.wait()
+        self.assertTrue(self.watcher.idle(self.tail))
+
+    def test_resumed_in_rotated_file(self):
+        self.tail.save_state()
+        self.write('one\n')
+        self.rotate()
+        self.write('two\n')
+        tail = LogTail(self.log, self.tail.state_file)
+        self.watcher.add(tail)
+        self.assertEqual(tail.read_lines(), ['one\n'])
+        # no more events are coming for the rotation
+        self.assertTrue(self.watcher.idle(tail))
+        self.assertEqual(tail.read_lines(), ['two\n'])
+        tail.close()
+
+class PollingTailWatcherTest(TailWatcherTest):
+    use_inotify = False
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+"""tests for TimestampParser
+
+run from the ganglia-logtailer directory with
+    python -m unittest discover -s tests"""
+
+import os
+import sys
+import time
+import calendar
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ganglia_logtailer_helper import TimestampParser
+
+# 2010-04-02 14:20:30 UTC
+APR_2 = calendar.timegm((2010, 4, 2, 14, 20, 30, 0, 0, 0))
+
+class TimestampParserTest(unittest.TestCase):
+    def test_ncsa(self):
+        parser = TimestampParser('ncsa')
+        self.assertEqual(parser.parse('02/Apr/2010:10:20:30 -0400'), APR_2)
+        self.assertEqual(parser.parse('[02/Apr/2010:16:20:30 +0200]'), APR_2)
+        self.assertEqual(parser.parse('02/Apr/2010:14:20:30 +0000'), APR_2)
+
+    def test_iso(self):
+        parser = TimestampParser('iso')
+        self.assertEqual(parser.parse('2010-04-02T14:20:30Z'), APR_2)
+        self.assertEqual(parser.parse('2010-04-02T15:20:30.123+01:00'), APR_2)
+        self.assertEqual(parser.parse('2010-04-02 09:20:30-0500'), APR_2)
+
+    def test_local_time(self):
+        parser = TimestampParser('iso')
+        self.assertEqual(parser.parse('2010-04-02T14:20:30'),
+                         time.mktime((2010, 4, 2, 14, 20, 30, 0, 0, -1)))
+
+    def test_syslog(self):
+        parser = TimestampParser('syslog')
+        now = int(time.time())
+        text = time.strftime('%b %e %H:%M:%S', time.localtime(now - 3600))
+        self.assertEqual(parser.parse(text), now - 3600)
+
+    def test_syslog_from_last_year(self):
+        # a timestamp days ahead must be from a year ago (eg. a December
+        # log read in January)
+        parser = TimestampParser('syslog')
+        ahead = time.localtime(time.time() + 5 * 86400)
+        text = time.strftime('%b %e %H:%M:%S', ahead)
+        expected = time.mktime((ahead.tm_year - 1,) + tuple(ahead[1:6]) + (0, 0, -1))
+        self.assertEqual(parser.parse(text), expected)
+
+    def test_each_second_within_an_hour(self):
+        parser = TimestampParser('ncsa')
+        for second in range(0, 3600, 7):
+            text = '02/Apr/2010:14:%02d:%02d +0000' % (second // 60, second % 60)
+            self.assertEqual(parser.parse(text), APR_2 - 20 * 60 - 30 + second)
+            # the remembered timestamp
+            self.assertEqual(parser.parse(text), APR_2 - 20 * 60 - 30 + second)
+
+    def test_hours_are_forgotten(self):
+        parser = TimestampParser('iso')
+        parser.max_hours = 4
+        for hour in range(10):
+            self.assertEqual(parser.parse('2010-04-02T%02d:20:30Z' % hour), APR_2 + (hour - 14) * 3600)
+            self.assertTrue(len(parser.hours) <= 4)
+
+    def test_bad_timestamps(self):
+        parser = TimestampParser('ncsa')
+        for text in ('', '02/Apr/2010', '02-Apr-2010:10:20:30 -0400', '02/Foo/2010:10:20:30 -0400'):
+            self.assertRaises(ValueError, parser.parse, text)
+        self.assertRaises(ValueError, TimestampParser('iso').parse, '2010/04/02 14:20:30')
+        self.assertRaises(ValueError, TimestampParser('syslog').parse, 'Sep 11 09-03-05')
+        self.assertRaises(ValueError, TimestampParser, 'rfc822')
+
+if __name__ == '__main__':
+    unittest.main()